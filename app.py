@@ -10,6 +10,7 @@ from colorama import Fore, Style
 import config
 from core.model_llama_cpp import ModelWrapper
 from core.conversation import ConversationManager
+from core.cancellation import CancelToken, cancel_on_sigint, display_text
 from core.utils import setup_logging, save_chat_log, get_model_info
 
 colorama.init(autoreset=True)
@@ -48,7 +49,7 @@ class ChatApp:
         
         try:
             self.model_wrapper = ModelWrapper()
-            self.conversation_manager = ConversationManager(self.config)
+            self.conversation_manager = ConversationManager(self.config, tokenizer=self.model_wrapper.tokenize)
             print(f"{Fore.GREEN}✓ Sẵn sàng!")
         except Exception as e:
             print(f"{Fore.RED}Lỗi: {e}")
@@ -91,19 +92,20 @@ class ChatApp:
         try:
             # Build prompt TRƯỚC khi thêm vào lịch sử
             prompt = self.conversation_manager.build_prompt(user_input)
-            response = self.model_wrapper.generate(prompt)
+            question = self.conversation_manager.standalone_question(user_input)
+            # Ctrl+C trong lúc sinh chỉ dừng câu trả lời, giữ phần đã có
+            cancel = CancelToken(timeout=self.config.get('request_timeout') or None)
+            with cancel_on_sigint(cancel):
+                response = self.model_wrapper.generate(prompt, question=question, cancel=cancel)
             
             # Sau đó mới thêm vào lịch sử
             self.conversation_manager.add_user_message(user_input)
             self.conversation_manager.add_assistant_message(response)
             
-            print(f"{Fore.GREEN}🤖 AI: {Style.RESET_ALL}{response}")
+            print(f"{Fore.GREEN}🤖 AI: {Style.RESET_ALL}{display_text(response)}")
             
             save_chat_log(user_input, response, self.config.get('log_dir', 'logs'))
             
-            if self.conversation_manager.is_history_full():
-                self.conversation_manager.trim_history(keep_turns=3)
-            
         except Exception as e:
             print(f"{Fore.RED}Lỗi: {e}")
 
@@ -0,0 +1,118 @@
+# micro-benchmarks for ConversationManager
+# compares the append-only prompt buffer with the old rebuild-every-turn code
+# run with: python benchmarks/bench_conversation.py
+import os
+import sys
+import time
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.conversation import ConversationManager
+
+
+class LegacyConversationManager:
+    # the previous implementation: join every message on every turn,
+    # trim by copying the deque into a list and back
+
+    def __init__(self, config):
+        self.config = config
+        self.history = deque(maxlen=config.get('history_max_turns', 6) * 2)
+
+    def add_user_message(self, message):
+        if message.strip():
+            self.history.append({"role": "user", "content": message.strip()})
+
+    def add_assistant_message(self, message):
+        if message.strip():
+            self.history.append({"role": "assistant", "content": message.strip()})
+
+    def build_prompt(self, user_input):
+        prompt_parts = []
+        for message in self.history:
+            if message["role"] == "user":
+                prompt_parts.append(f"### Human: {message['content']}")
+            else:
+                prompt_parts.append(f"### Assistant: {message['content']}")
+        prompt_parts.append(f"### Human: {user_input}")
+        prompt_parts.append("### Assistant:")
+        return "\n".join(prompt_parts)
+
+    def trim_history(self, keep_turns=3):
+        if len(self.history) <= keep_turns * 2:
+            return
+        history_list = list(self.history)
+        trimmed_history = history_list[-(keep_turns * 2):]
+        self.history.clear()
+        for message in trimmed_history:
+            self.history.append(message)
+
+
+def fake_tokenizer(text):
+    # cheap stand-in for the llama tokenizer, ~1 token id per word
+    return [len(word) for word in text.split()]
+
+
+USER_MSG = "Làm sao để đảo ngược một list trong Python mà không tạo bản sao?"
+AI_MSG = "Bạn có thể dùng list.reverse() để đảo ngược tại chỗ, hoặc slicing lst[::-1] nếu cần bản sao."
+
+
+def bench_turns(manager, turns):
+    # one turn = build prompt + add both messages (history already full)
+    # both sides pay for tokenizing the prompt once, as the model does
+    start = time.perf_counter()
+    for _ in range(turns):
+        prompt = manager.build_prompt(USER_MSG)
+        fake_tokenizer(prompt)
+        manager.add_user_message(USER_MSG)
+        manager.add_assistant_message(AI_MSG)
+    return (time.perf_counter() - start) / turns * 1e6
+
+
+def bench_trim(make_manager, history_turns, repeats):
+    # evict the oldest turn of a full history (the delta is one turn)
+    total = 0.0
+    for _ in range(repeats):
+        manager = make_manager()
+        for _ in range(history_turns):
+            manager.add_user_message(USER_MSG)
+            manager.add_assistant_message(AI_MSG)
+        start = time.perf_counter()
+        manager.trim_history(keep_turns=history_turns - 1)
+        total += time.perf_counter() - start
+    return total / repeats * 1e6
+
+
+def main():
+    print(f"{'history turns':>14} | {'legacy turn µs':>14} | {'buffer turn µs':>14} | "
+          f"{'legacy trim µs':>14} | {'buffer trim µs':>14}")
+    print("-" * 84)
+    for history_turns in (6, 60, 600, 6000):
+        # large context so the whole history always fits and both build the same prompt
+        config = {"history_max_turns": history_turns, "n_ctx": 10 ** 9, "max_tokens": 512}
+
+        legacy = LegacyConversationManager(config)
+        buffered = ConversationManager(config, tokenizer=fake_tokenizer)
+        for manager in (legacy, buffered):
+            for _ in range(history_turns):
+                manager.add_user_message(USER_MSG)
+                manager.add_assistant_message(AI_MSG)
+
+        turns = max(20, 20000 // history_turns)
+        legacy_turn = bench_turns(legacy, turns)
+        buffer_turn = bench_turns(buffered, turns)
+
+        repeats = max(3, 2000 // history_turns)
+        legacy_trim = bench_trim(lambda: LegacyConversationManager(config), history_turns, repeats)
+        buffer_trim = bench_trim(lambda: ConversationManager(config, tokenizer=fake_tokenizer), history_turns, repeats)
+
+        print(f"{history_turns:>14} | {legacy_turn:>14.1f} | {buffer_turn:>14.1f} | "
+              f"{legacy_trim:>14.1f} | {buffer_trim:>14.1f}")
+
+    print("\nturn: both sides build and tokenize the full prompt once; the buffer also")
+    print("tokenizes the two new messages and packs the token budget, which the legacy")
+    print("code did not do at all. trim: evicting no longer depends on history length.")
+
+
+if __name__ == "__main__":
+    main()
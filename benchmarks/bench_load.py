@@ -0,0 +1,145 @@
+# load test for the scheduler, caches and streaming without a model file
+# every slot runs the simulated backend (BACKEND = "simulated"): prompt
+# evaluation and generated tokens cost fixed sleeps, answers are a function
+# of prompt and seed, so the same workload gives the same outputs every run
+# run with: python benchmarks/bench_load.py [users] [turns] [slots]
+import os
+import sys
+import time
+import hashlib
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.conversation import ConversationManager
+from core.model_llama_cpp import ModelWrapper, create_response_cache
+from core.scheduler import InferenceScheduler, QueueFullError
+from core.state_store import ModelStateStore
+
+QUESTIONS = [
+    "Làm sao để đảo ngược một list trong Python?",
+    "Khác nhau giữa tuple và list là gì?",
+    "Cách đọc file theo từng dòng?",
+    "Dùng dict comprehension như thế nào?",
+    "Bắt nhiều loại ngoại lệ trong một except được không?",
+]
+
+BASE = {
+    "backend": "simulated",
+    "sim_prompt_ms": 0.5,
+    "sim_token_ms": 5.0,
+    "sim_answer_tokens": 48,
+    "max_tokens": 128,
+    "temperature": 0,
+    "seed": 42,
+    "state_cache": False,
+    "response_cache": False,
+    "semantic_cache": False,
+}
+
+
+def run_workload(n_users, n_turns, n_slots, overrides):
+    # each user holds one conversation and asks n_turns questions in a row,
+    # streaming the answers; all users start together
+    conf = dict(BASE, **overrides)
+    state_store = ModelStateStore(256, None, 0) if conf["state_cache"] else None
+    response_cache = create_response_cache(dict(conf, response_cache_dir="")) if conf["response_cache"] else None
+    scheduler = InferenceScheduler(
+        lambda slot: ModelWrapper(config_overrides=conf, state_store=state_store, response_cache=response_cache),
+        n_workers=n_slots, max_queue=n_users * 2, max_per_user=2)
+
+    latencies, first_tokens, outputs = [], [], {}
+    lock = threading.Lock()
+    rejected = [0]
+
+    def user(index):
+        manager = ConversationManager(conf, tokenizer=scheduler.slots[0].tokenize)
+        conv_id = f"user-{index}"
+        for turn in range(n_turns):
+            question = QUESTIONS[(index + turn) % len(QUESTIONS)]
+            prompt = manager.build_prompt(question)
+            started = time.perf_counter()
+            first = []
+
+            def job(model):
+                model.switch_conversation(conv_id)
+                pieces = []
+                for delta in model.generate(prompt, stream=True):
+                    if not first:
+                        first.append(time.perf_counter() - started)
+                    pieces.append(delta)
+                return "".join(pieces).strip()
+
+            try:
+                answer = scheduler.run(job, user=conv_id)
+            except QueueFullError:
+                with lock:
+                    rejected[0] += 1
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - started)
+                first_tokens.extend(first)
+                outputs[(index, turn)] = answer
+            manager.add_user_message(question)
+            manager.add_assistant_message(answer)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=user, args=(i,)) for i in range(n_users)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    eval_totals = [slot.get_eval_stats()["totals"] for slot in scheduler.slots]
+    prompt_tokens = sum(t["prompt_tokens"] for t in eval_totals)
+    reused = sum(t["reused_tokens"] for t in eval_totals)
+    cache = response_cache.get_stats() if response_cache else None
+    scheduler.shutdown()
+
+    digest = hashlib.sha256(repr(sorted(outputs.items())).encode("utf-8")).hexdigest()[:12]
+    return {
+        "requests": len(latencies),
+        "rejected": rejected[0],
+        "rps": len(latencies) / elapsed,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "ttft": percentile(first_tokens, 50),
+        "reuse": reused / prompt_tokens if prompt_tokens else 0.0,
+        "cache_hits": cache["ram_hits"] + cache["disk_hits"] if cache else 0,
+        "digest": digest,
+    }
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q / 100))]
+
+
+def main():
+    n_users = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    n_turns = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    n_slots = int(sys.argv[3]) if len(sys.argv) > 3 else 2
+    print(f"{n_users} users x {n_turns} turns, {n_slots} slots, "
+          f"{BASE['sim_token_ms']} ms/token, {BASE['sim_prompt_ms']} ms/prompt token\n")
+
+    scenarios = [
+        ("no caches", {}),
+        ("state cache", {"state_cache": True}),
+        ("state + response cache", {"state_cache": True, "response_cache": True}),
+    ]
+    print(f"{'scenario':>24} | {'req':>4} | {'rej':>4} | {'req/s':>6} | {'p50 s':>6} | "
+          f"{'p95 s':>6} | {'ttft s':>6} | {'reuse':>6} | {'hits':>4} | output")
+    print("-" * 104)
+    for name, overrides in scenarios:
+        r = run_workload(n_users, n_turns, n_slots, overrides)
+        print(f"{name:>24} | {r['requests']:>4} | {r['rejected']:>4} | {r['rps']:>6.2f} | {r['p50']:>6.3f} | "
+              f"{r['p95']:>6.3f} | {r['ttft']:>6.3f} | {r['reuse']:>6.1%} | {r['cache_hits']:>4} | {r['digest']}")
+
+    print("\noutput is a hash of all answers: same workload -> same hash in every run and scenario")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+# speculative decoding benchmark
+# generates the same prompts with and without DRAFT_MODEL_PATH and compares
+# decode speed; temperature 0 so both runs must produce the same text
+# run with: python benchmarks/bench_speculative.py [draft.gguf]
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from core.model_llama_cpp import ModelWrapper
+
+PROMPTS = [
+    "### Human: Viết hàm Python đảo ngược một list mà không dùng slicing.\n### Assistant:",
+    "### Human: Giải thích sự khác nhau giữa list và tuple trong Python.\n### Assistant:",
+    "### Human: Viết hàm kiểm tra một số có phải số nguyên tố không.\n### Assistant:",
+    "### Human: Làm sao đọc một file CSV bằng module csv?\n### Assistant:",
+]
+MAX_TOKENS = 128
+
+
+def run(model):
+    # (texts, generated tokens, seconds)
+    texts, tokens, elapsed = [], 0, 0.0
+    for prompt in PROMPTS:
+        model.reset_cache()
+        start = time.perf_counter()
+        text = model.generate(prompt, max_tokens=MAX_TOKENS, temperature=0, stream=False)
+        elapsed += time.perf_counter() - start
+        texts.append(text)
+        tokens += len(model.tokenize(text))
+    return texts, tokens, elapsed
+
+
+def main():
+    draft_path = sys.argv[1] if len(sys.argv) > 1 else config.DRAFT_MODEL_PATH
+    if not draft_path:
+        print("Cần draft model: python benchmarks/bench_speculative.py <draft.gguf> (hoặc đặt DRAFT_MODEL_PATH)")
+        return
+    common = {"response_cache": False, "semantic_cache": False, "state_cache": False}
+
+    baseline = ModelWrapper(config_overrides=dict(common, draft_model_path=None))
+    base_texts, base_tokens, base_time = run(baseline)
+    del baseline
+
+    speculative = ModelWrapper(config_overrides=dict(common, draft_model_path=draft_path))
+    spec_texts, spec_tokens, spec_time = run(speculative)
+    stats = speculative.get_speculative_stats()
+
+    base_rate = base_tokens / base_time
+    spec_rate = spec_tokens / spec_time
+    print(f"{'mode':>12} | {'tokens':>7} | {'seconds':>8} | {'tok/s':>7}")
+    print("-" * 44)
+    print(f"{'baseline':>12} | {base_tokens:>7} | {base_time:>8.2f} | {base_rate:>7.2f}")
+    print(f"{'speculative':>12} | {spec_tokens:>7} | {spec_time:>8.2f} | {spec_rate:>7.2f}")
+    print(f"\nspeedup: {spec_rate / base_rate:.2f}x")
+    print(f"acceptance: {stats['acceptance_rate']:.1%}, tokens/pass: {stats['tokens_per_pass']:.2f}, "
+          f"final k: {stats['k']}, draft: {stats['draft_ms_per_pass']:.1f} ms/pass")
+    print(f"same output as baseline: {base_texts == spec_texts}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,18 +2,89 @@
 # all settings in one place
 
 # model settings
+BACKEND = "llama_cpp"  # "llama_cpp" (GGUF model) or "simulated" (fake model for load tests, no model file)
 MODEL_PATH = "models/python.gguf"
 N_CTX = 2048          # context window size
 N_THREADS = 4         # cpu threads to use
 N_BATCH = 16          # batch size
+INCREMENTAL_EVAL = True  # reuse kv cache prefix between turns
+USE_MMAP = True          # map the GGUF instead of reading it (weights shared between processes)
+DRAFT_MODEL_PATH = None  # small GGUF with the same tokenizer for speculative decoding (None = off)
+DRAFT_MAX_K = 8          # max draft tokens verified per main-model pass (k adapts to acceptance)
+MODELS = {}              # more models by name, e.g. {"large": {"model_path": "models/big.gguf", "description": "..."}}; MODEL_PATH is "default"
+DEFAULT_MODEL = "default"  # model for requests that do not pick one
+
+# routing between a small and a large model of MODELS (requests that do not pick one)
+ROUTER = False                       # estimate each request's cost and use the cheapest adequate model
+ROUTER_SMALL_MODEL = "default"       # fast model for short, simple messages
+ROUTER_LARGE_MODEL = "large"         # slow model for the rest
+ROUTER_MAX_SMALL_PROMPT_TOKENS = 768   # longer prompts go to the large model
+ROUTER_MAX_SMALL_ANSWER_TOKENS = 512   # larger max_tokens go to the large model
+ROUTER_MAX_SMALL_WORDS = 40          # longer user messages go to the large model
+ROUTER_LARGE_KEYWORDS = ["giải thích", "tại sao", "so sánh", "phân tích", "tối ưu", "thuật toán",
+                         "viết chương trình", "debug", "explain", "why", "compare", "optimize"]
+ROUTER_ESCALATE = True               # answer again with the large model when the small one's looks bad
+ROUTER_ESCALATE_PEEK_CHARS = 160     # streamed characters held back for that check
+
+# simulated backend (BACKEND = "simulated")
+SIM_PROMPT_MS = 0.5       # ms per evaluated prompt token
+SIM_TOKEN_MS = 20.0       # ms per generated token
+SIM_ANSWER_TOKENS = 64    # average answer length (deterministic per prompt and seed)
+SIM_N_VOCAB = 32000       # size of the fake vocabulary
+
+# conversation state snapshots (fast switching)
+STATE_CACHE = False           # snapshot llama state per conversation (opt-in: RAM + disk below)
+STATE_CACHE_RAM_MB = 1024     # hot snapshots kept in RAM
+STATE_CACHE_DIR = "cache/states"  # colder snapshots spill here
+STATE_CACHE_DISK_MB = 4096    # disk cap for spilled snapshots
+
+# web server scheduling
+WORKER_SLOTS = 1          # model instances serving requests in parallel
+MEMORY_BUDGET_MB = 8192   # RAM allowed for all worker models
+QUEUE_MAX_DEPTH = 32      # queued requests before returning 503
+QUEUE_MAX_PER_USER = 4    # queued + running requests per user before 429
+BATCH_DECODE = False      # decode concurrent chats together in one context
+BATCH_MAX_SEQUENCES = 4   # sequences per batch (each gets N_CTX tokens)
+INFERENCE_SOCKET = None   # unix socket of the inference server (python -m core.inference_server), None = load the model in the web app
+INFERENCE_CLIENT_SLOTS = 8  # concurrent requests one web worker sends to the inference server
+PREFORK_WORKERS = 2       # web processes forked by web_prefork.py after loading the model once
 
 # generation settings  
 TEMPERATURE = 0.8     # creativity level (0-2)
 TOP_P = 0.95         # top-p sampling
 MAX_TOKENS = 512     # max response length
+SEED = None          # fixed sampling seed (None = random each time)
+REQUEST_TIMEOUT = 300  # seconds a request may take incl. queueing, then the partial answer is returned (0 = no limit)
+
+# response cache (only deterministic generations: TEMPERATURE 0 or SEED set)
+RESPONSE_CACHE = False             # serve repeated prompts without generating again
+RESPONSE_CACHE_RAM_MB = 32         # answers kept in RAM
+RESPONSE_CACHE_DIR = "cache/responses"  # answers persisted here ("" = RAM only)
+RESPONSE_CACHE_DISK_MB = 256       # disk cap for persisted answers
+RESPONSE_CACHE_TTL = 86400         # seconds an answer stays valid (0 = forever)
+
+# semantic cache (first question of a conversation, matched by meaning)
+SEMANTIC_CACHE = False             # answer near-duplicate questions from earlier answers
+SEMANTIC_CACHE_THRESHOLD = 0.92    # cosine similarity needed for a hit (0-1)
+SEMANTIC_CACHE_MAX_ITEMS = 2000    # stored question/answer pairs
+SEMANTIC_CACHE_EVICTION = "lru"    # "lru", "lfu" or "fifo" when full
+SEMANTIC_CACHE_ANN_MIN = 1000      # items before switching to approximate (LSH) search, 0 = always exact (<= MAX_ITEMS)
+EMBEDDING_N_CTX = 512              # context of the embedding-mode model (longer questions are cut)
 
 # conversation settings
 HISTORY_MAX_TURNS = 6  # how many turns to remember
+PROMPT_RESERVE_TOKENS = 64  # safety margin left free in the context
+SESSION_MAX = 1000        # live conversations kept in web server RAM
+SESSION_MAX_MB = 256      # memory cap for live conversations
+SESSION_IDLE_TTL = 1800   # seconds before an idle conversation is evicted
+SESSION_SYNC_TTL = 5      # multi-process web: seconds before re-checking a conversation in the database
+HISTORY_PAGE_SIZE = 20    # messages per page when opening old conversations
+
+# chat history storage
+STORAGE_BACKEND = "mongo"      # "mongo" (MONGO_URI) or "sqlite" (local file, no server)
+SQLITE_PATH = "chat_history.db"  # sqlite database file
+READ_CACHE_MB = 64             # in-process cache for conversation lists/messages (0 = off)
+READ_CACHE_TTL = 30            # seconds a cached read stays valid (bounds staleness across processes)
 
 # logging
 LOG_DIR = "logs"      # where to save logs
@@ -21,29 +92,106 @@ LOG_DIR = "logs"      # where to save logs
 # get all config as dict (for compatibility)
 def get_config():
     return {
+        "backend": BACKEND,
         "model_path": MODEL_PATH,
         "n_ctx": N_CTX,
         "n_threads": N_THREADS,
         "n_batch": N_BATCH,
+        "incremental_eval": INCREMENTAL_EVAL,
+        "use_mmap": USE_MMAP,
+        "draft_model_path": DRAFT_MODEL_PATH,
+        "draft_max_k": DRAFT_MAX_K,
+        "models": MODELS,
+        "default_model": DEFAULT_MODEL,
+        "router": ROUTER,
+        "router_small_model": ROUTER_SMALL_MODEL,
+        "router_large_model": ROUTER_LARGE_MODEL,
+        "router_max_small_prompt_tokens": ROUTER_MAX_SMALL_PROMPT_TOKENS,
+        "router_max_small_answer_tokens": ROUTER_MAX_SMALL_ANSWER_TOKENS,
+        "router_max_small_words": ROUTER_MAX_SMALL_WORDS,
+        "router_large_keywords": ROUTER_LARGE_KEYWORDS,
+        "router_escalate": ROUTER_ESCALATE,
+        "router_escalate_peek_chars": ROUTER_ESCALATE_PEEK_CHARS,
+        "sim_prompt_ms": SIM_PROMPT_MS,
+        "sim_token_ms": SIM_TOKEN_MS,
+        "sim_answer_tokens": SIM_ANSWER_TOKENS,
+        "sim_n_vocab": SIM_N_VOCAB,
+        "state_cache": STATE_CACHE,
+        "state_cache_ram_mb": STATE_CACHE_RAM_MB,
+        "state_cache_dir": STATE_CACHE_DIR,
+        "state_cache_disk_mb": STATE_CACHE_DISK_MB,
+        "worker_slots": WORKER_SLOTS,
+        "memory_budget_mb": MEMORY_BUDGET_MB,
+        "queue_max_depth": QUEUE_MAX_DEPTH,
+        "queue_max_per_user": QUEUE_MAX_PER_USER,
+        "batch_decode": BATCH_DECODE,
+        "batch_max_sequences": BATCH_MAX_SEQUENCES,
+        "inference_socket": INFERENCE_SOCKET,
+        "inference_client_slots": INFERENCE_CLIENT_SLOTS,
+        "prefork_workers": PREFORK_WORKERS,
         "temperature": TEMPERATURE,
         "top_p": TOP_P,
         "max_tokens": MAX_TOKENS,
+        "seed": SEED,
+        "request_timeout": REQUEST_TIMEOUT,
+        "response_cache": RESPONSE_CACHE,
+        "response_cache_ram_mb": RESPONSE_CACHE_RAM_MB,
+        "response_cache_dir": RESPONSE_CACHE_DIR,
+        "response_cache_disk_mb": RESPONSE_CACHE_DISK_MB,
+        "response_cache_ttl": RESPONSE_CACHE_TTL,
+        "semantic_cache": SEMANTIC_CACHE,
+        "semantic_cache_threshold": SEMANTIC_CACHE_THRESHOLD,
+        "semantic_cache_max_items": SEMANTIC_CACHE_MAX_ITEMS,
+        "semantic_cache_eviction": SEMANTIC_CACHE_EVICTION,
+        "semantic_cache_ann_min": SEMANTIC_CACHE_ANN_MIN,
+        "embedding_n_ctx": EMBEDDING_N_CTX,
         "history_max_turns": HISTORY_MAX_TURNS,
+        "prompt_reserve_tokens": PROMPT_RESERVE_TOKENS,
+        "session_max": SESSION_MAX,
+        "session_max_mb": SESSION_MAX_MB,
+        "session_idle_ttl": SESSION_IDLE_TTL,
+        "session_sync_ttl": SESSION_SYNC_TTL,
+        "history_page_size": HISTORY_PAGE_SIZE,
+        "storage_backend": STORAGE_BACKEND,
+        "sqlite_path": SQLITE_PATH,
+        "read_cache_mb": READ_CACHE_MB,
+        "read_cache_ttl": READ_CACHE_TTL,
         "log_dir": LOG_DIR
     }
 
 # validate config
-def validate_config():
-    # check if model file exists
+def validate_config(conf=None):
+    # conf: config dict to check (ModelWrapper with overrides), default get_config()
     import os
-    if not os.path.exists(MODEL_PATH):
-        return False, f"Model file not found: {MODEL_PATH}"
+    conf = conf or get_config()
+    if conf.get('backend', 'llama_cpp') not in ("llama_cpp", "simulated"):
+        return False, f"Unknown BACKEND: {conf.get('backend')}"
+    
+    # check if model file exists (the simulated backend has none)
+    if conf.get('backend', 'llama_cpp') == "llama_cpp" and not os.path.exists(conf['model_path']):
+        return False, f"Model file not found: {conf['model_path']}"
     
     # check values are reasonable
-    if N_CTX < 256 or N_CTX > 8192:
+    if conf['n_ctx'] < 256 or conf['n_ctx'] > 8192:
         return False, "N_CTX should be between 256-8192"
     
-    if TEMPERATURE < 0 or TEMPERATURE > 2:
+    if conf.get('draft_model_path') and not os.path.exists(conf['draft_model_path']):
+        return False, f"Draft model file not found: {conf['draft_model_path']}"
+    
+    for name, spec in (conf.get('models') or {}).items():
+        if 'model_path' not in spec:
+            return False, f"MODELS[{name!r}] needs model_path"
+        if conf.get('backend', 'llama_cpp') == "llama_cpp" and not os.path.exists(spec['model_path']):
+            return False, f"Model file not found: {spec['model_path']}"
+    
+    if conf['temperature'] < 0 or conf['temperature'] > 2:
         return False, "TEMPERATURE should be between 0-2"
+    
+    ann_min = conf.get('semantic_cache_ann_min', 0)
+    if conf.get('semantic_cache') and ann_min > conf.get('semantic_cache_max_items', 0):
+        # not fatal: the cache never grows that large, search just stays exact
+        import logging
+        logging.warning(f"SEMANTIC_CACHE_ANN_MIN ({ann_min}) > SEMANTIC_CACHE_MAX_ITEMS "
+                        f"({conf.get('semantic_cache_max_items')}): LSH search is never used")
         
     return True, "Config OK"
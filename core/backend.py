@@ -0,0 +1,74 @@
+# inference backend interface
+# ModelWrapper adds prompt prefix reuse, answer caches, cancellation and
+# conversation snapshots on top of a backend; the backend only runs the model
+# implementations: llama_cpp (GGUF via llama-cpp-python) and simulated
+# (deterministic fake model for load tests without a model file)
+
+
+class InferenceBackend:
+    # one loaded model with one evaluation context (not thread-safe)
+
+    model_id = None  # identity used in response cache keys
+
+    def tokenize(self, text, add_bos=True):
+        """Token ids của text"""
+        raise NotImplementedError
+
+    def token_bos(self):
+        raise NotImplementedError
+
+    def n_ctx(self):
+        raise NotImplementedError
+
+    def cached_tokens(self):
+        # token ids currently evaluated in the context (kv cache), oldest first
+        raise NotImplementedError
+
+    def reset(self):
+        # forget the evaluated tokens
+        raise NotImplementedError
+
+    def complete(self, tokens, max_tokens, temperature, top_p, stop, stream=False,
+                 seed=None, should_stop=None):
+        # generate after the prompt tokens (with BOS); the evaluated prefix
+        # shared with cached_tokens() is reused
+        # returns the text, or an iterator of text deltas when stream=True
+        # should_stop: callable checked after every generated token
+        raise NotImplementedError
+
+    def save_state(self):
+        # snapshot of the context (picklable, sized by ModelStateStore)
+        raise NotImplementedError
+
+    def load_state(self, state):
+        raise NotImplementedError
+
+    def embed(self, text):
+        # embedding vector of text
+        raise NotImplementedError
+
+    def get_speculative_stats(self):
+        # draft acceptance stats, None when not supported / off
+        return None
+
+    def after_fork(self, n_threads=None):
+        # called in a forked worker before first use: rebuild per-process
+        # state, the loaded weights stay shared with the parent
+        self.reset()
+
+    def close(self):
+        # release the model (unloaded by ModelRegistry); unusable afterwards
+        pass
+
+
+def create_backend(conf):
+    # create the backend selected by conf['backend']
+    # imports are lazy so the simulated backend works without llama_cpp installed
+    name = conf.get('backend', 'llama_cpp')
+    if name == 'llama_cpp':
+        from core.backend_llama_cpp import LlamaCppBackend
+        return LlamaCppBackend(conf)
+    if name == 'simulated':
+        from core.backend_simulated import SimulatedBackend
+        return SimulatedBackend(conf)
+    raise ValueError(f"BACKEND không hợp lệ: {name}")
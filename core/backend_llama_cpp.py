@@ -0,0 +1,177 @@
+# llama.cpp backend (GGUF models through llama-cpp-python)
+import os
+
+from llama_cpp import Llama, StoppingCriteriaList
+
+from core.backend import InferenceBackend
+from core.response_cache import model_identity
+
+
+class LlamaCppBackend(InferenceBackend):
+
+    def __init__(self, conf):
+        self.config = conf
+        model_path = conf.get('model_path')
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(f"Không tìm thấy model: {model_path}")
+
+        self.draft_model = None  # GGUFDraftModel when DRAFT_MODEL_PATH is set
+        self._load(conf)
+        self.model_id = model_identity(model_path)
+        self._embedder = None  # embedding-mode context, loaded on first use
+        self._parent = None    # models of the preloading parent (after_fork)
+
+    def _load(self, conf):
+        kwargs = {}
+        if conf.get('seed') is not None:
+            kwargs['seed'] = conf['seed']
+        if conf.get('draft_model_path'):
+            # speculative decoding: llama verifies the draft's tokens in one batch
+            from core.speculative import create_draft_model
+            self.draft_model = create_draft_model(conf)
+            kwargs['draft_model'] = self.draft_model
+
+        self.llm = Llama(
+            model_path=conf.get('model_path'),
+            n_ctx=conf.get('n_ctx', 1024),
+            n_threads=conf.get('n_threads', 4),
+            n_batch=conf.get('n_batch', 16),
+            use_mmap=conf.get('use_mmap', True),
+            verbose=False,
+            **kwargs
+        )
+        if self.draft_model is not None and self.draft_model.llm.n_vocab() != self.llm.n_vocab():
+            raise ValueError("Draft model phải dùng cùng bộ từ vựng (tokenizer) với model chính")
+
+    def tokenize(self, text, add_bos=True):
+        return self.llm.tokenize(text.encode("utf-8"), add_bos=add_bos)
+
+    def token_bos(self):
+        return self.llm.token_bos()
+
+    def n_ctx(self):
+        return self.llm.n_ctx()
+
+    def cached_tokens(self):
+        return getattr(self.llm, '_input_ids', [])
+
+    def reset(self):
+        self.llm.reset()
+
+    def complete(self, tokens, max_tokens, temperature, top_p, stop, stream=False,
+                 seed=None, should_stop=None):
+        kwargs = {}
+        if seed is not None:
+            # fixed seed is passed on every call so each generation restarts the rng
+            kwargs["seed"] = seed
+        if should_stop is not None:
+            # checked by llama after each sampled token
+            kwargs["stopping_criteria"] = StoppingCriteriaList([lambda input_ids, logits: should_stop()])
+        response = self.llm(
+            tokens,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            top_p=top_p,
+            stop=stop,
+            echo=False,
+            stream=stream,
+            **kwargs
+        )
+        if not stream:
+            return response['choices'][0]['text']
+        return self._deltas(response)
+
+    @staticmethod
+    def _deltas(chunks):
+        for chunk in chunks:
+            if 'choices' in chunk and len(chunk['choices']) > 0:
+                delta = chunk['choices'][0].get('text', '')
+                if delta:
+                    yield delta
+
+    def save_state(self):
+        # only the last logits row is kept since the next call always
+        # re-evaluates at least one prompt token
+        state = self.llm.save_state()
+        scores = getattr(state, 'scores', None)
+        if scores is not None and getattr(scores, 'ndim', 0) == 2 and len(scores) > 1:
+            state.scores = scores[-1:].copy()
+        return state
+
+    def load_state(self, state):
+        import numpy as np
+        scores = getattr(state, 'scores', None)
+        if scores is not None and getattr(scores, 'ndim', 0) == 2 and len(scores) < state.n_tokens:
+            state.scores = np.broadcast_to(scores[-1:], (state.n_tokens, scores.shape[1])).copy()
+        self.llm.load_state(state)
+
+    def embed(self, text):
+        # same GGUF file in embedding mode (a second small context; the
+        # weights are mmapped once and shared)
+        if self._embedder is None:
+            self._embedder = Llama(
+                model_path=self.config.get('model_path'),
+                embedding=True,
+                n_ctx=self.config.get('embedding_n_ctx', 512),
+                n_threads=self.config.get('n_threads', 4),
+                n_batch=self.config.get('embedding_n_ctx', 512),
+                verbose=False
+            )
+        tokens = self._embedder.tokenize(text.encode("utf-8"))
+        limit = self._embedder.n_ctx()
+        if len(tokens) > limit:
+            text = self._embedder.detokenize(tokens[:limit]).decode("utf-8", errors="ignore")
+        return self._embedder.embed(text)
+
+    def get_speculative_stats(self):
+        return self.draft_model.get_stats() if self.draft_model is not None else None
+
+    def after_fork(self, n_threads=None):
+        # the parent's context must not be shared between workers: each one
+        # gets its own context (kv cache, batch)
+        # with mmap the worker loads the GGUF again through the public API:
+        # the weights are the same file pages as the parent's (page cache);
+        # the parent's objects are kept so their memory is never touched
+        self._embedder = None
+        if self.config.get('use_mmap', True):
+            self._parent = (self.llm, self.draft_model)
+            conf = dict(self.config, n_threads=n_threads) if n_threads else self.config
+            self._load(conf)
+            return
+        # without mmap the weights are shared only copy-on-write, in the
+        # parent's model object: build a new context on it
+        _new_context(self.llm, n_threads)
+        if self.draft_model is not None:
+            _new_context(self.draft_model.llm, n_threads)
+
+    def close(self):
+        # free weights and contexts now instead of at garbage collection
+        models = [self.llm, self._embedder, self.draft_model.llm if self.draft_model is not None else None]
+        for llm in models:
+            if llm is not None and hasattr(llm, 'close'):
+                llm.close()
+        self._embedder = None
+
+
+def _new_context(llm, n_threads=None):
+    # replace llm's context, keeping its model (weights)
+    # llama_cpp._internals is private API (checked with llama-cpp-python
+    # 0.2.90 - 0.3.x, see requirements.txt)
+    try:
+        from llama_cpp import _internals
+        params = llm.context_params
+        if n_threads:
+            params.n_threads = n_threads
+            params.n_threads_batch = n_threads
+            llm.n_threads = llm.n_threads_batch = n_threads
+        # the parent's context is left alone: its pages stay shared and untouched
+        ctx = _internals.LlamaContext(model=llm._model, params=params, verbose=False)
+        batch = _internals.LlamaBatch(n_tokens=llm.n_batch, embd=0, n_seq_max=params.n_ctx, verbose=False)
+    except (ImportError, AttributeError, TypeError) as e:
+        import llama_cpp
+        raise RuntimeError(
+            f"llama-cpp-python {getattr(llama_cpp, '__version__', '?')} không tạo được context mới "
+            f"cho worker ({e}); dùng USE_MMAP = True hoặc llama-cpp-python 0.2.90 - 0.3.x") from e
+    llm._ctx = ctx
+    llm._batch = batch
+    llm.n_tokens = 0
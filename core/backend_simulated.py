@@ -0,0 +1,130 @@
+# simulated backend for load tests and CI (no model file, no llama_cpp)
+# behaves like a model from the outside: real tokenization work, kv prefix
+# reuse, state snapshots and embeddings; prompt evaluation and every
+# generated token cost a configurable sleep (the GIL is released like in
+# llama.cpp) and the answer is a deterministic function of prompt and seed
+import re
+import time
+import zlib
+import random
+
+from core.backend import InferenceBackend
+
+BOS, EOS = 1, 2
+PIECE_CHARS = 4  # a word is split into pieces of at most this many characters
+EMBEDDING_DIM = 256
+
+_PIECE = re.compile(r" ?[^\W\d_]+| ?\d| ?[^\s\w]+|\s+")
+
+# words the simulated answers are made of
+ANSWER_WORDS = (
+    "Python list tuple dict hàm biến vòng lặp để có thể dùng trả về giá trị "
+    "chuỗi số nguyên kiểu dữ liệu ví dụ như sau bạn cần import module file "
+    "đọc ghi lỗi ngoại lệ class đối tượng phương thức thuộc tính sắp xếp "
+    "đảo ngược phần tử chỉ số slicing append extend sorted reversed len range "
+    "print return def for while if else try except with open"
+).split()
+
+
+class SimState:
+    # snapshot of the simulated context
+    def __init__(self, tokens):
+        self.tokens = tuple(tokens)
+        self.n_tokens = len(self.tokens)
+
+
+class SimulatedBackend(InferenceBackend):
+
+    def __init__(self, conf):
+        self.prompt_ms = conf.get('sim_prompt_ms', 0.5)   # per evaluated prompt token
+        self.token_ms = conf.get('sim_token_ms', 20.0)    # per generated token
+        self.answer_tokens = conf.get('sim_answer_tokens', 64)
+        self.n_vocab = conf.get('sim_n_vocab', 32000)
+        self._n_ctx = conf.get('n_ctx', 2048)
+        self.model_id = f"simulated:{self.n_vocab}:{self.answer_tokens}"
+        self._tokens = []   # evaluated context
+
+    def _token_id(self, piece):
+        return zlib.crc32(piece.encode("utf-8")) % (self.n_vocab - 3) + 3
+
+    def _split(self, text):
+        # word-level pre-split, then pieces of PIECE_CHARS characters
+        pieces = []
+        for match in _PIECE.finditer(text):
+            word = match.group()
+            pieces.extend(word[i:i + PIECE_CHARS] for i in range(0, len(word), PIECE_CHARS))
+        return pieces
+
+    def tokenize(self, text, add_bos=True):
+        ids = [self._token_id(piece) for piece in self._split(text)]
+        return [BOS] + ids if add_bos else ids
+
+    def token_bos(self):
+        return BOS
+
+    def n_ctx(self):
+        return self._n_ctx
+
+    def cached_tokens(self):
+        return self._tokens
+
+    def reset(self):
+        self._tokens = []
+
+    def _evaluate(self, tokens):
+        # reuse the shared prefix, pay for the rest (last token always re-evaluated)
+        limit = min(len(self._tokens), len(tokens) - 1)
+        reused = 0
+        while reused < limit and self._tokens[reused] == tokens[reused]:
+            reused += 1
+        if len(tokens) > self._n_ctx:
+            raise ValueError(f"Prompt quá dài: {len(tokens)} tokens (n_ctx={self._n_ctx})")
+        time.sleep((len(tokens) - reused) * self.prompt_ms / 1000)
+        self._tokens = list(tokens)
+
+    def _answer(self, tokens, max_tokens, seed):
+        # deterministic answer pieces for this prompt (and seed)
+        digest = zlib.crc32(" ".join(map(str, tokens)).encode("ascii"))
+        rng = random.Random(digest * 1000003 + (seed or 0))
+        length = min(max_tokens, max(1, int(self.answer_tokens * rng.uniform(0.5, 1.5))))
+        pieces = []
+        while len(pieces) < length:
+            word = rng.choice(ANSWER_WORDS)
+            pieces.extend(self._split(" " + word + ("." if rng.random() < 0.1 else "")))
+        return pieces[:length]
+
+    def complete(self, tokens, max_tokens, temperature, top_p, stop, stream=False,
+                 seed=None, should_stop=None):
+        tokens = list(tokens)
+        self._evaluate(tokens)
+        pieces = self._generate(tokens, max_tokens, seed, stop, should_stop)
+        if stream:
+            return pieces
+        return "".join(pieces)
+
+    def _generate(self, tokens, max_tokens, seed, stop, should_stop):
+        max_tokens = min(max_tokens, self._n_ctx - len(tokens))
+        text = ""
+        for piece in self._answer(tokens, max_tokens, seed):
+            time.sleep(self.token_ms / 1000)
+            self._tokens.append(self._token_id(piece))
+            text += piece
+            if stop and any(s in text for s in stop):
+                return
+            yield piece
+            if should_stop is not None and should_stop():
+                return
+
+    def save_state(self):
+        return SimState(self._tokens)
+
+    def load_state(self, state):
+        self._tokens = list(state.tokens)
+
+    def embed(self, text):
+        # hashed bag of words: texts sharing words get similar vectors
+        vector = [0.0] * EMBEDDING_DIM
+        for word in re.findall(r"\w+", text.lower()):
+            h = zlib.crc32(word.encode("utf-8"))
+            vector[h % EMBEDDING_DIM] += 1.0 if h & 0x80000000 else -1.0
+        return vector
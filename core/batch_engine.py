@@ -0,0 +1,335 @@
+# batched decode engine
+# runs several chat sequences in one llama context (one seq id each),
+# decoding them together step by step (continuous batching)
+import queue
+import logging
+import threading
+from collections import deque
+
+import numpy as np
+import llama_cpp
+
+from core.model_llama_cpp import STOP_SEQUENCES
+from core.cancellation import finish_text
+
+
+def sample_token(logits, temperature, top_p, rng):
+    # temperature + top-p sampling on a logits vector
+    if temperature <= 0:
+        return int(np.argmax(logits))
+    scaled = logits.astype(np.float64) / temperature
+    scaled -= scaled.max()
+    probs = np.exp(scaled)
+    probs /= probs.sum()
+    if top_p < 1.0:
+        order = np.argsort(-probs)
+        cumulative = np.cumsum(probs[order])
+        keep = order[:int(np.searchsorted(cumulative, top_p)) + 1]
+        kept = probs[keep] / probs[keep].sum()
+        return int(rng.choice(keep, p=kept))
+    return int(rng.choice(len(probs), p=probs))
+
+
+class BatchRequest:
+    # one caller's generation inside the engine
+    # iterate for text deltas, or call result() for the final text
+
+    def __init__(self, tokens, max_tokens, temperature, top_p, cancel_token=None):
+        self.tokens = tokens
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.cancel_token = cancel_token  # CancelToken: deadline / token budget / cancel()
+        self.text = ""
+        self.error = None
+        self.cancelled = False
+        self._deltas = queue.Queue()
+        self._done = threading.Event()
+
+    def _push(self, delta):
+        self.text += delta
+        self._deltas.put(delta)
+
+    def _finish(self, error=None):
+        self.error = error
+        self._done.set()
+        self._deltas.put(None)
+
+    def cancel(self):
+        # stop generating, the engine retires the sequence on its next step
+        self.cancelled = True
+
+    def abandoned(self):
+        # nobody wants more output (iterator closed or token tripped)
+        return self.cancelled or (self.cancel_token is not None and self.cancel_token.cancelled)
+
+    def __iter__(self):
+        try:
+            while True:
+                delta = self._deltas.get()
+                if delta is None:
+                    break
+                yield delta
+            if self.error:
+                raise RuntimeError(f"Lỗi khi sinh text: {self.error}")
+        finally:
+            if not self._done.is_set():
+                self.cancel()
+
+    def result(self, timeout=None):
+        self._done.wait(timeout)
+        if self.error:
+            raise RuntimeError(f"Lỗi khi sinh text: {self.error}")
+        return finish_text(self.text.strip(), self.cancel_token)
+
+
+class _Sequence:
+    # decode state of one active request
+    def __init__(self, request, seq_id):
+        self.request = request
+        self.seq_id = seq_id
+        self.n_past = 0
+        self.n_generated = 0
+        self.next_token = None
+        self.pending_bytes = b""
+        self.text = ""
+        self.emitted = 0
+
+
+class BatchDecodeEngine:
+    # continuous batching over one llama context shared by n_seq sequences
+    # uses the weights already loaded by model_wrapper, with its own context
+
+    def __init__(self, model_wrapper, n_seq=4):
+        self.model_wrapper = model_wrapper
+        self.config = model_wrapper.config  # shared, so update_config applies to both
+        self.n_seq = max(1, int(n_seq))
+        self.n_ctx_seq = self.config.get('n_ctx', 2048)
+        self.n_batch = max(self.config.get('n_batch', 16), self.n_seq)
+        self.stats = {"requests": 0, "steps": 0, "tokens": 0, "max_active": 0}
+
+        llm = getattr(model_wrapper.backend, 'llm', None)
+        if llm is None:
+            raise ValueError("BATCH_DECODE cần BACKEND = llama_cpp")
+        self._llm = llm
+        self._n_vocab = llm.n_vocab()
+        self._eos = llm.token_eos()
+        self._rng = np.random.default_rng()
+
+        # each sequence gets a full n_ctx window inside the shared context
+        params = llama_cpp.llama_context_default_params()
+        params.n_ctx = self.n_ctx_seq * self.n_seq
+        params.n_batch = self.n_batch
+        params.n_threads = self.config.get('n_threads', 4)
+        params.n_threads_batch = self.config.get('n_threads', 4)
+        if hasattr(params, 'n_seq_max'):
+            params.n_seq_max = self.n_seq
+        model_ptr = getattr(getattr(llm, '_model', None), 'model', None) or llm.model
+        self._ctx = llama_cpp.llama_new_context_with_model(model_ptr, params)
+        if not self._ctx:
+            raise RuntimeError("Không tạo được llama context cho batch engine")
+        self._batch = llama_cpp.llama_batch_init(self.n_batch, 0, 1)
+
+        self._pending = deque()
+        self._active = {}  # seq_id -> _Sequence
+        self._free_ids = list(range(self.n_seq))
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._loop, name="batch-decode", daemon=True)
+        self._thread.start()
+
+    # --- ModelWrapper compatible API ---
+    def generate(self, prompt, max_tokens=None, temperature=None, top_p=None, stream=None, question=None,
+                 cancel=None):
+        # question is accepted for compatibility, answer caches are not used here
+        max_tokens = max_tokens or self.config.get('max_tokens', 512)
+        temperature = temperature if temperature is not None else self.config.get('temperature', 0.8)
+        top_p = top_p if top_p is not None else self.config.get('top_p', 0.95)
+        stream = stream if stream is not None else self.config.get('stream', False)
+
+        request = self.submit(prompt, max_tokens, temperature, top_p, cancel=cancel)
+        if stream:
+            return iter(request)
+        return request.result()
+
+    def submit(self, prompt, max_tokens, temperature, top_p, cancel=None):
+        # queue a prompt, it joins the running batch at the next step
+        tokens = self._llm.tokenize(prompt.encode("utf-8"))
+        if len(tokens) >= self.n_ctx_seq:
+            raise ValueError(f"Prompt quá dài: {len(tokens)} tokens (n_ctx={self.n_ctx_seq})")
+        max_tokens = min(max_tokens, self.n_ctx_seq - len(tokens))
+        request = BatchRequest(tokens, max_tokens, temperature, top_p, cancel_token=cancel)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Batch engine đã dừng")
+            self._pending.append(request)
+            self.stats["requests"] += 1
+            self._cond.notify()
+        return request
+
+    def tokenize(self, text):
+        return self.model_wrapper.tokenize(text)
+    
+    def switch_conversation(self, conv_id):
+        # sequences always start from an empty kv range, nothing to restore
+        return False
+
+    def forget_conversation(self, conv_id):
+        pass
+
+    def get_config(self):
+        return self.config.copy()
+
+    def update_config(self, new_config):
+        self.config.update(new_config)
+
+    def is_ready(self):
+        return self._ctx is not None and not self._closed
+
+    def get_stats(self):
+        with self._cond:
+            return dict(self.stats, active=len(self._active), pending=len(self._pending))
+
+    def shutdown(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        llama_cpp.llama_batch_free(self._batch)
+        llama_cpp.llama_free(self._ctx)
+        self._ctx = None
+
+    # --- decode loop ---
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._closed and not self._pending and not self._active:
+                    self._cond.wait()
+                if self._closed:
+                    break
+                admitted = []
+                while self._pending and self._free_ids:
+                    request = self._pending.popleft()
+                    if request.abandoned():
+                        request._finish()  # bỏ qua, không tốn prefill
+                        continue
+                    admitted.append(_Sequence(request, self._free_ids.pop(0)))
+
+            try:
+                for seq in admitted:
+                    self._prefill(seq)
+                    self._active[seq.seq_id] = seq
+                    self._process_token(seq)
+                self.stats["max_active"] = max(self.stats["max_active"], len(self._active))
+                if self._active:
+                    self._step()
+            except Exception as e:
+                logging.error(f"Lỗi batch decode: {e}")
+                for seq in admitted:
+                    if seq.seq_id not in self._active:
+                        self._active[seq.seq_id] = seq
+                for seq in list(self._active.values()):
+                    self._retire(seq, error=str(e))
+
+        for seq in list(self._active.values()):
+            self._retire(seq, error="Batch engine đã dừng")
+        with self._cond:
+            while self._pending:
+                self._pending.popleft()._finish("Batch engine đã dừng")
+
+    def _fill_batch(self, items):
+        # items: (token, pos, seq_id, want_logits)
+        self._batch.n_tokens = len(items)
+        for i, (token, pos, seq_id, want_logits) in enumerate(items):
+            self._batch.token[i] = token
+            self._batch.pos[i] = pos
+            self._batch.n_seq_id[i] = 1
+            self._batch.seq_id[i][0] = seq_id
+            self._batch.logits[i] = want_logits
+
+    def _decode(self):
+        ret = llama_cpp.llama_decode(self._ctx, self._batch)
+        if ret != 0:
+            raise RuntimeError(f"llama_decode trả về {ret}")
+
+    def _logits(self, index):
+        ptr = llama_cpp.llama_get_logits_ith(self._ctx, index)
+        return np.ctypeslib.as_array(ptr, shape=(self._n_vocab,)).copy()
+
+    def _prefill(self, seq):
+        # evaluate the prompt in n_batch chunks, logits only for the last token
+        tokens = seq.request.tokens
+        for start in range(0, len(tokens), self.n_batch):
+            chunk = tokens[start:start + self.n_batch]
+            last = start + len(chunk) == len(tokens)
+            self._fill_batch([(tok, start + i, seq.seq_id, last and i == len(chunk) - 1)
+                              for i, tok in enumerate(chunk)])
+            self._decode()
+        seq.n_past = len(tokens)
+        req = seq.request
+        seq.next_token = sample_token(self._logits(self._batch.n_tokens - 1), req.temperature, req.top_p, self._rng)
+
+    def _step(self):
+        # one token for every active sequence in a single decode call
+        running = list(self._active.values())
+        self._fill_batch([(seq.next_token, seq.n_past, seq.seq_id, True) for seq in running])
+        self._decode()
+        self.stats["steps"] += 1
+        for i, seq in enumerate(running):
+            seq.n_past += 1
+            req = seq.request
+            seq.next_token = sample_token(self._logits(i), req.temperature, req.top_p, self._rng)
+            self._process_token(seq)
+
+    def _process_token(self, seq):
+        # append the sampled token, emit safe text, retire finished sequences
+        req = seq.request
+        token = seq.next_token
+        stopped = req.cancel_token is not None and req.cancel_token.step()
+        if req.cancelled or stopped or token == self._eos:
+            if not req.cancelled:
+                self._emit(seq, len(seq.text))
+            self._retire(seq)
+            return
+
+        seq.n_generated += 1
+        self.stats["tokens"] += 1
+        seq.pending_bytes += self._llm.detokenize([token])
+        try:
+            seq.text += seq.pending_bytes.decode("utf-8")
+            seq.pending_bytes = b""
+        except UnicodeDecodeError:
+            pass  # incomplete multi-byte character, wait for next token
+
+        stop_at = min((pos for pos in (seq.text.find(s) for s in STOP_SEQUENCES) if pos >= 0), default=-1)
+        if stop_at >= 0:
+            seq.text = seq.text[:stop_at]
+            self._emit(seq, len(seq.text))
+            self._retire(seq)
+            return
+
+        # hold back a tail that could still become a stop sequence
+        hold = 0
+        for stop in STOP_SEQUENCES:
+            for k in range(min(len(stop) - 1, len(seq.text)), 0, -1):
+                if seq.text.endswith(stop[:k]):
+                    hold = max(hold, k)
+                    break
+        self._emit(seq, len(seq.text) - hold)
+
+        if seq.n_generated >= req.max_tokens or seq.n_past + 1 >= self.n_ctx_seq:
+            self._emit(seq, len(seq.text))
+            self._retire(seq)
+
+    def _emit(self, seq, upto):
+        if upto > seq.emitted:
+            seq.request._push(seq.text[seq.emitted:upto])
+            seq.emitted = upto
+
+    def _retire(self, seq, error=None):
+        # free the sequence's kv cells and its seq id
+        llama_cpp.llama_kv_cache_seq_rm(self._ctx, seq.seq_id, -1, -1)
+        self._active.pop(seq.seq_id, None)
+        with self._cond:
+            self._free_ids.append(seq.seq_id)
+        seq.request._finish(error)
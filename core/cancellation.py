@@ -0,0 +1,94 @@
+# cooperative cancellation for generations
+# a CancelToken is checked by the model after every generated token; it
+# trips when cancel() is called, when its wall-clock deadline passes or when
+# its token budget is used up, and the generation returns what it has so far
+import time
+import signal
+import threading
+from contextlib import contextmanager
+
+CANCELLED = "cancelled"
+DEADLINE = "deadline"
+TOKEN_LIMIT = "token_limit"
+
+# ghi chú hiển thị sau câu trả lời bị dừng sớm
+PARTIAL_NOTES = {CANCELLED: "⏹ (đã dừng)", DEADLINE: "⏱ (hết thời gian)", TOKEN_LIMIT: "(đạt giới hạn token)"}
+
+
+class CancelToken:
+    # timeout: seconds from creation (None = no deadline)
+    # max_tokens: tokens the generation may produce (None = only MAX_TOKENS)
+
+    def __init__(self, timeout=None, max_tokens=None):
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self.max_tokens = max_tokens
+        self.tokens = 0
+        self.reason = None  # why it tripped, None while running
+        self._event = threading.Event()
+
+    def cancel(self, reason=CANCELLED):
+        # first reason wins
+        if self.reason is None:
+            self.reason = reason
+            self._event.set()
+
+    @property
+    def cancelled(self):
+        if self.reason is None and self.deadline is not None and time.monotonic() >= self.deadline:
+            self.cancel(DEADLINE)
+        return self.reason is not None
+
+    def step(self):
+        # one more token generated; True when the generation must stop
+        self.tokens += 1
+        if self.max_tokens is not None and self.tokens >= self.max_tokens:
+            self.cancel(TOKEN_LIMIT)
+        return self.cancelled
+
+    def remaining(self):
+        # seconds left before the deadline (None = no deadline)
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def wait(self, timeout=None):
+        # block until cancel() is called (deadlines are only seen by polling)
+        return self._event.wait(timeout)
+
+
+class PartialResponse(str):
+    # text of a generation that stopped early, reason is the token's reason
+    partial = True
+
+    def __new__(cls, text, reason):
+        obj = super().__new__(cls, text)
+        obj.reason = reason
+        return obj
+
+
+def finish_text(text, cancel):
+    # text as is, or flagged partial when the token tripped
+    if cancel is not None and cancel.reason is not None:
+        return PartialResponse(text, cancel.reason)
+    return text
+
+
+def display_text(response):
+    # response with a note when it was cut short
+    if getattr(response, 'partial', False):
+        return f"{response} {PARTIAL_NOTES.get(response.reason, '')}".strip()
+    return response
+
+
+@contextmanager
+def cancel_on_sigint(cancel):
+    # Ctrl+C cancels the token instead of raising KeyboardInterrupt
+    # (main thread only, elsewhere it is a no-op)
+    if threading.current_thread() is not threading.main_thread():
+        yield cancel
+        return
+    previous = signal.signal(signal.SIGINT, lambda signum, frame: cancel.cancel())
+    try:
+        yield cancel
+    finally:
+        signal.signal(signal.SIGINT, previous)
@@ -1,48 +1,203 @@
 # conversation manager
 # keeps track of chat history
+from bisect import bisect_left
 from collections import deque
 from typing import List, Dict, Any
 
 
+TRUNCATION_MARK = " [...] "
+
+
+def estimate_tokens(text):
+    # rough count when no tokenizer is loaded
+    return len(text) // 4 + 1
+
+
+class PromptBuffer:
+    # append-only rendered text and token counts of the history
+    # (each message is tokenized once, packing the budget never re-tokenizes)
+    # evicting the oldest message only moves a start offset, the dead
+    # prefix is compacted once it is larger than the live part
+    
+    def __init__(self, tokenizer=None):
+        self.tokenizer = tokenizer
+        self._segments = []          # rendered "### Role: content\n"
+        self._token_ends = []        # absolute token count at the end of each segment
+        self._token_offset = 0       # tokens dropped by compaction
+        self._start = 0              # first live segment
+    
+    def __len__(self):
+        return len(self._segments) - self._start
+    
+    def _tokens_before(self, index):
+        return self._token_ends[index - 1] if index > 0 else self._token_offset
+    
+    def _total(self):
+        return self._token_ends[-1] if self._token_ends else self._token_offset
+    
+    def append(self, text):
+        # add one rendered message, O(len(text))
+        segment = text + "\n"
+        if self.tokenizer is not None:
+            count = len(self.tokenizer(segment))
+        else:
+            count = estimate_tokens(segment)
+        self._segments.append(segment)
+        self._token_ends.append(self._total() + count)
+    
+    def evict(self, count=1):
+        # drop the oldest messages
+        self._start = min(self._start + count, len(self._segments))
+        if self._start > 32 and self._start * 2 > len(self._segments):
+            self._compact()
+    
+    def _compact(self):
+        self._token_offset = self._tokens_before(self._start)
+        del self._segments[:self._start]
+        del self._token_ends[:self._start]
+        self._start = 0
+    
+    def clear(self):
+        self.__init__(self.tokenizer)
+    
+    def token_count(self, last=None):
+        # tokens of the newest `last` messages (all live messages by default)
+        if last is None:
+            last = len(self)
+        return self._total() - self._tokens_before(len(self._segments) - last)
+    
+    def tail_fitting(self, budget):
+        # how many of the newest messages fit in budget tokens, O(log n)
+        total = self._total()
+        threshold = total - budget
+        if self._tokens_before(self._start) >= threshold:
+            return len(self)
+        index = bisect_left(self._token_ends, threshold, self._start) + 1
+        return max(0, len(self._segments) - index)
+    
+    def text_tail(self, last):
+        if last <= 0:
+            return ""
+        return "".join(self._segments[len(self._segments) - last:])
+    
+    def nbytes(self):
+        # approximate memory held by the live buffer
+        return sum(len(segment) for segment in self._segments[self._start:])
+
+
 class ConversationManager:
     # manages conversation history
     
-    def __init__(self, config):
+    def __init__(self, config, tokenizer=None):
+        # tokenizer: callable text -> token ids (the loaded model's tokenizer)
+        # without it token counts are estimated from text length
         self.config = config
+        self.tokenizer = tokenizer
         self.history = deque(maxlen=config.get('history_max_turns', 6) * 2)
-        
+        self.buffer = PromptBuffer(tokenizer)
+    
+    def set_tokenizer(self, tokenizer):
+        # token counts of another tokenizer are no longer valid
+        self.tokenizer = tokenizer
+        self.buffer = PromptBuffer(tokenizer)
+        for message in self.history:
+            self.buffer.append(self._render(message))
+    
+    def count_tokens(self, text):
+        if self.tokenizer is None:
+            return estimate_tokens(text)
+        return len(self.tokenizer(text))
+    
+    def _append(self, message):
+        # keep history and buffer in lockstep (deque drops the oldest itself)
+        if len(self.history) == self.history.maxlen:
+            self.buffer.evict()
+        self.history.append(message)
+        self.buffer.append(self._render(message))
+    
     def add_user_message(self, message):
         # add user message to history
         if message.strip():
-            self.history.append({"role": "user", "content": message.strip()})
+            self._append({"role": "user", "content": message.strip()})
     
     def add_assistant_message(self, message):
         # add ai response to history
         if message.strip():
-            self.history.append({"role": "assistant", "content": message.strip()})
+            self._append({"role": "assistant", "content": message.strip()})
     
-    def build_prompt(self, user_input):
-        # build prompt for the model
-        prompt_parts = []
+    @staticmethod
+    def _render(message):
+        if message["role"] == "user":
+            return f"### Human: {message['content']}"
+        return f"### Assistant: {message['content']}"
+    
+    def prompt_budget(self, max_tokens=None):
+        # tokens available for the prompt: n_ctx - max_tokens - reserve
+        max_tokens = max_tokens or self.config.get('max_tokens', 512)
+        reserve = self.config.get('prompt_reserve_tokens', 64)
+        return self.config.get('n_ctx', 2048) - max_tokens - reserve
+    
+    def truncate_text(self, text, max_tokens):
+        # cut the middle of an oversized text, keeping its head and tail
+        n_tokens = self.count_tokens(text)
+        if n_tokens <= max_tokens:
+            return text
+        if max_tokens <= 0:
+            return ""
+        chars_per_token = len(text) / n_tokens
+        keep = int(max_tokens * chars_per_token)
+        while keep > 0:
+            half = keep // 2
+            truncated = text[:half] + TRUNCATION_MARK + text[len(text) - half:]
+            if self.count_tokens(truncated) <= max_tokens:
+                return truncated
+            keep = int(keep * 0.9)
+        return ""
+    
+    def _pack(self, user_input, max_tokens):
+        # choose history tail and (maybe truncated) user input for the budget
+        # returns (n newest messages, truncated newest message or None, user input)
+        budget = self.prompt_budget(max_tokens)
         
-        # Thêm lịch sử hội thoại (không bao gồm tin nhắn hiện tại)
-        for message in self.history:
-            role = message["role"]
-            content = message["content"]
-            if role == "user":
-                prompt_parts.append(f"### Human: {content}")
-            else:
-                prompt_parts.append(f"### Assistant: {content}")
+        # Câu hỏi mới luôn được giữ, cắt bớt nếu quá dài
+        tail_tokens = self.count_tokens("### Human: \n### Assistant:")
+        user_input = self.truncate_text(user_input, budget - tail_tokens)
+        remaining = budget - tail_tokens - self.count_tokens(user_input)
         
-        # Thêm câu hỏi mới
-        prompt_parts.append(f"### Human: {user_input}")
-        prompt_parts.append("### Assistant:")
+        # Lấy lịch sử từ mới đến cũ cho đến khi hết ngân sách token
+        last = self.buffer.tail_fitting(remaining)
+        oversized = None
+        if last == 0 and self.history and remaining > 32:
+            # tin nhắn gần nhất quá dài: giữ phần đầu và cuối
+            message = self.history[-1]
+            prefix = "### Human: " if message["role"] == "user" else "### Assistant: "
+            content = self.truncate_text(message["content"], remaining - self.count_tokens(prefix) - 1)
+            if content:
+                oversized = prefix + content + "\n"
+        return last, oversized, user_input
+    
+    def build_prompt(self, user_input, max_tokens=None):
+        # build prompt for the model
+        # packs as many recent messages as fit in the token budget
+        last, oversized, user_input = self._pack(user_input, max_tokens)
+        history_text = oversized or self.buffer.text_tail(last)
         
-        return "\n".join(prompt_parts)
+        # Thêm câu hỏi mới
+        return f"{history_text}### Human: {user_input}\n### Assistant:"
+    
+    def standalone_question(self, user_input):
+        # user input when the prompt carries no history (answer depends on it
+        # alone, so the semantic cache may answer it), else None
+        return None if self.history else user_input.strip()
     
     def clear_history(self):
         # clear all chat history
         self.history.clear()
+        self.buffer.clear()
+    
+    def memory_usage(self):
+        # approximate bytes held by this conversation (history + buffer)
+        return sum(len(m["content"]) for m in self.history) + self.buffer.nbytes()
     
     def get_history_count(self):
         # get number of messages in history
@@ -54,12 +209,10 @@ class ConversationManager:
     
     def trim_history(self, keep_turns=3):
         # remove old messages to save memory
-        if len(self.history) <= keep_turns * 2:
+        drop = len(self.history) - keep_turns * 2
+        if drop <= 0:
             return
         
-        history_list = list(self.history)
-        trimmed_history = history_list[-(keep_turns * 2):]
-        
-        self.history.clear()
-        for message in trimmed_history:
-            self.history.append(message)
+        for _ in range(drop):
+            self.history.popleft()
+        self.buffer.evict(drop)
@@ -1,33 +1,120 @@
 import os
-from pymongo import MongoClient
+import time
+import atexit
+from pymongo import MongoClient, UpdateOne, ReturnDocument, ASCENDING, DESCENDING, TEXT
+from pymongo.errors import BulkWriteError
+from bson import ObjectId
 from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
 
+from core.storage import ChatStorage, TITLE_LENGTH, PAGE_SIZE, SNIPPET_OPEN, make_snippet
+from core.write_behind import WriteBehindQueue
+
 # Cấu hình MongoDB
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017/") 
 DB_NAME = "chat_ai_database"
 COLLECTION_CHAT = "chat_history"
 COLLECTION_USERS = "users" 
+COLLECTION_CONVERSATIONS = "conversations"  # bảng tóm tắt mỗi cuộc trò chuyện (sidebar)
+COLLECTION_SYNC = "sync_state"  # phiên bản danh sách cuộc trò chuyện của mỗi user (đồng bộ delta)
+MESSAGE_FIELDS = {"timestamp": 1, "user_message": 1, "assistant_response": 1}
+
+# Ghi tin nhắn theo lô ở luồng nền (write-behind)
+WRITE_BATCH_SIZE = 50          # số tin nhắn mỗi lần insert_many
+WRITE_FLUSH_INTERVAL = 1.0     # giây, ghi lô chưa đầy sau khoảng này
+WRITE_MAX_PENDING = 10000      # quá số này thì ghi thẳng ra file tạm
+WRITE_SPILL_FILE = "cache/pending_writes.jsonl"  # tin nhắn chờ khi mất kết nối DB
+RECONNECT_INTERVAL = 30        # giây giữa các lần thử kết nối lại
+VERSION_LEASE = 60             # giây, phiên bản đang ghi dở quá thời gian này coi như bỏ
 
-class MongoDBManager:
-    def __init__(self):
+class MongoDBManager(ChatStorage):
+    def __init__(self, spill_path=None):
+        # spill_path: file for messages the database could not take (default WRITE_SPILL_FILE)
         self.client = None
         self.db = None
         self.chat_col = None
         self.user_col = None
+        self.conv_col = None
+        self.sync_col = None
+        self._last_connect = 0
         self._connect()
         
+        # save_message chỉ xếp hàng, luồng nền ghi theo lô
+        self.writer = WriteBehindQueue(
+            self._write_batch,
+            batch_size=WRITE_BATCH_SIZE,
+            flush_interval=WRITE_FLUSH_INTERVAL,
+            max_pending=WRITE_MAX_PENDING,
+            spill_path=spill_path or WRITE_SPILL_FILE,
+            encode_doc=lambda doc: dict(doc, _id=str(doc["_id"])),
+            decode_doc=lambda doc: dict(doc, _id=ObjectId(doc["_id"]))
+        )
+        atexit.register(self.close)
+        
     def _connect(self):
+        self._last_connect = time.time()
         try:
             self.client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000)
             self.client.admin.command('ping') 
             self.db = self.client[DB_NAME]
             self.chat_col = self.db[COLLECTION_CHAT]
             self.user_col = self.db[COLLECTION_USERS]
+            self.conv_col = self.db[COLLECTION_CONVERSATIONS]
+            self.sync_col = self.db[COLLECTION_SYNC]
             print(f"[{datetime.now()}] Đã kết nối MongoDB thành công!")
         except Exception as e:
             print(f"Lỗi kết nối MongoDB: {e}")
             self.client = None
+            return
+        
+        try:
+            self._ensure_indexes()
+        except Exception as e:
+            print(f"Lỗi tạo index MongoDB: {e}")
+
+    def _ensure_indexes(self):
+        """Tạo index cần thiết (idempotent) và dựng bảng tóm tắt nếu còn trống"""
+        self.chat_col.create_index([("owner", ASCENDING), ("conversation_id", ASCENDING),
+                                    ("timestamp", ASCENDING), ("_id", ASCENDING)])
+        # Chỉ mục toàn văn theo từng user (owner đứng trước: chỉ quét tin nhắn của user đó)
+        # default_language="none": không stemming, dùng được cho tiếng Việt
+        self.chat_col.create_index([("owner", ASCENDING), ("user_message", TEXT), ("assistant_response", TEXT)],
+                                   name="chat_text", default_language="none",
+                                   weights={"user_message": 2, "assistant_response": 1})
+        self.conv_col.create_index([("owner", ASCENDING), ("conversation_id", ASCENDING)], unique=True)
+        self.conv_col.create_index([("owner", ASCENDING), ("last_activity", DESCENDING)])
+        self.conv_col.create_index([("owner", ASCENDING), ("version", ASCENDING)])
+        self.sync_col.create_index("owner", unique=True)
+        self.user_col.create_index("username", unique=True)
+        if self.conv_col.estimated_document_count() == 0 and self.chat_col.estimated_document_count() > 0:
+            self.rebuild_conversation_index()
+
+    def rebuild_conversation_index(self):
+        """Dựng lại bảng tóm tắt từ toàn bộ tin nhắn (chỉ chạy một lần khi nâng cấp)"""
+        pipeline = [
+            {"$sort": {"owner": 1, "conversation_id": 1, "timestamp": 1}},
+            {"$group": {
+                "_id": {"owner": "$owner", "conversation_id": "$conversation_id"},
+                "created_at": {"$min": "$timestamp"},
+                "last_activity": {"$max": "$timestamp"},
+                "message_count": {"$sum": 1},
+                "first_user_message": {"$first": "$user_message"}
+            }}
+        ]
+        ops = []
+        for row in self.chat_col.aggregate(pipeline, allowDiskUse=True):
+            key = {"owner": row["_id"]["owner"], "conversation_id": row["_id"]["conversation_id"]}
+            ops.append(UpdateOne(key, {"$set": {
+                "title": (row["first_user_message"] or "")[:TITLE_LENGTH],
+                "created_at": row["created_at"],
+                "last_activity": row["last_activity"],
+                "message_count": row["message_count"]
+            }}, upsert=True))
+            if len(ops) >= 1000:
+                self.conv_col.bulk_write(ops, ordered=False)
+                ops = []
+        if ops:
+            self.conv_col.bulk_write(ops, ordered=False)
 
     # --- QUẢN LÝ USER ---
     def register_user(self, username, password):
@@ -56,51 +143,203 @@ class MongoDBManager:
 
     # --- QUẢN LÝ CHAT (Đã cập nhật để lọc theo user) ---
     def save_message(self, user_msg, assistant_resp, conv_id, username):
-        """Lưu tin nhắn kèm theo username người sở hữu"""
-        if not self.client: return
+        """Lưu tin nhắn kèm theo username người sở hữu (ghi nền, không chờ DB)"""
+        doc = {
+            "_id": ObjectId(),  # tạo sẵn để ghi lại từ file tạm không bị trùng
+            "timestamp": datetime.now(),
+            "user_message": user_msg,
+            "assistant_response": assistant_resp,
+            "conversation_id": conv_id,
+            "owner": username  # Quan trọng: Đánh dấu tin nhắn của ai
+        }
         try:
-            doc = {
-                "timestamp": datetime.now(),
-                "user_message": user_msg,
-                "assistant_response": assistant_resp,
-                "conversation_id": conv_id,
-                "owner": username  # Quan trọng: Đánh dấu tin nhắn của ai
-            }
-            self.chat_col.insert_one(doc)
+            self.writer.put(doc)
         except Exception as e:
             print(f"Lỗi lưu: {e}")
+        self._invalidate(username, conv_id)
 
-    def get_conversation_list(self, username):
-        """Lấy danh sách chat CỦA RIÊNG user đang đăng nhập"""
+    def _write_batch(self, docs):
+        """Ghi một lô tin nhắn (chạy ở luồng nền), lỗi sẽ được chuyển ra file tạm"""
+        if not self.client:
+            if time.time() - self._last_connect >= RECONNECT_INTERVAL:
+                self._connect()
+            if not self.client:
+                raise ConnectionError("Chưa kết nối MongoDB")
+        # tin nhắn đã insert nhưng lần trước chưa cập nhật được bảng tóm tắt
+        index_only = {id(doc) for doc in docs if doc.pop("_index_pending", False)}
+        try:
+            self.chat_col.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            # Bỏ qua lỗi trùng _id (lô đã được ghi một phần trước đó)
+            errors = e.details.get("writeErrors", [])
+            if any(err.get("code") != 11000 for err in errors) or e.details.get("writeConcernErrors"):
+                raise
+            duplicated = {err["index"] for err in errors}
+            docs = [doc for i, doc in enumerate(docs) if i not in duplicated or id(doc) in index_only]
+        try:
+            self._update_conversation_index(docs)
+        except Exception:
+            # cả lô sẽ nằm trong file tạm: đánh dấu để lần phát lại vẫn tính
+            # các tin nhắn này vào bảng tóm tắt dù insert báo trùng
+            for doc in docs:
+                doc["_index_pending"] = True
+            raise
+
+    def _bump_version(self, username, reset=False, in_flight=False):
+        """Tăng phiên bản của user; reset=True đánh dấu lần xóa toàn bộ
+        in_flight=True: phiên bản được cấp cho lần ghi bảng tóm tắt sắp diễn ra, người
+        đọc chỉ thấy nó sau khi _end_version (xem _read_sync_state)"""
+        update = [{"$set": {"version": {"$add": [{"$ifNull": ["$version", 0]}, 1]}}}]
+        if reset:
+            update.append({"$set": {"reset_version": "$version"}})
+        if in_flight:
+            update.append({"$set": {"in_flight": {"$concatArrays": [
+                {"$ifNull": ["$in_flight", []]}, [{"version": "$version", "at": time.time()}]]}}})
+        state = self.sync_col.find_one_and_update({"owner": username}, update, upsert=True,
+                                                  return_document=ReturnDocument.AFTER)
+        return state["version"]
+
+    def _end_version(self, username, version):
+        try:
+            self.sync_col.update_one({"owner": username}, {"$pull": {"in_flight": {"version": version}}})
+        except Exception as e:
+            # hết hạn sau VERSION_LEASE giây
+            print(f"Lỗi cập nhật phiên bản: {e}")
+
+    def _update_conversation_index(self, docs):
+        """Cập nhật bảng tóm tắt bằng upsert nguyên tử ($setOnInsert/$max/$inc)"""
+        summaries = {}
+        for doc in docs:
+            key = (doc["owner"], doc["conversation_id"])
+            if key not in summaries:
+                summaries[key] = {"first": doc, "last_activity": doc["timestamp"], "count": 0}
+            summary = summaries[key]
+            summary["last_activity"] = max(summary["last_activity"], doc["timestamp"])
+            summary["count"] += 1
+        # một phiên bản mới cho mỗi user có thay đổi trong lô; bảng tóm tắt được
+        # gắn phiên bản sau khi nó đã được cấp, nên người đọc chỉ thấy phiên bản
+        # đã ghi xong (không bỏ sót cuộc trò chuyện chưa kịp gắn phiên bản)
+        versions = {}
+        try:
+            for owner, _ in summaries:
+                if owner not in versions:
+                    versions[owner] = self._bump_version(owner, in_flight=True)
+            self._write_summaries(summaries, versions)
+        finally:
+            for owner, version in versions.items():
+                self._end_version(owner, version)
+        # bảng tóm tắt đã đổi (last_activity, thứ tự sidebar)
+        for owner, conv_id in summaries:
+            self._invalidate(owner, conv_id)
+
+    def _write_summaries(self, summaries, versions):
+        ops = [
+            UpdateOne(
+                {"owner": owner, "conversation_id": conv_id},
+                {
+                    "$setOnInsert": {
+                        "title": (s["first"]["user_message"] or "")[:TITLE_LENGTH],
+                        "created_at": s["first"]["timestamp"]
+                    },
+                    "$max": {"last_activity": s["last_activity"], "version": versions[owner]},
+                    "$inc": {"message_count": s["count"]}
+                },
+                upsert=True
+            )
+            for (owner, conv_id), s in summaries.items()
+        ]
+        if ops:
+            self.conv_col.bulk_write(ops, ordered=False)
+
+    def _read_conversations(self, username, since=None):
+        """Đọc danh sách chat từ bảng tóm tắt"""
         if not self.client: return []
+        query = {"owner": username}
+        if since is not None:
+            query["version"] = {"$gt": since}
         try:
-            pipeline = [
-                {"$match": {"owner": username}}, # Chỉ lấy tin nhắn của user này
-                {"$sort": {"conversation_id": 1, "timestamp": 1}},
-                {"$group": {
-                    "_id": "$conversation_id",
-                    "last_message_time": {"$max": "$timestamp"}, 
-                    "first_user_message": {"$first": "$user_message"}
-                }},
-                {"$sort": {"last_message_time": -1}},
-                {"$project": {
-                    "_id": 0, "id": "$_id",
-                    "title": {"$substrCP": ["$first_user_message", 0, 40]}, 
-                    "last_activity": "$last_message_time"
-                }}
+            cursor = self.conv_col.find(
+                query,
+                {"_id": 0, "conversation_id": 1, "title": 1, "last_activity": 1}
+            ).sort("last_activity", DESCENDING)
+            return [
+                {"id": c["conversation_id"], "title": c.get("title", ""), "last_activity": c["last_activity"]}
+                for c in cursor
             ]
-            return list(self.chat_col.aggregate(pipeline))
         except Exception: return []
 
-    def get_messages_by_conversation_id(self, conv_id, username):
-        """Lấy nội dung chat (bảo mật: phải đúng chủ sở hữu)"""
+    def _read_sync_state(self, username):
+        if not self.client: return 0, 0
+        state = self.sync_col.find_one({"owner": username}) or {}
+        # phiên bản trả về không mới hơn lần ghi bảng tóm tắt cuối đã xong: các
+        # cuộc trò chuyện của phiên bản đang ghi dở sẽ có trong lần delta sau
+        now = time.time()
+        in_flight = [e["version"] for e in state.get("in_flight", []) if now - e["at"] < VERSION_LEASE]
+        version = min(in_flight) - 1 if in_flight else state.get("version", 0)
+        return version, state.get("reset_version", 0)
+
+    def _read_message_count(self, conv_id, username):
+        if not self.client: return 0
+        summary = self.conv_col.find_one({"owner": username, "conversation_id": conv_id}, {"message_count": 1})
+        return summary.get("message_count", 0) if summary else 0
+
+    def _read_messages(self, conv_id, username):
         if not self.client: return []
         return list(self.chat_col.find({
             "conversation_id": conv_id,
             "owner": username
         }).sort("timestamp", 1))
 
+    @staticmethod
+    def _parse_cursor(cursor):
+        timestamp, oid = ChatStorage._parse_cursor(cursor)
+        if not ObjectId.is_valid(oid):
+            raise ValueError(f"Cursor không hợp lệ: {cursor}")
+        return timestamp, ObjectId(oid)
+
+    def _read_page(self, conv_id, username, before, limit):
+        if not self.client: return []
+        query = {"conversation_id": conv_id, "owner": username}
+        if before is not None:
+            ts, oid = before
+            query["$or"] = [{"timestamp": {"$lt": ts}}, {"timestamp": ts, "_id": {"$lt": oid}}]
+        return list(self.chat_col.find(query, MESSAGE_FIELDS)
+                    .sort([("timestamp", DESCENDING), ("_id", DESCENDING)])
+                    .limit(limit))
+
+    def _search(self, username, terms, offset, limit):
+        if not self.client: return []
+        # mỗi từ đặt trong ngoặc kép để $text yêu cầu khớp tất cả các từ
+        phrase = " ".join(f'"{term}"' for term in terms)
+        cursor = self.chat_col.find(
+            {"owner": username, "$text": {"$search": phrase}},
+            {"score": {"$meta": "textScore"}, "conversation_id": 1, "timestamp": 1,
+             "user_message": 1, "assistant_response": 1}
+        ).sort([("score", {"$meta": "textScore"})]).skip(offset).limit(limit)
+        docs = list(cursor)
+        
+        conv_ids = list({d["conversation_id"] for d in docs})
+        titles = {c["conversation_id"]: c.get("title", "") for c in self.conv_col.find(
+            {"owner": username, "conversation_id": {"$in": conv_ids}}, {"conversation_id": 1, "title": 1})}
+        results = []
+        for d in docs:
+            # snippet lấy từ trường có từ khớp (ưu tiên câu hỏi)
+            snippet = make_snippet(d.get("user_message") or "", terms)
+            if SNIPPET_OPEN not in snippet:
+                snippet = make_snippet(d.get("assistant_response") or "", terms)
+            results.append({"id": str(d["_id"]), "conversation_id": d["conversation_id"],
+                            "title": titles.get(d["conversation_id"], ""),
+                            "timestamp": d["timestamp"], "snippet": snippet})
+        return results
+
     def delete_all_conversations(self, username):
         """Xóa lịch sử của riêng user"""
         if self.client:
-            self.chat_col.delete_many({"owner": username})
\ No newline at end of file
+            # không lô nào đang ghi trong lúc xóa; bỏ tin nhắn đang chờ và trong file tạm
+            # của user để chúng không bị ghi lại sau khi xóa
+            with self.writer.exclusive():
+                self.writer.discard(lambda d: d["owner"] == username)
+                self.chat_col.delete_many({"owner": username})
+                self.conv_col.delete_many({"owner": username})
+                self._bump_version(username, reset=True)
+            self._invalidate(username)
\ No newline at end of file
@@ -0,0 +1,277 @@
+# inference daemon: one process owns the model slots and serves the web
+# workers over a local unix socket, so several web processes share one copy
+# of the weights and none of them holds the GIL during generation
+# run with: python -m core.inference_server [socket path]
+#
+# protocol: every message is a frame = 4-byte big-endian length + utf-8 json
+# a connection carries one request at a time:
+#   {"op": "generate", "prompt": str | [token ids], "max_tokens", "temperature",
+#    "top_p", "question", "conv_id", "user", "timeout", "token_budget", "model"}
+#       -> {"delta": str} ... then {"done": true, "reason": null | "deadline" | ...}
+#   {"op": "tokenize", "text"}          -> {"tokens": [...]}
+#   {"op": "forget", "conv_id"}         -> {"ok": true}
+#   {"op": "config"}                    -> {"config": {...}}
+#   {"op": "update_config", "values"}   -> {"ok": true}
+#   {"op": "stats"}                     -> {"stats": {...}}
+#   {"op": "models"}                    -> {"models": [...]} ([] without MODELS)
+#   {"op": "select_model", "model"}     -> {"ok": true}
+#   {"op": "ping"}                      -> {"ok": true}
+# failures answer {"error": msg, "kind": "queue_full" | "per_user" | "error"}
+# closing the connection during a generation cancels it
+import os
+import sys
+import json
+import queue
+import select
+import signal
+import socket
+import struct
+import logging
+import socketserver
+
+from core.cancellation import CancelToken
+from core.scheduler import QueueFullError, PRIORITY_INTERACTIVE
+
+HEADER = struct.Struct(">I")
+MAX_FRAME = 64 * 1024 * 1024
+POLL_INTERVAL = 0.5  # seconds between disconnect checks while a request waits
+
+
+def send_frame(sock, message):
+    data = json.dumps(message, ensure_ascii=False).encode("utf-8")
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+def _recv_exact(sock, size):
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            return None
+        buf.extend(chunk)
+    return bytes(buf)
+
+
+def recv_frame(sock):
+    # next message, None when the peer closed the connection between frames
+    header = _recv_exact(sock, HEADER.size)
+    if header is None:
+        return None
+    (size,) = HEADER.unpack(header)
+    if size > MAX_FRAME:
+        raise ConnectionError(f"Frame quá lớn: {size} bytes")
+    data = _recv_exact(sock, size)
+    if data is None:
+        raise ConnectionError("Kết nối bị đóng giữa chừng")
+    return json.loads(data.decode("utf-8"))
+
+
+def peer_closed(sock):
+    # True when the other side hung up (readable with nothing to read)
+    readable, _, _ = select.select([sock], [], [], 0)
+    if not readable:
+        return False
+    try:
+        return sock.recv(1, socket.MSG_PEEK) == b""
+    except OSError:
+        return True
+
+
+class _Handler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        server = self.server.inference
+        server.stats["connections"] += 1
+        while True:
+            try:
+                request = recv_frame(self.request)
+            except ConnectionResetError:
+                return
+            except (OSError, ValueError) as e:
+                logging.warning(f"Inference server: kết nối lỗi: {e}")
+                return
+            if request is None:
+                return
+            try:
+                if not server.handle(self.request, request):
+                    return
+            except OSError:
+                return  # client gone while answering
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class InferenceServer:
+    # serves the slots of an InferenceScheduler on a unix socket
+    # response_cache / semantic_cache: shared caches, only for stats
+
+    def __init__(self, socket_path, scheduler, response_cache=None, semantic_cache=None):
+        self.socket_path = socket_path
+        self.scheduler = scheduler
+        self.response_cache = response_cache
+        self.semantic_cache = semantic_cache
+        self.stats = {"connections": 0, "requests": 0, "disconnects": 0}
+        self._server = None
+
+    def start(self):
+        # bind the socket (a stale file of a dead server is replaced)
+        if os.path.exists(self.socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+                raise RuntimeError(f"Inference server đang chạy ở {self.socket_path}")
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.unlink(self.socket_path)
+            finally:
+                probe.close()
+        self._server = _UnixServer(self.socket_path, _Handler)
+        self._server.inference = self
+        os.chmod(self.socket_path, 0o600)  # only the same user may connect
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever(poll_interval=POLL_INTERVAL)
+
+    def shutdown(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    def handle(self, sock, request):
+        # answer one request, False when the connection must be closed
+        self.stats["requests"] += 1
+        op = request.get("op")
+        slots = self.scheduler.slots
+        try:
+            if op == "generate":
+                return self._generate(sock, request)
+            if op == "tokenize":
+                reply = {"tokens": list(slots[0].tokenize(request["text"]))}
+            elif op == "forget":
+                for model in set(slots):
+                    model.forget_conversation(request["conv_id"])
+                reply = {"ok": True}
+            elif op == "config":
+                reply = {"config": slots[0].get_config()}
+            elif op == "update_config":
+                for model in set(slots):
+                    model.update_config(request["values"])
+                reply = {"ok": True}
+            elif op == "stats":
+                reply = {"stats": self.get_stats()}
+            elif op == "models":
+                reply = {"models": slots[0].list_models() if hasattr(slots[0], 'list_models') else []}
+            elif op == "select_model":
+                if not hasattr(slots[0], 'select_model'):
+                    raise ValueError(f"Không có model: {request['model']}")
+                slots[0].select_model(request["model"])
+                reply = {"ok": True}
+            elif op == "ping":
+                reply = {"ok": True}
+            else:
+                reply = {"error": f"Không hỗ trợ op: {op}", "kind": "error"}
+        except Exception as e:
+            reply = {"error": str(e), "kind": "error"}
+        send_frame(sock, reply)
+        return True
+
+    def _generate(self, sock, request):
+        # run the generation on a scheduler slot and forward its deltas
+        token = CancelToken(timeout=request.get("timeout"), max_tokens=request.get("token_budget"))
+        deltas = queue.Queue()
+        conv_id = request.get("conv_id")
+        options = {"model": request["model"]} if request.get("model") else {}
+
+        def job(model):
+            stream = None
+            try:
+                if conv_id is not None:
+                    model.switch_conversation(conv_id)
+                stream = model.generate(request["prompt"], max_tokens=request.get("max_tokens"),
+                                        temperature=request.get("temperature"), top_p=request.get("top_p"),
+                                        stream=True, question=request.get("question"), cancel=token, **options)
+                for delta in stream:
+                    deltas.put(delta)
+            finally:
+                if stream is not None:
+                    stream.close()
+                deltas.put(None)
+
+        try:
+            future = self.scheduler.submit(job, user=request.get("user") or conv_id,
+                                           priority=request.get("priority") or PRIORITY_INTERACTIVE)
+        except QueueFullError as e:
+            send_frame(sock, {"error": str(e), "kind": "per_user" if e.per_user else "queue_full"})
+            return True
+
+        while True:
+            try:
+                delta = deltas.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                if peer_closed(sock):
+                    break
+                continue
+            if delta is None:
+                error = future.exception()
+                if error is not None:
+                    send_frame(sock, {"error": str(error), "kind": "error"})
+                else:
+                    send_frame(sock, {"done": True, "reason": token.reason})
+                return True
+            try:
+                send_frame(sock, {"delta": delta})
+            except OSError:
+                break
+
+        # client went away: stop generating (or never start)
+        self.stats["disconnects"] += 1
+        token.cancel()
+        future.cancel()
+        return False
+
+    def get_stats(self):
+        slots = self.scheduler.slots
+        return {
+            "server": dict(self.stats),
+            "scheduler": self.scheduler.get_stats(),
+            "response_cache": self.response_cache.get_stats() if self.response_cache else None,
+            "semantic_cache": self.semantic_cache.get_stats() if self.semantic_cache else None,
+            "speculative": [slot.get_speculative_stats() for slot in slots
+                            if hasattr(slot, 'get_speculative_stats')],
+            "models": slots[0].get_registry_stats() if hasattr(slots[0], 'get_registry_stats') else None,
+            "router": slots[0].get_router_stats() if hasattr(slots[0], 'get_router_stats') else None,
+        }
+
+
+def main():
+    import config
+    from core.model_llama_cpp import create_response_cache, create_semantic_cache
+    from core.scheduler import create_model_scheduler
+    from core.utils import setup_logging
+
+    conf = config.get_config()
+    setup_logging(conf.get('log_dir', 'logs'))
+    socket_path = sys.argv[1] if len(sys.argv) > 1 else (conf['inference_socket'] or "inference.sock")
+
+    response_cache = create_response_cache(conf) if conf.get('response_cache') else None
+    semantic_cache = create_semantic_cache(conf) if conf.get('semantic_cache') else None
+    scheduler = create_model_scheduler(conf, response_cache, semantic_cache)
+    server = InferenceServer(socket_path, scheduler, response_cache, semantic_cache).start()
+    print(f"Inference server: {socket_path} ({len(scheduler.slots)} slot)")
+    signal.signal(signal.SIGTERM, signal.default_int_handler)  # stop cleanly, remove the socket
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        scheduler.shutdown(wait=False)
+
+
+if __name__ == "__main__":
+    main()
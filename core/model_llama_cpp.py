@@ -1,97 +1,318 @@
 # model wrapper for llama-cpp-python
 # handles model loading and text generation
-import os
-from llama_cpp import Llama
+# the model itself runs in an InferenceBackend (config.BACKEND)
+import re
+import logging
 import config
+from core.backend import create_backend
+from core.cancellation import finish_text
+from core.state_store import ModelStateStore
+from core.response_cache import ResponseCache, cache_key
+
+STOP_SEQUENCES = ["### Human:", "\n### Human:", "Human:", "\nHuman:"]
+
+
+def create_response_cache(conf):
+    # ResponseCache from the RESPONSE_CACHE_* settings
+    return ResponseCache(
+        ram_mb=conf.get('response_cache_ram_mb', 32),
+        ttl=conf.get('response_cache_ttl', 86400),
+        disk_dir=conf.get('response_cache_dir') or None,
+        disk_mb=conf.get('response_cache_disk_mb', 256)
+    )
+
+
+def create_semantic_cache(conf):
+    # SemanticCache from the SEMANTIC_CACHE_* settings (needs numpy)
+    from core.semantic_cache import SemanticCache
+    return SemanticCache(
+        threshold=conf.get('semantic_cache_threshold', 0.92),
+        max_items=conf.get('semantic_cache_max_items', 2000),
+        eviction=conf.get('semantic_cache_eviction', 'lru'),
+        ann_min_items=conf.get('semantic_cache_ann_min', 1000)
+    )
 
 
 class ModelWrapper:
     # wrapper class for the llama model
     
-    def __init__(self):
+    def __init__(self, config_overrides=None, state_store=None, response_cache=None, semantic_cache=None,
+                 backend=None):
         # init the model wrapper with config
+        # config_overrides: per-instance values (e.g. n_threads of a worker slot)
+        # state_store: shared ModelStateStore, created from config if None
+        # response_cache: shared ResponseCache, created from config if None
+        # semantic_cache: shared SemanticCache, created from config if None
+        # backend: an already loaded InferenceBackend (preload-and-fork workers)
         self.config = config.get_config()
-        self.model = None
-        self._initialize_model()
+        if config_overrides:
+            self.config.update(config_overrides)
+        self.backend = None
+        # prompt eval stats (incremental kv cache reuse)
+        self.last_eval_stats = {}
+        self.eval_totals = {"calls": 0, "prompt_tokens": 0, "reused_tokens": 0}
+        # snapshots of other conversations' context state
+        self.active_conv_id = None
+        self.state_store = state_store
+        if self.state_store is None and self.config.get('state_cache', False):
+            self.state_store = ModelStateStore(
+                ram_budget_mb=self.config.get('state_cache_ram_mb', 1024),
+                disk_dir=self.config.get('state_cache_dir'),
+                disk_budget_mb=self.config.get('state_cache_disk_mb', 4096)
+            )
+        # answers of deterministic generations (temperature 0 / fixed seed)
+        self.response_cache = response_cache
+        if self.response_cache is None and self.config.get('response_cache', False):
+            self.response_cache = create_response_cache(self.config)
+        # answers of similar first questions (embedding similarity)
+        self.semantic_cache = semantic_cache
+        if self.semantic_cache is None and self.config.get('semantic_cache', False):
+            self.semantic_cache = create_semantic_cache(self.config)
+        self.model_id = None
+        self._initialize_model(backend)
     
     def _validate_config(self):
         # validate config from config.py
-        is_valid, message = config.validate_config()
+        is_valid, message = config.validate_config(self.config)
         if not is_valid:
             raise ValueError(f"Config error: {message}")
     
-    def _initialize_model(self):
+    def _initialize_model(self, backend=None):
         # load the actual model
         self._validate_config()  # check config first
         
-        model_path = self.config.get('model_path')
-        
-        if not os.path.exists(model_path):
-            raise FileNotFoundError(f"Không tìm thấy model: {model_path}")
+        if backend is not None:
+            # model đã được nạp sẵn (tiến trình cha của launcher prefork)
+            self.backend = backend
+            self.model_id = backend.model_id
+            return
         
-        print(f"Đang tải model từ: {model_path}")
+        if self.config.get('backend', 'llama_cpp') == 'simulated':
+            print("Đang khởi tạo model mô phỏng (BACKEND = simulated)")
+        else:
+            print(f"Đang tải model từ: {self.config.get('model_path')}")
         
         try:
-            self.model = Llama(
-                model_path=model_path,
-                n_ctx=self.config.get('n_ctx', 1024),
-                n_threads=self.config.get('n_threads', 4),
-                n_batch=self.config.get('n_batch', 16),
-                verbose=False
-            )
+            self.backend = create_backend(self.config)
+            self.model_id = self.backend.model_id
             print("Model đã được tải thành công!")
+        except FileNotFoundError:
+            raise
         except Exception as e:
             raise RuntimeError(f"Lỗi khi tải model: {e}")
     
-    def generate(self, prompt, max_tokens=None, temperature=None, top_p=None, stream=None):
+    def generate(self, prompt, max_tokens=None, temperature=None, top_p=None, stream=None, question=None,
+                 cancel=None):
         # generate text from prompt
-        if self.model is None:
+        # question: the user's message when the prompt has no conversation
+        # context (ConversationManager.standalone_question), enables the semantic cache
+        # cancel: CancelToken checked after every token; a stopped generation
+        # returns a PartialResponse (stream: simply ends) and is never cached
+        if self.backend is None:
             raise RuntimeError("Model chưa được khởi tạo")
         
         # Sử dụng giá trị từ config nếu không được chỉ định
+        # (so sánh với None: temperature = 0 là giá trị hợp lệ)
         max_tokens = max_tokens or self.config.get('max_tokens', 256)
-        temperature = temperature or self.config.get('temperature', 0.7)
-        top_p = top_p or self.config.get('top_p', 0.9)
+        temperature = temperature if temperature is not None else self.config.get('temperature', 0.7)
+        top_p = top_p if top_p is not None else self.config.get('top_p', 0.9)
         stream = stream if stream is not None else self.config.get('stream', False)
+        key = self._response_key(prompt, max_tokens, temperature, top_p)
         
         try:
+            if cancel is not None and cancel.cancelled:
+                # hết hạn / bị hủy trước khi bắt đầu (ví dụ khi còn trong hàng đợi)
+                return self._replay("") if stream else finish_text("", cancel)
+            
+            vector = None
+            if question is not None and self.semantic_cache is not None:
+                vector = self.embed(question)
+                hit = self.semantic_cache.lookup(vector, question)
+                if hit is not None:
+                    return self._replay(hit[0]) if stream else hit[0]
+            
             if stream:
-                return self._generate_stream(prompt, max_tokens, temperature, top_p)
-            else:
-                return self._generate_once(prompt, max_tokens, temperature, top_p)
+                result = self._generate_stream(prompt, max_tokens, temperature, top_p, cache_key=key, cancel=cancel)
+                if vector is not None:
+                    result = self._remember_stream(result, vector, question, cancel)
+                return result
+            result = self._generate_once(prompt, max_tokens, temperature, top_p, cache_key=key, cancel=cancel)
+            if vector is not None and not getattr(result, 'partial', False):
+                self.semantic_cache.add(vector, question, result)
+            return result
         except Exception as e:
             raise RuntimeError(f"Lỗi khi sinh text: {e}")
     
-    def _generate_once(self, prompt, max_tokens, temperature, top_p):
-        # generate text in one go
-        response = self.model(
-            prompt,
-            max_tokens=max_tokens,
-            temperature=temperature,
-            top_p=top_p,
-            stop=["### Human:", "\n### Human:", "Human:", "\nHuman:"],
-            echo=False
+    def embed(self, text):
+        # embedding of text (llama_cpp: the same GGUF file in embedding mode)
+        return self.backend.embed(text)
+    
+    def _remember_stream(self, stream, vector, question, cancel=None):
+        # pass the stream through, store the full answer once it completed
+        pieces = []
+        for delta in stream:
+            pieces.append(delta)
+            yield delta
+        if cancel is None or cancel.reason is None:
+            self.semantic_cache.add(vector, question, "".join(pieces).strip())
+    
+    def _response_key(self, prompt, max_tokens, temperature, top_p):
+        # cache key of a deterministic generation, None when sampling is random
+        seed = self.config.get('seed')
+        if self.response_cache is None or (temperature > 0 and seed is None):
+            return None
+        params = {"max_tokens": max_tokens, "temperature": temperature, "top_p": top_p,
+                  "seed": seed, "stop": STOP_SEQUENCES}
+        return cache_key(self.model_id, prompt, params)
+    
+    def _complete(self, prompt, max_tokens, temperature, top_p, stream, cancel):
+        # run the backend; the cancel token is checked after each sampled token
+        return self.backend.complete(
+            self._prepare_prompt(prompt),
+            max_tokens,
+            temperature,
+            top_p,
+            STOP_SEQUENCES,
+            stream=stream,
+            seed=self.config.get('seed'),
+            should_stop=cancel.step if cancel is not None else None
         )
+    
+    def _prepare_prompt(self, prompt):
+        # tokenize prompt and find how much of it is already in the kv cache
+        # llama only evaluates tokens after the shared prefix, so each turn
+        # costs the new "### Human:" suffix instead of the whole history
+        # prompt can also be token ids without BOS
+        if isinstance(prompt, (list, tuple)):
+            tokens = [self.backend.token_bos()] + list(prompt)
+        else:
+            tokens = self.backend.tokenize(prompt)
+        reused = 0
+        
+        if self.config.get('incremental_eval', True):
+            cached = self.backend.cached_tokens()
+            # last prompt token is always re-evaluated to get fresh logits
+            limit = min(len(cached), len(tokens) - 1)
+            while reused < limit and cached[reused] == tokens[reused]:
+                reused += 1
         
-        return response['choices'][0]['text'].strip()
+        if reused == 0:
+            # prefix changed (old turns evicted / other conversation), start clean
+            self.backend.reset()
+        
+        self.last_eval_stats = {
+            "prompt_tokens": len(tokens),
+            "reused_tokens": reused,
+            "evaluated_tokens": len(tokens) - reused
+        }
+        self.eval_totals["calls"] += 1
+        self.eval_totals["prompt_tokens"] += len(tokens)
+        self.eval_totals["reused_tokens"] += reused
+        logging.debug(f"Prompt eval: {len(tokens) - reused}/{len(tokens)} tokens (tiết kiệm {reused})")
+        
+        return tokens
+    
+    def tokenize(self, text):
+        # token ids of text, without BOS (for counting prompt pieces)
+        return self.backend.tokenize(text, add_bos=False)
+    
+    def reset_cache(self):
+        # drop the evaluated prefix, next call evaluates the full prompt
+        if self.backend is not None:
+            self.backend.reset()
     
-    def _generate_stream(self, prompt, max_tokens, temperature, top_p):
+    def switch_conversation(self, conv_id):
+        # make conv_id the active conversation of the llama context
+        # current state is snapshotted, target state restored if we have one
+        # returns True when the target state was restored
+        if conv_id == self.active_conv_id:
+            return True
+        
+        if self.state_store is None:
+            self.active_conv_id = conv_id
+            self.reset_cache()
+            return False
+        
+        if self.active_conv_id is not None and len(self.backend.cached_tokens()) > 0:
+            try:
+                self.state_store.put(self.active_conv_id, self.backend.save_state())
+            except Exception as e:
+                logging.error(f"Lỗi lưu state: {e}")
+        
+        self.active_conv_id = conv_id
+        state = self.state_store.take(conv_id)
+        if state is not None:
+            try:
+                self.backend.load_state(state)
+                return True
+            except Exception as e:
+                logging.error(f"Lỗi khôi phục state: {e}")
+        
+        self.reset_cache()
+        return False
+    
+    def forget_conversation(self, conv_id):
+        # drop stored state of a deleted / cleared conversation
+        if self.state_store is not None:
+            self.state_store.discard(conv_id)
+        if conv_id == self.active_conv_id:
+            self.reset_cache()
+    
+    def get_speculative_stats(self):
+        # draft acceptance stats (None when speculative decoding is off)
+        return self.backend.get_speculative_stats()
+    
+    def get_eval_stats(self):
+        # prompt eval stats of the last call and totals
+        return {"last": dict(self.last_eval_stats), "totals": dict(self.eval_totals)}
+    
+    def _cached_response(self, cache_key):
+        if cache_key is None:
+            return None
+        text = self.response_cache.get(cache_key)
+        if text is not None:
+            logging.info(f"Response cache hit: {cache_key[:12]}")
+        return text
+    
+    def _generate_once(self, prompt, max_tokens, temperature, top_p, cache_key=None, cancel=None):
+        # generate text in one go
+        cached = self._cached_response(cache_key)
+        if cached is not None:
+            return cached.strip()
+        
+        text = self._complete(prompt, max_tokens, temperature, top_p, False, cancel)
+        if cancel is not None and cancel.reason is not None:
+            return finish_text(text.strip(), cancel)
+        if cache_key is not None:
+            self.response_cache.put(cache_key, text)
+        return text.strip()
+    
+    def _generate_stream(self, prompt, max_tokens, temperature, top_p, cache_key=None, cancel=None):
         # generate text as stream
-        stream = self.model(
-            prompt,
-            max_tokens=max_tokens,
-            temperature=temperature,
-            top_p=top_p,
-            stop=["### Human:", "\n### Human:", "Human:", "\nHuman:"],
-            echo=False,
-            stream=True
-        )
+        cached = self._cached_response(cache_key)
+        if cached is not None:
+            yield from self._replay(cached)
+            return
         
-        for chunk in stream:
-            if 'choices' in chunk and len(chunk['choices']) > 0:
-                delta = chunk['choices'][0].get('text', '')
-                if delta:
-                    yield delta
+        pieces = []
+        for delta in self._complete(prompt, max_tokens, temperature, top_p, True, cancel):
+            pieces.append(delta)
+            yield delta
+        
+        # chỉ lưu khi sinh xong (người dùng dừng giữa chừng thì không tới đây)
+        if cache_key is not None and (cancel is None or cancel.reason is None):
+            self.response_cache.put(cache_key, "".join(pieces))
+    
+    @staticmethod
+    def _replay(text):
+        # phát lại câu trả lời đã lưu theo từng từ, giống khi sinh mới
+        for piece in re.findall(r"\s*\S+|\s+$", text):
+            yield piece
+    
+    def get_cache_stats(self):
+        # response / semantic cache counters (None when disabled)
+        return {"response": self.response_cache.get_stats() if self.response_cache else None,
+                "semantic": self.semantic_cache.get_stats() if self.semantic_cache else None}
     
     def get_config(self):
         # get current config
@@ -102,6 +323,12 @@ class ModelWrapper:
         # note: this only updates runtime config, not config.py file
         self.config.update(new_config)
     
+    def close(self):
+        # unload the model (the state store and caches are kept)
+        if self.backend is not None:
+            self.backend.close()
+            self.backend = None
+    
     def is_ready(self):
         # check if model is ready to use
-        return self.model is not None
+        return self.backend is not None
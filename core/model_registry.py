@@ -0,0 +1,386 @@
+# registry of several GGUF models by name
+# models are loaded on first use and kept resident while the estimated RAM
+# (weights + kv cache) fits the budget; the least recently used idle model
+# is unloaded to make room. a model serving a request is never unloaded,
+# a newer load waits for it instead. replacing a model (register under an
+# existing name) lets running requests finish on the old instance
+import os
+import time
+import struct
+import hashlib
+import logging
+import threading
+
+DEFAULT_NAME = "default"  # name of MODEL_PATH in the registry
+
+# gguf value types -> struct format (8 = string, 9 = array)
+_GGUF_SCALARS = {0: "<B", 1: "<b", 2: "<H", 3: "<h", 4: "<I", 5: "<i", 6: "<f",
+                 7: "<?", 10: "<Q", 11: "<q", 12: "<d"}
+_GGUF_STRING, _GGUF_ARRAY = 8, 9
+
+# general.file_type -> quantization name (most common ones)
+FILE_TYPES = {0: "F32", 1: "F16", 2: "Q4_0", 3: "Q4_1", 7: "Q8_0", 8: "Q5_0", 9: "Q5_1",
+              10: "Q2_K", 11: "Q3_K_S", 12: "Q3_K_M", 13: "Q3_K_L", 14: "Q4_K_S",
+              15: "Q4_K_M", 16: "Q5_K_S", 17: "Q5_K_M", 18: "Q6_K"}
+
+
+def _read(f, fmt):
+    size = struct.calcsize(fmt)
+    data = f.read(size)
+    if len(data) < size:
+        raise ValueError("File GGUF bị cắt ngắn")
+    return struct.unpack(fmt, data)[0]
+
+
+def _read_string(f):
+    return f.read(_read(f, "<Q")).decode("utf-8", errors="replace")
+
+
+def _read_value(f, value_type):
+    if value_type in _GGUF_SCALARS:
+        return _read(f, _GGUF_SCALARS[value_type])
+    if value_type == _GGUF_STRING:
+        return _read_string(f)
+    if value_type == _GGUF_ARRAY:
+        # arrays (vocab, merges, ...) are skipped, only their length is kept
+        item_type, count = _read(f, "<I"), _read(f, "<Q")
+        if item_type in _GGUF_SCALARS:
+            f.seek(count * struct.calcsize(_GGUF_SCALARS[item_type]), os.SEEK_CUR)
+        else:
+            for _ in range(count):
+                _read_value(f, item_type)
+        return count
+    raise ValueError(f"Kiểu giá trị GGUF không hỗ trợ: {value_type}")
+
+
+def read_gguf_metadata(path):
+    # key/value header of a GGUF file (v2/v3) without loading the weights
+    # array values are replaced by their length (e.g. tokenizer.ggml.tokens = vocab size)
+    with open(path, "rb") as f:
+        if f.read(4) != b"GGUF":
+            raise ValueError(f"Không phải file GGUF: {path}")
+        version = _read(f, "<I")
+        if version < 2:
+            raise ValueError(f"GGUF v{version} quá cũ")
+        _read(f, "<Q")  # tensor count
+        metadata = {}
+        for _ in range(_read(f, "<Q")):
+            key = _read_string(f)
+            metadata[key] = _read_value(f, _read(f, "<I"))
+    return metadata
+
+
+def describe_model(path, n_ctx):
+    # size, architecture and estimated resident RAM of a model file
+    info = {"path": path, "exists": os.path.exists(path), "size_mb": 0.0, "estimated_mb": 0.0}
+    if not info["exists"]:
+        return info
+    info["size_mb"] = os.path.getsize(path) / (1024 * 1024)
+    info["estimated_mb"] = info["size_mb"]
+    try:
+        metadata = read_gguf_metadata(path)
+    except (OSError, ValueError) as e:
+        logging.warning(f"Không đọc được metadata GGUF {path}: {e}")
+        return info
+    arch = metadata.get("general.architecture", "")
+    n_layer = metadata.get(f"{arch}.block_count")
+    n_embd = metadata.get(f"{arch}.embedding_length")
+    n_head = metadata.get(f"{arch}.attention.head_count")
+    n_head_kv = metadata.get(f"{arch}.attention.head_count_kv", n_head)
+    info.update({
+        "name": metadata.get("general.name"),
+        "architecture": arch,
+        "quantization": FILE_TYPES.get(metadata.get("general.file_type")),
+        "context_length": metadata.get(f"{arch}.context_length"),
+        "n_layer": n_layer,
+        "n_vocab": metadata.get("tokenizer.ggml.tokens"),
+    })
+    if n_layer and n_embd and n_head:
+        # f16 k and v for every layer and context position
+        kv_bytes = 2 * n_layer * n_ctx * (n_embd * n_head_kv // n_head) * 2
+        info["estimated_mb"] += kv_bytes / (1024 * 1024)
+    return info
+
+
+class _Entry:
+    # one registered model and its loaded instance (if any)
+
+    def __init__(self, name, spec, info):
+        self.name = name
+        self.spec = spec          # config overrides of this model (model_path, n_ctx, ...)
+        self.info = info          # describe_model()
+        self.model = None         # ModelWrapper while resident
+        self.loading = False
+        self.refs = 0             # requests using the model right now
+        self.retired = False      # replaced by register(), unloaded when idle
+        self.last_used = 0.0
+        self.lock = threading.Lock()  # one generation at a time per model
+
+
+class ModelRegistry:
+    # ModelWrapper-compatible front for several models, shared by all
+    # scheduler slots (like BatchDecodeEngine); generate(model=...) picks
+    # one, default_model is used otherwise
+    # factory(name, spec) -> ModelWrapper
+
+    def __init__(self, factory, specs, default=None, ram_budget_mb=0, base_config=None):
+        self.factory = factory
+        self.ram_budget_mb = ram_budget_mb  # 0 = no limit
+        self.base_config = dict(base_config or {})
+        self._overrides = {}  # update_config() values, applied to every model
+        self._entries = {}  # name -> _Entry, in registration order
+        self._retired = []
+        self._cond = threading.Condition()
+        self._local = threading.local()  # conversation of the calling thread
+        self.stats = {"loads": 0, "unloads": 0, "load_time": 0.0, "waits": 0}
+        for name, spec in specs.items():
+            self.register(name, spec)
+        self.default_model = default if default in self._entries else next(iter(self._entries))
+
+    # --- registry ---
+    def register(self, name, spec):
+        # add a model or replace the one registered under name (hot swap)
+        n_ctx = spec.get('n_ctx', self.base_config.get('n_ctx', 2048))
+        entry = _Entry(name, dict(spec), describe_model(spec['model_path'], n_ctx))
+        with self._cond:
+            old = self._entries.get(name)
+            self._entries[name] = entry
+            if old is not None and (old.model is not None or old.loading):
+                old.retired = True
+                self._retired.append(old)
+                if old.refs == 0 and not old.loading:
+                    self._unload(old)
+            self._cond.notify_all()
+        logging.info(f"Model registry: {name} -> {spec['model_path']} (~{entry.info['estimated_mb']:.0f} MB)")
+
+    def select_model(self, name):
+        # default model for requests that do not name one (running requests keep theirs)
+        with self._cond:
+            if name not in self._entries:
+                raise ValueError(f"Không có model: {name}")
+            self.default_model = name
+
+    def list_models(self):
+        with self._cond:
+            return [dict(entry.info, id=entry.name, description=entry.spec.get('description', ''),
+                         loaded=entry.model is not None, in_use=entry.refs,
+                         default=entry.name == self.default_model)
+                    for entry in self._entries.values()]
+
+    def _resident_mb(self):
+        entries = list(self._entries.values()) + self._retired
+        return sum(e.info["estimated_mb"] for e in entries if e.model is not None or e.loading)
+
+    def _acquire(self, name=None):
+        # resident entry of name with one more user, loading it if needed
+        with self._cond:
+            name = name or self.default_model
+            if name not in self._entries:
+                raise ValueError(f"Không có model: {name}")
+            waited = False
+            while True:
+                entry = self._entries.get(name)
+                if entry is None:
+                    raise ValueError(f"Không có model: {name}")
+                if entry.model is not None:
+                    break
+                if not entry.loading and self._make_room(entry):
+                    entry.loading = True
+                    break
+                if not waited:
+                    self.stats["waits"] += 1
+                    waited = True
+                self._cond.wait()  # another load, or requests still using the models we must unload
+            entry.refs += 1
+            if entry.model is not None:
+                self._touch(entry)
+                return entry
+
+        # load outside the lock (slow), others wait on entry.loading
+        started = time.perf_counter()
+        try:
+            model = self.factory(entry.name, self._spec(entry))
+        except BaseException:
+            with self._cond:
+                entry.loading = False
+                entry.refs -= 1
+                self._cond.notify_all()
+            raise
+        with self._cond:
+            entry.model = model
+            entry.loading = False
+            self.stats["loads"] += 1
+            self.stats["load_time"] += time.perf_counter() - started
+            self._touch(entry)
+            self._cond.notify_all()
+        logging.info(f"Đã nạp model {entry.name} ({time.perf_counter() - started:.1f}s)")
+        return entry
+
+    def _make_room(self, entry):
+        # unload idle models (least recently used first) until entry fits
+        if not self.ram_budget_mb:
+            return True
+        needed = entry.info["estimated_mb"]
+        for other in sorted(self._entries.values(), key=lambda e: e.last_used):
+            if self._resident_mb() + needed <= self.ram_budget_mb:
+                break
+            if other is not entry and other.model is not None and other.refs == 0:
+                self._unload(other)
+        if self._resident_mb() + needed <= self.ram_budget_mb:
+            return True
+        # larger than the whole budget: load it once nothing else is resident
+        return self._resident_mb() == 0
+
+    def _unload(self, entry):
+        model, entry.model = entry.model, None
+        if entry in self._retired:
+            self._retired.remove(entry)
+        if model is not None:
+            model.close()
+            self.stats["unloads"] += 1
+            logging.info(f"Đã giải phóng model {entry.name}")
+
+    def _touch(self, entry):
+        entry.last_used = time.time()
+
+    def _release(self, entry):
+        with self._cond:
+            entry.refs -= 1
+            if entry.refs == 0 and entry.retired:
+                self._unload(entry)
+            self._cond.notify_all()
+
+    def _spec(self, entry):
+        return dict(entry.spec, **self._overrides)
+
+    # --- ModelWrapper API ---
+    def generate(self, prompt, max_tokens=None, temperature=None, top_p=None, stream=None, question=None,
+                 cancel=None, model=None):
+        # model: registry name, None = default_model
+        conv_id = getattr(self._local, 'conv_id', None)
+        args = (prompt, max_tokens, temperature, top_p, question, cancel)
+        if stream:
+            return self._stream(model, conv_id, args)
+        entry = self._acquire(model)
+        try:
+            with entry.lock:
+                return self._run(entry, conv_id, args, False)
+        finally:
+            self._release(entry)
+
+    def _stream(self, name, conv_id, args):
+        # the model stays acquired (and locked) until the stream is done or closed
+        entry = self._acquire(name)
+        try:
+            with entry.lock:
+                yield from self._run(entry, conv_id, args, True)
+        finally:
+            self._release(entry)
+
+    @staticmethod
+    def _run(entry, conv_id, args, stream):
+        prompt, max_tokens, temperature, top_p, question, cancel = args
+        if conv_id is not None:
+            entry.model.switch_conversation(conv_id)
+        return entry.model.generate(prompt, max_tokens=max_tokens, temperature=temperature, top_p=top_p,
+                                    stream=stream, question=question, cancel=cancel)
+
+    def tokenize(self, text):
+        # token ids for prompt budgeting: default model's tokenizer, or any
+        # resident model's so that counting never loads (and swaps) a model
+        entry = None
+        with self._cond:
+            resident = [e for e in self._entries.values() if e.model is not None]
+            resident.sort(key=lambda e: e.name != self.default_model)
+            if resident:
+                entry = resident[0]
+                entry.refs += 1
+        if entry is None:
+            entry = self._acquire()
+        try:
+            return entry.model.tokenize(text)
+        finally:
+            self._release(entry)
+
+    def switch_conversation(self, conv_id):
+        # remembered per thread, applied to the model the next generate() uses
+        self._local.conv_id = conv_id
+        return False
+
+    def forget_conversation(self, conv_id):
+        # only resident models hold state; refs keeps them from being unloaded meanwhile
+        with self._cond:
+            entries = [e for e in self._entries.values() if e.model is not None]
+            for entry in entries:
+                entry.refs += 1
+        for entry in entries:
+            try:
+                with entry.lock:
+                    entry.model.forget_conversation(conv_id)
+            finally:
+                self._release(entry)
+
+    def get_config(self):
+        with self._cond:
+            entry = self._entries[self.default_model]
+        return dict(self.base_config, **self._spec(entry), model=self.default_model)
+
+    def update_config(self, new_config):
+        # applies to every model, loaded now or later
+        with self._cond:
+            self._overrides.update(new_config)
+            entries = [e for e in list(self._entries.values()) + self._retired if e.model is not None]
+        for entry in entries:
+            entry.model.update_config(new_config)
+
+    def get_speculative_stats(self):
+        with self._cond:
+            entry = self._entries[self.default_model]
+            return entry.model.get_speculative_stats() if entry.model is not None else None
+
+    def is_ready(self):
+        return True
+
+    def get_registry_stats(self):
+        # loads / unloads and what is resident now
+        with self._cond:
+            return dict(self.stats, default=self.default_model, resident_mb=round(self._resident_mb(), 1),
+                        ram_budget_mb=self.ram_budget_mb,
+                        loaded=[e.name for e in self._entries.values() if e.model is not None],
+                        retired=len(self._retired))
+
+
+def model_specs(conf):
+    # name -> config overrides: MODEL_PATH as "default" plus config.MODELS
+    specs = {DEFAULT_NAME: {"model_path": conf['model_path']}}
+    for name, spec in (conf.get('models') or {}).items():
+        specs[name] = dict(spec)
+    return specs
+
+
+def create_model_registry(conf, response_cache=None):
+    # ModelRegistry over MODEL_PATH and config.MODELS; every model file gets
+    # its own conversation snapshots and semantic cache (states and answers
+    # of one model are meaningless for another)
+    from core.model_llama_cpp import ModelWrapper, create_semantic_cache
+    from core.response_cache import model_identity
+    from core.state_store import ModelStateStore
+    specs = model_specs(conf)
+    state_stores = {}
+    semantic_caches = {}
+
+    def factory(name, spec):
+        key = model_identity(spec['model_path']) if os.path.exists(spec['model_path']) else spec['model_path']
+        if conf.get('state_cache') and key not in state_stores:
+            disk_dir = conf.get('state_cache_dir')
+            if disk_dir:
+                disk_dir = os.path.join(disk_dir, hashlib.sha1(key.encode("utf-8")).hexdigest()[:12])
+            state_stores[key] = ModelStateStore(conf['state_cache_ram_mb'] / len(specs), disk_dir,
+                                                conf['state_cache_disk_mb'] / len(specs))
+        if conf.get('semantic_cache') and key not in semantic_caches:
+            semantic_caches[key] = create_semantic_cache(conf)
+        return ModelWrapper(config_overrides=dict(conf, **spec), state_store=state_stores.get(key),
+                            response_cache=response_cache, semantic_cache=semantic_caches.get(key))
+
+    return ModelRegistry(factory, specs, default=conf.get('default_model') or DEFAULT_NAME,
+                         ram_budget_mb=conf.get('memory_budget_mb', 0), base_config=conf)
@@ -0,0 +1,94 @@
+# read-through cache for chat history reads
+# byte-bounded LRU with a TTL; write paths invalidate per user/conversation
+import time
+import threading
+from collections import OrderedDict
+
+
+def estimate_size(value):
+    # rough bytes held by a cached result (strings dominate)
+    if isinstance(value, str):
+        return 49 + len(value)
+    if isinstance(value, dict):
+        return 232 + sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return 56 + 8 * len(value) + sum(estimate_size(v) for v in value)
+    return 32
+
+
+class ReadCache:
+    # keys are tuples (kind, user, conv_id or None, ...)
+    # cached values are shared between callers and must not be modified
+
+    def __init__(self, max_mb=64, ttl=30):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> [value, expires_at, size], least recently used first
+        self._by_user = {}             # user -> set of keys, for invalidation
+        self._generation = {}          # user -> bumped on every invalidation
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0, "evicted": 0, "expired": 0}
+
+    def get(self, key, loader):
+        # cached value of key, or loader() stored under key
+        user = key[1]
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] > time.time():
+                    self._entries.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return entry[0]
+                self._remove(key)
+                self.stats["expired"] += 1
+            self.stats["misses"] += 1
+            generation = self._generation.get(user, 0)
+
+        # database read happens outside the lock
+        value = loader()
+        size = estimate_size(value)
+        with self._lock:
+            # a write invalidated this user while loading: the value may be stale
+            if self._generation.get(user, 0) != generation or size > self.max_bytes:
+                return value
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = [value, time.time() + self.ttl, size]
+            self._by_user.setdefault(user, set()).add(key)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.stats["evicted"] += 1
+        return value
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry[2]
+        keys = self._by_user.get(key[1])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_user[key[1]]
+
+    def invalidate(self, user, conv_id=None):
+        # drop the user's lists and the conversation's messages (all of them when conv_id is None)
+        with self._lock:
+            self._generation[user] = self._generation.get(user, 0) + 1
+            self.stats["invalidations"] += 1
+            for key in list(self._by_user.get(user, ())):
+                if conv_id is None or key[2] is None or key[2] == conv_id:
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_user.clear()
+            self._generation.clear()
+            self._bytes = 0
+
+    def get_stats(self):
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return dict(self.stats, entries=len(self._entries), bytes=self._bytes,
+                        hit_rate=self.stats["hits"] / lookups if lookups else 0.0)
@@ -0,0 +1,175 @@
+# client of the inference daemon (core/inference_server.py)
+# drop-in for ModelWrapper in the web app: same generate / tokenize /
+# switch_conversation / config API, the model runs in the daemon
+import time
+import select
+import socket
+import threading
+
+from core.cancellation import finish_text
+from core.inference_server import send_frame, recv_frame, POLL_INTERVAL
+from core.scheduler import QueueFullError
+
+
+class RemoteModelWrapper:
+    # one instance per scheduler slot of the web worker (not shared between
+    # threads for generate); idle connections are pooled and reused
+
+    def __init__(self, socket_path, connect_timeout=30):
+        # connect_timeout: seconds to wait for the daemon to come up
+        self.socket_path = socket_path
+        self.active_conv_id = None
+        self._idle = []
+        self._lock = threading.Lock()
+        self._wait_ready(connect_timeout)
+
+    def _wait_ready(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self._call({"op": "ping"})
+                return
+            except OSError:
+                if time.monotonic() >= deadline:
+                    raise ConnectionError(f"Không kết nối được inference server: {self.socket_path}")
+                time.sleep(0.5)
+
+    def _acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def _release(self, sock, reusable):
+        # a connection is reused only after a complete answer
+        if reusable:
+            with self._lock:
+                self._idle.append(sock)
+        else:
+            sock.close()
+
+    def _call(self, request):
+        # one request / one reply
+        sock = self._acquire()
+        ok = False
+        try:
+            send_frame(sock, request)
+            reply = recv_frame(sock)
+            if reply is None:
+                raise ConnectionError("Inference server đã đóng kết nối")
+            ok = True
+        finally:
+            self._release(sock, ok)
+        if "error" in reply:
+            raise _remote_error(reply)
+        return reply
+
+    def generate(self, prompt, max_tokens=None, temperature=None, top_p=None, stream=None, question=None,
+                 cancel=None, model=None, user=None, priority=None):
+        # same contract as ModelWrapper.generate; the daemon applies config
+        # defaults for parameters left as None
+        # model: model name when the daemon has MODELS (ModelRegistry)
+        # user: who asks, for the daemon's per-user fairness and limit
+        #   (without it the daemon counts per conversation)
+        # priority: scheduler priority on the daemon (None = interactive)
+        # cancel: its deadline and token budget go to the daemon, cancel()
+        # here closes the connection which stops the generation there
+        request = {"op": "generate", "prompt": list(prompt) if isinstance(prompt, (list, tuple)) else prompt,
+                   "max_tokens": max_tokens, "temperature": temperature, "top_p": top_p,
+                   "question": question, "conv_id": self.active_conv_id, "model": model,
+                   "user": user, "priority": priority}
+        if cancel is not None:
+            if cancel.cancelled:
+                return self._deltas(None, cancel) if stream else finish_text("", cancel)
+            request["timeout"] = cancel.remaining()
+            if cancel.max_tokens is not None:
+                request["token_budget"] = max(1, cancel.max_tokens - cancel.tokens)
+        deltas = self._deltas(request, cancel)
+        if stream:
+            return deltas
+        return finish_text("".join(deltas).strip(), cancel)
+
+    def _deltas(self, request, cancel):
+        if request is None:
+            return
+        sock = self._acquire()
+        complete = False
+        try:
+            send_frame(sock, request)
+            while True:
+                if cancel is not None and cancel.cancelled:
+                    break  # closing the connection stops the daemon side
+                readable, _, _ = select.select([sock], [], [], POLL_INTERVAL)
+                if not readable:
+                    continue
+                message = recv_frame(sock)
+                if message is None:
+                    raise ConnectionError("Inference server đã đóng kết nối")
+                if "delta" in message:
+                    yield message["delta"]
+                    continue
+                complete = True
+                if "error" in message:
+                    raise _remote_error(message)
+                if message.get("reason") and cancel is not None:
+                    cancel.cancel(message["reason"])
+                break
+        finally:
+            self._release(sock, complete)
+
+    def tokenize(self, text):
+        # token ids of text, without BOS
+        return self._call({"op": "tokenize", "text": text})["tokens"]
+
+    def switch_conversation(self, conv_id):
+        # the daemon switches its context when the next generation starts
+        self.active_conv_id = conv_id
+        return False
+
+    def forget_conversation(self, conv_id):
+        self._call({"op": "forget", "conv_id": conv_id})
+        if conv_id == self.active_conv_id:
+            self.active_conv_id = None
+
+    def get_config(self):
+        return self._call({"op": "config"})["config"]
+
+    def update_config(self, new_config):
+        # applies to every slot of the daemon (and so to all web workers)
+        self._call({"op": "update_config", "values": new_config})
+
+    def list_models(self):
+        return self._call({"op": "models"})["models"]
+
+    def select_model(self, name):
+        # default model of the daemon (for all web workers)
+        self._call({"op": "select_model", "model": name})
+
+    def get_server_stats(self):
+        return self._call({"op": "stats"})["stats"]
+
+    def is_ready(self):
+        try:
+            self._call({"op": "ping"})
+            return True
+        except OSError:
+            return False
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for sock in idle:
+            sock.close()
+
+
+def _remote_error(reply):
+    # daemon error -> the exception the local code would have raised
+    if reply.get("kind") in ("queue_full", "per_user"):
+        return QueueFullError(reply["error"], per_user=reply["kind"] == "per_user")
+    return RuntimeError(reply["error"])
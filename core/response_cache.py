@@ -0,0 +1,170 @@
+# response cache for deterministic generations
+# same model file + prompt + sampling params (temperature 0 or fixed seed)
+# gives the same text, so it is served from RAM (LRU) or an optional disk
+# tier instead of being generated again
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+
+def model_identity(path):
+    # cheap identity of a model file: a replaced file gets a new identity
+    st = os.stat(path)
+    return f"{os.path.abspath(path)}:{st.st_size}:{int(st.st_mtime)}"
+
+
+def cache_key(model_id, prompt, params):
+    # prompt is the text or the token ids sent to the model
+    if not isinstance(prompt, str):
+        prompt = list(prompt)
+    payload = json.dumps([model_id, prompt, params], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    # key -> generated text, RAM LRU in front of one json file per key on disk
+
+    def __init__(self, ram_mb=32, ttl=86400, disk_dir=None, disk_mb=256):
+        self.ram_budget = int(ram_mb * 1024 * 1024)
+        self.disk_budget = int(disk_mb * 1024 * 1024)
+        self.disk_dir = disk_dir
+        self.ttl = ttl  # seconds, 0 = never expires
+
+        self._ram = OrderedDict()   # key -> (text, created, size), least recently used first
+        self._ram_bytes = 0
+        self._disk = OrderedDict()  # key -> (created, size), oldest first
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {"ram_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "expired": 0}
+
+        if self.disk_dir and self.disk_budget > 0:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._scan_disk()
+
+    def _scan_disk(self):
+        # keys are content hashes, so answers from previous runs stay valid
+        entries = []
+        for name in os.listdir(self.disk_dir):
+            path = os.path.join(self.disk_dir, name)
+            if name.endswith(".tmp"):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            elif name.endswith(".json"):
+                st = os.stat(path)
+                entries.append((st.st_mtime, name[:-5], st.st_size))
+        for created, key, size in sorted(entries):
+            self._disk[key] = (created, size)
+            self._disk_bytes += size
+        self._trim_disk(0)
+
+    def _file_for(self, key):
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _expired(self, created):
+        return self.ttl and time.time() - created > self.ttl
+
+    def get(self, key):
+        # cached text or None
+        with self._lock:
+            entry = self._ram.get(key)
+            if entry is not None:
+                if not self._expired(entry[1]):
+                    self._ram.move_to_end(key)
+                    self.stats["ram_hits"] += 1
+                    return entry[0]
+                self._remove(key)
+                self.stats["expired"] += 1
+
+            if key in self._disk:
+                created, _ = self._disk[key]
+                if self._expired(created):
+                    self._remove(key)
+                    self.stats["expired"] += 1
+                else:
+                    try:
+                        with open(self._file_for(key), 'r', encoding='utf-8') as f:
+                            text = json.load(f)["text"]
+                        self._put_ram(key, text, created)
+                        self.stats["disk_hits"] += 1
+                        return text
+                    except Exception as e:
+                        logging.error(f"Lỗi đọc response cache {key}: {e}")
+                        self._remove(key)
+
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, key, text):
+        created = time.time()
+        with self._lock:
+            self._remove(key)
+            self._put_ram(key, text, created)
+            if self.disk_dir and self.disk_budget > 0:
+                self._write_disk(key, text, created)
+            self.stats["stores"] += 1
+
+    def _put_ram(self, key, text, created):
+        size = len(text.encode("utf-8")) + 100
+        if size > self.ram_budget:
+            return
+        if key in self._ram:
+            self._ram_bytes -= self._ram.pop(key)[2]
+        self._ram[key] = (text, created, size)
+        self._ram_bytes += size
+        while self._ram_bytes > self.ram_budget:
+            _, (_, _, old_size) = self._ram.popitem(last=False)
+            self._ram_bytes -= old_size
+
+    def _write_disk(self, key, text, created):
+        path = self._file_for(key)
+        tmp_path = path + ".tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"created": created, "text": text}, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logging.error(f"Lỗi ghi response cache {key}: {e}")
+            return
+        size = os.path.getsize(path)
+        self._trim_disk(size)
+        self._disk[key] = (created, size)
+        self._disk_bytes += size
+
+    def _trim_disk(self, incoming):
+        # drop the oldest files until incoming bytes fit under the cap
+        while self._disk and self._disk_bytes + incoming > self.disk_budget:
+            old_key = next(iter(self._disk))
+            self._remove_disk(old_key)
+
+    def _remove_disk(self, key):
+        _, size = self._disk.pop(key)
+        self._disk_bytes -= size
+        try:
+            os.remove(self._file_for(key))
+        except OSError:
+            pass
+
+    def _remove(self, key):
+        if key in self._ram:
+            self._ram_bytes -= self._ram.pop(key)[2]
+        if key in self._disk:
+            self._remove_disk(key)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._ram) + list(self._disk):
+                self._remove(key)
+
+    def get_stats(self):
+        with self._lock:
+            hits = self.stats["ram_hits"] + self.stats["disk_hits"]
+            lookups = hits + self.stats["misses"]
+            return dict(self.stats, hit_rate=hits / lookups if lookups else 0.0,
+                        ram_items=len(self._ram), ram_bytes=self._ram_bytes,
+                        disk_items=len(self._disk), disk_bytes=self._disk_bytes)
@@ -0,0 +1,189 @@
+# routing between a small and a large model of the ModelRegistry
+# requests that do not name a model go to the small one unless they look
+# expensive (long prompt or answer budget, long message, code, analysis
+# keywords); with ROUTER_ESCALATE a small-model answer that trips the
+# quality checks (empty, unsure, repetitive) is generated again by the
+# large model. for streams only the first ROUTER_ESCALATE_PEEK_CHARS are
+# held back and checked, the rest is passed through as it comes
+import re
+import time
+import threading
+
+SMALL, LARGE, ESCALATED, PINNED = "small", "large", "escalated", "pinned"
+
+_CODE = re.compile(r"```|\bdef \w+\(|\bclass \w+|\bimport \w+|Traceback|\w+\(.*\)\s*[:;{]|^\s{4,}\S", re.MULTILINE)
+_UNSURE = ("tôi không biết", "tôi không chắc", "không rõ", "i don't know", "i'm not sure", "i am not sure")
+
+
+def last_user_message(prompt):
+    # the message the prompt asks about (prompts of ConversationManager.build_prompt)
+    if not isinstance(prompt, str):
+        return ""
+    message = prompt.rsplit("### Human:", 1)[-1]
+    return message.split("### Assistant:", 1)[0].strip()
+
+
+def escalation_reason(text, complete=True):
+    # why a small-model answer is not good enough, None when it is fine
+    # complete=False: text is only the beginning of the answer
+    stripped = text.strip()
+    if complete and len(stripped) < 2:
+        return "empty"
+    lowered = stripped.lower()
+    if any(phrase in lowered for phrase in _UNSURE):
+        return "unsure"
+    words = lowered.split()
+    if len(words) >= 20 and len(set(words)) / len(words) < 0.3:
+        return "repetitive"
+    return None
+
+
+class ModelRouter:
+    # ModelWrapper-compatible front of a ModelRegistry that picks the model
+    # per request; generate(model=...) bypasses the routing (pinned)
+    # everything else (list_models, tokenize, ...) goes to the registry
+
+    def __init__(self, registry, conf):
+        self.registry = registry
+        self.small_model = conf.get('router_small_model', 'default')
+        self.large_model = conf.get('router_large_model', 'large')
+        for name in (self.small_model, self.large_model):
+            if name not in [m["id"] for m in registry.list_models()]:
+                raise ValueError(f"ROUTER: không có model {name} trong MODELS")
+        self.max_small_prompt_tokens = conf.get('router_max_small_prompt_tokens', 768)
+        self.max_small_answer_tokens = conf.get('router_max_small_answer_tokens', 512)
+        self.max_small_words = conf.get('router_max_small_words', 40)
+        self.large_keywords = [k.lower() for k in conf.get('router_large_keywords', [])]
+        self.escalate = conf.get('router_escalate', True)
+        self.peek_chars = conf.get('router_escalate_peek_chars', 160)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.stats = {route: {"requests": 0, "tokens": 0, "total_time": 0.0, "max_time": 0.0}
+                      for route in (SMALL, LARGE, ESCALATED, PINNED)}
+        self.reasons = {}  # why requests went to the large model / were escalated
+
+    def __getattr__(self, name):
+        return getattr(self.registry, name)
+
+    def route(self, prompt, max_tokens=None, question=None):
+        # (SMALL or LARGE, reason) for a request
+        max_tokens = max_tokens or self.registry.get_config().get('max_tokens', 256)
+        if max_tokens > self.max_small_answer_tokens:
+            return LARGE, "max_tokens"
+        n_prompt = len(prompt) if isinstance(prompt, (list, tuple)) else len(self.registry.tokenize(prompt))
+        if n_prompt > self.max_small_prompt_tokens:
+            return LARGE, "prompt_tokens"
+        message = question or last_user_message(prompt)
+        if len(message.split()) > self.max_small_words:
+            return LARGE, "long_message"
+        if _CODE.search(message):
+            return LARGE, "code"
+        lowered = message.lower()
+        for keyword in self.large_keywords:
+            if keyword in lowered:
+                return LARGE, f"keyword:{keyword}"
+        return SMALL, None
+
+    def switch_conversation(self, conv_id):
+        # kept here as well: an escalated request starts a second generation
+        self._local.conv_id = conv_id
+        return self.registry.switch_conversation(conv_id)
+
+    def generate(self, prompt, max_tokens=None, temperature=None, top_p=None, stream=None, question=None,
+                 cancel=None, model=None):
+        # same contract as ModelWrapper.generate; model: pin a model (no routing)
+        conv_id = getattr(self._local, 'conv_id', None)
+        args = (prompt, max_tokens, temperature, top_p, question, cancel)
+        if model:
+            route, name = PINNED, model
+        else:
+            route, reason = self.route(prompt, max_tokens, question)
+            name = self.small_model if route == SMALL else self.large_model
+            if reason:
+                self._count_reason(reason)
+        stream = stream if stream is not None else self.registry.get_config().get('stream', False)
+        if stream:
+            return self._stream(route, name, conv_id, args)
+
+        started = time.perf_counter()
+        text = self._generate(name, conv_id, args, False)
+        if route == SMALL and self._should_escalate(text, True, cancel):
+            route = ESCALATED
+            text = self._generate(self.large_model, conv_id, args, False)
+        self._record(route, started, len(self.registry.tokenize(text)) if text else 0)
+        return text
+
+    def _stream(self, route, name, conv_id, args):
+        started = time.perf_counter()
+        tokens = 0
+        try:
+            deltas = self._generate(name, conv_id, args, True)
+            if route == SMALL and self.escalate:
+                # hold back the beginning of the small model's answer and check it
+                head = []
+                complete = True
+                for delta in deltas:
+                    head.append(delta)
+                    if sum(len(d) for d in head) >= self.peek_chars:
+                        complete = False
+                        break
+                if self._should_escalate("".join(head), complete, args[-1]):
+                    deltas.close()
+                    route = ESCALATED
+                    deltas = self._generate(self.large_model, conv_id, args, True)
+                else:
+                    for delta in head:
+                        tokens += 1
+                        yield delta
+            try:
+                for delta in deltas:
+                    tokens += 1
+                    yield delta
+            finally:
+                deltas.close()
+        finally:
+            self._record(route, started, tokens)
+
+    def _generate(self, name, conv_id, args, stream):
+        prompt, max_tokens, temperature, top_p, question, cancel = args
+        if conv_id is not None:
+            self.registry.switch_conversation(conv_id)
+        return self.registry.generate(prompt, max_tokens=max_tokens, temperature=temperature, top_p=top_p,
+                                      stream=stream, question=question, cancel=cancel, model=name)
+
+    def _should_escalate(self, text, complete, cancel):
+        if not self.escalate or (cancel is not None and cancel.cancelled):
+            return False
+        reason = escalation_reason(text, complete)
+        if reason is None:
+            return False
+        self._count_reason(f"escalate:{reason}")
+        return True
+
+    def _count_reason(self, reason):
+        with self._lock:
+            self.reasons[reason] = self.reasons.get(reason, 0) + 1
+
+    def _record(self, route, started, tokens):
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            stats = self.stats[route]
+            stats["requests"] += 1
+            stats["tokens"] += tokens
+            stats["total_time"] += elapsed
+            stats["max_time"] = max(stats["max_time"], elapsed)
+
+    def get_router_stats(self):
+        # per route: requests, average latency and generated tokens per second
+        with self._lock:
+            routes = {}
+            for route, stats in self.stats.items():
+                count = stats["requests"]
+                routes[route] = {
+                    "requests": count,
+                    "avg_latency": stats["total_time"] / count if count else 0.0,
+                    "max_latency": stats["max_time"],
+                    "tokens_per_s": stats["tokens"] / stats["total_time"] if stats["total_time"] else 0.0,
+                }
+            return {"small_model": self.small_model, "large_model": self.large_model,
+                    "routes": routes, "reasons": dict(self.reasons)}
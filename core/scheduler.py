@@ -0,0 +1,219 @@
+# request scheduler for inference
+# bounded queue, per-user fair queuing and N worker slots (one model each)
+import os
+import time
+import logging
+import threading
+from collections import deque, OrderedDict
+from concurrent.futures import Future
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+
+class QueueFullError(Exception):
+    # raised when a request can't be queued
+    # per_user=True: this user already has too many requests (-> 429)
+    # per_user=False: the whole server is saturated (-> 503)
+    def __init__(self, message, per_user=False):
+        super().__init__(message)
+        self.per_user = per_user
+
+
+def plan_workers(requested, model_path, n_threads, memory_budget_mb=0):
+    # work out how many slots fit the memory budget and split cpu threads
+    # each slot loads its own model, so count the full file size per slot
+    n_workers = max(1, int(requested))
+    if memory_budget_mb and os.path.exists(model_path):
+        model_mb = os.path.getsize(model_path) / (1024 * 1024)
+        if model_mb > 0:
+            n_workers = max(1, min(n_workers, int(memory_budget_mb // model_mb)))
+    threads_per_worker = max(1, int(n_threads) // n_workers)
+    return n_workers, threads_per_worker
+
+
+class InferenceScheduler:
+    # runs jobs on worker slots, each slot owns one model instance
+    # a job is a callable taking the slot's model and returning a result
+
+    def __init__(self, model_factory, n_workers=1, max_queue=32, max_per_user=4):
+        self.max_queue = max_queue
+        self.max_per_user = max_per_user
+        # priority -> {user: deque of jobs}, users are served round-robin
+        self._queues = {PRIORITY_INTERACTIVE: OrderedDict(), PRIORITY_BACKGROUND: OrderedDict()}
+        self._queued = 0
+        self._per_user = {}  # user -> queued + running jobs
+        self._cond = threading.Condition()
+        self._closed = False
+        self.stats = {"submitted": 0, "rejected": 0, "completed": 0, "failed": 0,
+                      "cancelled": 0, "running": 0, "total_wait": 0.0}
+
+        self.slots = [model_factory(i) for i in range(max(1, n_workers))]
+        self._threads = []
+        for i, model in enumerate(self.slots):
+            t = threading.Thread(target=self._worker, args=(model,), name=f"inference-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, job, user=None, priority=PRIORITY_INTERACTIVE):
+        # queue a job, returns a Future; fails fast when queues are full
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Scheduler đã dừng")
+            if self._queued >= self.max_queue:
+                self.stats["rejected"] += 1
+                raise QueueFullError("Máy chủ đang quá tải, vui lòng thử lại sau", per_user=False)
+            if self.max_per_user and self._per_user.get(user, 0) >= self.max_per_user:
+                self.stats["rejected"] += 1
+                raise QueueFullError("Bạn đang có quá nhiều yêu cầu chờ xử lý", per_user=True)
+
+            future = Future()
+            users = self._queues.get(priority, self._queues[PRIORITY_BACKGROUND])
+            item = (job, future, time.time())
+            users.setdefault(user, deque()).append(item)
+            self._queued += 1
+            self._per_user[user] = self._per_user.get(user, 0) + 1
+            self.stats["submitted"] += 1
+            self._cond.notify()
+        # a queued job whose future is cancelled gives its place back at once
+        future.add_done_callback(lambda f: f.cancelled() and self._drop(users, user, item))
+        return future
+
+    def _drop(self, users, user, item):
+        with self._cond:
+            jobs = users.get(user)
+            if jobs is None or item not in jobs:
+                return  # already taken by a worker
+            jobs.remove(item)
+            if not jobs:
+                del users[user]
+            self._queued -= 1
+            self.stats["cancelled"] += 1
+        self._release(user)
+
+    def run(self, job, user=None, priority=PRIORITY_INTERACTIVE, timeout=None):
+        # submit and wait for the result
+        return self.submit(job, user=user, priority=priority).result(timeout=timeout)
+
+    def _next_job(self):
+        # highest priority first, then round-robin between users
+        for priority in sorted(self._queues):
+            users = self._queues[priority]
+            if not users:
+                continue
+            user, jobs = next(iter(users.items()))
+            item = jobs.popleft()
+            del users[user]
+            if jobs:
+                users[user] = jobs  # move user to the back of the line
+            return user, item
+        return None
+
+    def _release(self, user):
+        with self._cond:
+            count = self._per_user.get(user, 1) - 1
+            if count > 0:
+                self._per_user[user] = count
+            else:
+                self._per_user.pop(user, None)
+
+    def _worker(self, model):
+        while True:
+            with self._cond:
+                while not self._closed and self._queued == 0:
+                    self._cond.wait()
+                if self._queued == 0:
+                    return
+                user, (job, future, queued_at) = self._next_job()
+                self._queued -= 1
+                self.stats["running"] += 1
+                self.stats["total_wait"] += time.time() - queued_at
+
+            outcome = "completed"
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(job(model))
+                    except BaseException as e:
+                        logging.error(f"Lỗi khi xử lý yêu cầu: {e}")
+                        future.set_exception(e)
+                        outcome = "failed"
+                else:
+                    outcome = "cancelled"
+            finally:
+                with self._cond:
+                    self.stats["running"] -= 1
+                    self.stats[outcome] += 1
+                self._release(user)
+
+    def queue_depth(self):
+        with self._cond:
+            return self._queued
+
+    def get_stats(self):
+        with self._cond:
+            stats = dict(self.stats, queued=self._queued, workers=len(self.slots))
+        started = stats["completed"] + stats["failed"] + stats["running"]
+        stats["avg_wait"] = stats.pop("total_wait") / started if started else 0.0
+        return stats
+
+    def shutdown(self, wait=True):
+        # stop accepting jobs, workers exit once the queue is drained
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if wait:
+            for t in self._threads:
+                t.join()
+
+
+def create_model_scheduler(conf, response_cache=None, semantic_cache=None, backend=None):
+    # scheduler over local model slots (WORKER_SLOTS models, or the sequences
+    # of one BatchDecodeEngine with BATCH_DECODE); slots share the state
+    # store and the answer caches
+    # backend: model already loaded by the preload-and-fork launcher, served
+    # by a single slot (the process is one of several workers)
+    # with MODELS the slots share a ModelRegistry (requests pick the model)
+    from core.model_llama_cpp import ModelWrapper
+    from core.state_store import ModelStateStore
+
+    if conf.get('models') and backend is None:
+        # several models: one registry shared by all slots, it loads and
+        # unloads models within MEMORY_BUDGET_MB; state stores and semantic
+        # caches are per model (semantic_cache is not used)
+        if conf.get('batch_decode'):
+            raise ValueError("BATCH_DECODE không dùng được với MODELS")
+        from core.model_registry import create_model_registry
+        registry = create_model_registry(conf, response_cache)
+        if conf.get('router'):
+            # requests that do not pick a model go to the cheapest adequate one
+            from core.router import ModelRouter
+            registry = ModelRouter(registry, conf)
+        return InferenceScheduler(lambda slot: registry, n_workers=max(1, conf['worker_slots']),
+                                  max_queue=conf['queue_max_depth'],
+                                  max_per_user=conf['queue_max_per_user'])
+
+    n_workers, threads_per_worker = plan_workers(
+        conf['worker_slots'], conf['model_path'], conf['n_threads'], conf['memory_budget_mb'])
+    state_store = None
+    if conf.get('state_cache'):
+        state_store = ModelStateStore(conf['state_cache_ram_mb'], conf['state_cache_dir'], conf['state_cache_disk_mb'])
+
+    if backend is not None:
+        n_workers = 1
+
+    def create_model(slot):
+        return ModelWrapper(config_overrides={"n_threads": threads_per_worker}, state_store=state_store,
+                            response_cache=response_cache, semantic_cache=semantic_cache, backend=backend)
+
+    if conf.get('batch_decode'):
+        # one shared context, the scheduler's slots are the batch sequences
+        from core.batch_engine import BatchDecodeEngine
+        batch_engine = BatchDecodeEngine(ModelWrapper(state_store=state_store, backend=backend),
+                                         n_seq=conf['batch_max_sequences'])
+        n_workers = batch_engine.n_seq
+        create_model = lambda slot: batch_engine
+
+    return InferenceScheduler(create_model, n_workers=n_workers,
+                              max_queue=conf['queue_max_depth'],
+                              max_per_user=conf['queue_max_per_user'])
@@ -0,0 +1,179 @@
+# semantic answer cache
+# first questions of a conversation (no context) are embedded; a new question
+# close enough to a stored one (cosine similarity) gets the stored answer
+# vectors live in one normalized numpy matrix, so a lookup is one mat-vec;
+# past ann_min_items a random-hyperplane LSH index narrows the candidates
+import logging
+import threading
+import time
+
+import numpy as np
+
+EVICTION_POLICIES = ("lru", "lfu", "fifo")
+
+
+def normalize(vector):
+    # float32 unit vector (embedding of one text)
+    vector = np.asarray(vector, dtype=np.float32)
+    if vector.ndim == 2:
+        # one vector per token (no pooling in the model): mean pooling
+        vector = vector.mean(axis=0)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+class LSHIndex:
+    # n_tables hash tables, each keyed by the signs of n_bits random projections
+    # similar vectors share a bucket in at least one table with high probability
+
+    def __init__(self, dim, n_tables=8, n_bits=12, seed=0):
+        rng = np.random.default_rng(seed)
+        self.planes = rng.standard_normal((n_tables, n_bits, dim)).astype(np.float32)
+        self.weights = 1 << np.arange(n_bits, dtype=np.int64)
+        self.tables = [{} for _ in range(n_tables)]
+        self.codes = {}  # row -> codes, to remove a row later
+
+    def _codes(self, vectors):
+        # (rows, n_tables) bucket ids
+        bits = np.einsum("tbd,nd->ntb", self.planes, vectors) > 0
+        return bits @ self.weights
+
+    def add(self, row, vector):
+        codes = self._codes(vector[None, :])[0]
+        for table, code in zip(self.tables, codes.tolist()):
+            table.setdefault(code, set()).add(row)
+        self.codes[row] = codes
+
+    def add_many(self, rows, vectors):
+        for row, codes in zip(rows, self._codes(vectors)):
+            for table, code in zip(self.tables, codes.tolist()):
+                table.setdefault(code, set()).add(row)
+            self.codes[row] = codes
+
+    def remove(self, row):
+        codes = self.codes.pop(row, None)
+        if codes is None:
+            return
+        for table, code in zip(self.tables, codes.tolist()):
+            bucket = table.get(code)
+            if bucket is not None:
+                bucket.discard(row)
+                if not bucket:
+                    del table[code]
+
+    def candidates(self, vector):
+        rows = set()
+        for table, code in zip(self.tables, self._codes(vector[None, :])[0].tolist()):
+            rows.update(table.get(code, ()))
+        return np.fromiter(rows, dtype=np.int64, count=len(rows))
+
+
+class SemanticCache:
+    # question embeddings -> stored answers, capacity-bounded
+
+    def __init__(self, threshold=0.92, max_items=2000, eviction="lru", ann_min_items=1000):
+        if eviction not in EVICTION_POLICIES:
+            raise ValueError(f"SEMANTIC_CACHE_EVICTION không hợp lệ: {eviction}")
+        self.threshold = threshold
+        self.max_items = max_items
+        self.eviction = eviction
+        self.ann_min_items = ann_min_items  # 0 = always exact search
+
+        self._vectors = None   # (max_items, dim) float32, rows [0, _count) in use
+        self._count = 0
+        self._entries = []     # row -> (question, answer)
+        self._created = None   # per-row eviction metadata, same rows as _vectors
+        self._last_used = None
+        self._hits = None
+        self._index = None     # LSHIndex once _count reaches ann_min_items
+        self._lock = threading.Lock()
+        self.stats = {"lookups": 0, "hits": 0, "stores": 0, "evicted": 0, "ann_lookups": 0}
+
+    def lookup(self, vector, question=""):
+        # (answer, similarity, stored question) of the closest entry, or None
+        vector = normalize(vector)
+        with self._lock:
+            self.stats["lookups"] += 1
+            if self._count == 0 or vector.shape[0] != self._vectors.shape[1]:
+                return None
+
+            if self._index is not None:
+                self.stats["ann_lookups"] += 1
+                rows = self._index.candidates(vector)
+                if len(rows) == 0:
+                    return None
+                scores = self._vectors[rows] @ vector
+                best = int(np.argmax(scores))
+                row, score = int(rows[best]), float(scores[best])
+            else:
+                scores = self._vectors[:self._count] @ vector
+                row = int(np.argmax(scores))
+                score = float(scores[row])
+
+            if score < self.threshold:
+                return None
+            self._last_used[row] = time.time()
+            self._hits[row] += 1
+            self.stats["hits"] += 1
+            stored_question, answer = self._entries[row]
+        logging.info(f"Semantic cache hit ({score:.3f}): {question!r} ~ {stored_question!r}")
+        return answer, score, stored_question
+
+    def add(self, vector, question, answer):
+        vector = normalize(vector)
+        if self.max_items <= 0 or not answer.strip():
+            return
+        with self._lock:
+            if self._vectors is None or vector.shape[0] != self._vectors.shape[1]:
+                # first entry (or another embedding model): start a new matrix
+                self._reset(vector.shape[0])
+
+            if self._count < self.max_items:
+                row = self._count
+                self._count += 1
+                self._entries.append((question, answer))
+            else:
+                row = self._victim()
+                self._entries[row] = (question, answer)
+                self.stats["evicted"] += 1
+                if self._index is not None:
+                    self._index.remove(row)
+            self._vectors[row] = vector
+            self._created[row] = self._last_used[row] = time.time()
+            self._hits[row] = 0
+            self.stats["stores"] += 1
+
+            if self._index is not None:
+                self._index.add(row, vector)
+            elif self.ann_min_items and self._count >= self.ann_min_items:
+                self._index = LSHIndex(vector.shape[0])
+                self._index.add_many(range(self._count), self._vectors[:self._count])
+
+    def _victim(self):
+        # row to overwrite when full
+        if self.eviction == "lru":
+            return int(np.argmin(self._last_used))
+        if self.eviction == "lfu":
+            # fewest hits, least recently used among them
+            return int(np.lexsort((self._last_used, self._hits))[0])
+        return int(np.argmin(self._created))
+
+    def _reset(self, dim):
+        self._vectors = np.zeros((self.max_items, dim), dtype=np.float32)
+        self._created = np.zeros(self.max_items)
+        self._last_used = np.zeros(self.max_items)
+        self._hits = np.zeros(self.max_items, dtype=np.int64)
+        self._count = 0
+        self._entries = []
+        self._index = None
+
+    def clear(self):
+        with self._lock:
+            if self._vectors is not None:
+                self._reset(self._vectors.shape[1])
+
+    def get_stats(self):
+        with self._lock:
+            lookups = self.stats["lookups"]
+            return dict(self.stats, items=self._count, ann=self._index is not None,
+                        hit_rate=self.stats["hits"] / lookups if lookups else 0.0)
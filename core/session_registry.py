@@ -0,0 +1,142 @@
+# session registry for the web app
+# one ConversationManager per (user, conversation id), LRU + idle eviction,
+# rehydrated lazily from the database on a miss
+# with a counter, a cached session is reloaded when the conversation got
+# messages this registry did not see (saved by another web process);
+# counter_ttl: seconds a checked session is trusted before counting again
+import time
+import threading
+from collections import OrderedDict
+
+from core.conversation import ConversationManager
+
+
+class SessionRegistry:
+    # maps (user, conv_id) to its own ConversationManager
+
+    def __init__(self, config, loader=None, tokenizer=None, max_sessions=1000, max_mb=256, idle_ttl=1800,
+                 counter=None, counter_ttl=0):
+        # loader(conv_id, user) -> [(user_message, assistant_response), ...] oldest first
+        # counter(conv_id, user) -> number of stored messages (all processes)
+        self.config = config
+        self.loader = loader
+        self.counter = counter
+        self.counter_ttl = counter_ttl
+        self.tokenizer = tokenizer
+        self.max_sessions = max_sessions
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.idle_ttl = idle_ttl
+        # key -> [manager, last_access, size, stored count, counted at], oldest access first
+        self._sessions = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evicted": 0, "reloaded": 0}
+
+    def set_tokenizer(self, tokenizer):
+        with self._lock:
+            self.tokenizer = tokenizer
+            for entry in self._sessions.values():
+                entry[0].set_tokenizer(tokenizer)
+
+    def _new_manager(self, pairs=()):
+        manager = ConversationManager(self.config, tokenizer=self.tokenizer)
+        for user_msg, assistant_resp in pairs:
+            manager.add_user_message(user_msg or "")
+            manager.add_assistant_message(assistant_resp or "")
+        return manager
+
+    def get(self, user, conv_id, messages=None):
+        # get the session's manager, loading its history on a miss
+        # messages: history already fetched by the caller, used instead of the loader
+        key = (user, conv_id)
+        # counted before loading: a message saved meanwhile triggers one more reload
+        checked = self.counter is not None and not self._recently_counted(key)
+        count = self.counter(conv_id, user) if checked else None
+        with self._lock:
+            entry = self._sessions.get(key)
+            if entry is not None and (not checked or entry[3] == count):
+                if checked:
+                    entry[4] = time.time()
+                self._touch(key, entry)
+                self.stats["hits"] += 1
+                return entry[0]
+            self.stats["misses" if entry is None else "reloaded"] += 1
+
+        # database read happens outside the lock
+        if messages is None:
+            messages = self.loader(conv_id, user) if self.loader is not None else ()
+        else:
+            # the caller's messages may come from a read cache that is stale
+            # for other processes' writes: verify against the loader next time
+            count = None
+        manager = self._new_manager(messages or ())
+        return self._insert(key, manager, replace=entry is not None, count=count)
+
+    def create(self, user, conv_id):
+        # start an empty session (new conversation), no database read
+        return self._insert((user, conv_id), self._new_manager(), replace=True,
+                            count=0 if self.counter is not None else None)
+
+    def _recently_counted(self, key):
+        with self._lock:
+            entry = self._sessions.get(key)
+            return (entry is not None and entry[3] is not None
+                    and time.time() - entry[4] < self.counter_ttl)
+
+    def saved(self, user, conv_id):
+        # this process stored one more message of the session (already in its manager)
+        with self._lock:
+            entry = self._sessions.get((user, conv_id))
+            if entry is not None and entry[3] is not None:
+                entry[3] += 1
+
+    def _insert(self, key, manager, replace=False, count=None):
+        with self._lock:
+            entry = self._sessions.get(key)
+            if entry is not None and not replace:
+                # another request loaded it meanwhile, keep that one
+                self._touch(key, entry)
+                return entry[0]
+            if entry is not None:
+                self._remove(key)
+            size = manager.memory_usage()
+            now = time.time()
+            self._sessions[key] = [manager, now, size, count, now]
+            self._bytes += size
+            self._evict()
+            return manager
+
+    def _touch(self, key, entry):
+        entry[1] = time.time()
+        size = entry[0].memory_usage()
+        self._bytes += size - entry[2]
+        entry[2] = size
+        self._sessions.move_to_end(key)
+
+    def _remove(self, key):
+        entry = self._sessions.pop(key)
+        self._bytes -= entry[2]
+
+    def _evict(self):
+        # idle sessions first, then least recently used over the caps
+        now = time.time()
+        while self._sessions:
+            key, entry = next(iter(self._sessions.items()))
+            idle = self.idle_ttl and now - entry[1] > self.idle_ttl
+            over = len(self._sessions) > self.max_sessions or self._bytes > self.max_bytes
+            if not (idle or over) or (len(self._sessions) == 1 and not idle):
+                break
+            self._remove(key)
+            self.stats["evicted"] += 1
+
+    def drop(self, user, conv_id=None):
+        # forget one session, or all sessions of a user
+        with self._lock:
+            keys = [k for k in self._sessions if k[0] == user and (conv_id is None or k[1] == conv_id)]
+            for key in keys:
+                self._remove(key)
+
+    def get_stats(self):
+        with self._lock:
+            self._evict()
+            return dict(self.stats, sessions=len(self._sessions), bytes=self._bytes)
@@ -0,0 +1,129 @@
+# single-flight for generation requests
+# concurrent requests with the same prompt and sampling parameters attach to
+# one running generation and all read its stream; the generation is
+# cancelled only when every attached request has gone
+import threading
+
+from core.cancellation import CancelToken, finish_text
+
+
+def generation_key(prompt, max_tokens, temperature, top_p, seed, model=None, requester=None):
+    # SingleFlight key of a generation request
+    # with random sampling (temperature > 0, no seed) another request must get
+    # its own sample: only the same requester (e.g. user + conversation
+    # sending twice) shares the running generation
+    key = (prompt, max_tokens, temperature, top_p, seed, model)
+    if temperature > 0 and seed is None:
+        key += (requester,)
+    return key
+
+
+class Flight:
+    # one running generation shared by identical requests
+    # the producer publishes deltas and finishes it; waiters read stream()/wait()
+
+    def __init__(self, key, owner, token):
+        self.key = key
+        self.waiters = 1
+        self.token = token      # CancelToken of the generation, cancelled when the last waiter left
+        self.future = None      # scheduler Future of the producing job
+        self.origin = None      # caller-defined id of the request that started it
+        self._owner = owner
+        self._deltas = []       # everything generated so far (late joiners replay it)
+        self._done = False
+        self._error = None
+        self._cond = threading.Condition()
+
+    @property
+    def cancelled(self):
+        return self.token.cancelled
+
+    def publish(self, delta):
+        with self._cond:
+            self._deltas.append(delta)
+            self._cond.notify_all()
+
+    def finish(self, error=None):
+        with self._cond:
+            self._done = True
+            self._error = error
+            self._cond.notify_all()
+        self._owner._finished(self)
+
+    def stream(self):
+        # every delta from the start, raises the producer's error at the end
+        sent = 0
+        while True:
+            with self._cond:
+                while sent == len(self._deltas) and not self._done:
+                    self._cond.wait()
+                pending = self._deltas[sent:]
+                done = self._done
+            for delta in pending:
+                yield delta
+            sent += len(pending)
+            if done and sent == len(self._deltas):
+                break
+        if self._error is not None:
+            raise self._error
+
+    def wait(self):
+        # full text once the generation finished (PartialResponse if it stopped early)
+        return finish_text("".join(self.stream()).strip(), self.token)
+
+
+class SingleFlight:
+    # key -> running Flight
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.stats = {"started": 0, "joined": 0, "cancelled": 0}
+
+    def join(self, key, start, timeout=None):
+        # attach to the running flight of key, or create one and call
+        # start(flight) to launch its producer (errors propagate, nothing is kept)
+        # timeout: wall-clock deadline of a new flight's token
+        # returns (flight, started); call leave(flight) when done reading
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None and not flight.cancelled:
+                flight.waiters += 1
+                self.stats["joined"] += 1
+                return flight, False
+            flight = Flight(key, self, CancelToken(timeout=timeout))
+            self._flights[key] = flight
+        try:
+            start(flight)
+        except BaseException:
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            raise
+        with self._lock:
+            self.stats["started"] += 1
+        return flight, True
+
+    def leave(self, flight):
+        # a waiter is gone (finished reading or disconnected)
+        with self._lock:
+            flight.waiters -= 1
+            if flight.waiters > 0 or flight._done:
+                return
+            # nobody reads this generation anymore
+            flight.token.cancel()
+            self.stats["cancelled"] += 1
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+        if flight.future is not None:
+            flight.future.cancel()  # still queued: never runs
+
+    def _finished(self, flight):
+        # finished flights are not joined anymore (the answer caches take over)
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats, in_flight=len(self._flights))
@@ -0,0 +1,121 @@
+# speculative decoding with a small draft GGUF model
+# the draft proposes k tokens greedily; llama evaluates them with the main
+# model in one batch and samples every position from the main model's own
+# logits, keeping a draft token only when it equals that sample. the output
+# therefore has exactly the distribution of normal sampling, the draft only
+# decides how many tokens one main-model pass can produce
+import time
+import logging
+
+import numpy as np
+from llama_cpp import Llama
+from llama_cpp.llama_speculative import LlamaDraftModel
+
+
+class GGUFDraftModel(LlamaDraftModel):
+    # draft side of llama's speculative loop (Llama(draft_model=...))
+    # k adapts to the acceptance measured on the previous proposal:
+    # everything accepted -> k + 1, otherwise k shrinks to what was accepted + 1
+
+    def __init__(self, model_path, n_ctx=2048, n_threads=4, n_batch=64, max_k=8):
+        self.llm = Llama(
+            model_path=model_path,
+            n_ctx=n_ctx,
+            n_threads=n_threads,
+            n_batch=n_batch,
+            verbose=False
+        )
+        self.max_k = max(1, max_k)
+        self.k = max(1, self.max_k // 2)
+        self._n_vocab = self.llm.n_vocab()
+        self._eos = self.llm.token_eos()
+        self._base = None      # input ids the last proposal continued
+        self._proposal = []
+        self.stats = {"passes": 0, "proposed": 0, "accepted": 0, "draft_time": 0.0}
+
+    def __call__(self, input_ids, /, **kwargs):
+        started = time.perf_counter()
+        self._measure(input_ids)
+        ids = input_ids.tolist()
+        llm = self.llm
+
+        # reuse the draft kv cache for the common prefix (previous proposal
+        # tokens after a rejection are dropped by eval)
+        cached = llm.input_ids[:llm.n_tokens].tolist()
+        limit = min(len(cached), len(ids) - 1)
+        prefix = 0
+        while prefix < limit and cached[prefix] == ids[prefix]:
+            prefix += 1
+        llm.n_tokens = prefix
+        llm.eval(ids[prefix:])
+
+        proposal = []
+        room = llm.n_ctx() - llm.n_tokens - 1
+        for _ in range(min(self.k, room)):
+            token = self._greedy()
+            if token == self._eos:
+                break
+            proposal.append(token)
+            llm.eval([token])
+
+        self._base = ids
+        self._proposal = proposal
+        self.stats["draft_time"] += time.perf_counter() - started
+        return np.array(proposal, dtype=np.intc)
+
+    def _greedy(self):
+        # most likely next token (only the last evaluated position has logits)
+        logits = np.ctypeslib.as_array(self.llm._ctx.get_logits(), shape=(self._n_vocab,))
+        return int(np.argmax(logits))
+
+    def _measure(self, input_ids):
+        # how much of the previous proposal the main model kept
+        # input_ids = previous context + accepted tokens + one sampled token
+        base, proposal = self._base, self._proposal
+        self._base, self._proposal = None, []
+        if base is None or not proposal or len(input_ids) <= len(base):
+            return
+        if input_ids[len(base) - 1] != base[-1]:
+            return  # another generation started
+        new = input_ids[len(base):len(base) + len(proposal)].tolist()
+        accepted = 0
+        while accepted < len(new) and new[accepted] == proposal[accepted]:
+            accepted += 1
+
+        self.stats["passes"] += 1
+        self.stats["proposed"] += len(proposal)
+        self.stats["accepted"] += accepted
+        if accepted == len(proposal):
+            self.k = min(self.max_k, self.k + 1)
+        else:
+            self.k = max(1, accepted + 1)
+
+    def reset_stats(self):
+        self.stats = {"passes": 0, "proposed": 0, "accepted": 0, "draft_time": 0.0}
+
+    def get_stats(self):
+        passes = self.stats["passes"]
+        proposed = self.stats["proposed"]
+        return dict(
+            self.stats,
+            k=self.k,
+            acceptance_rate=self.stats["accepted"] / proposed if proposed else 0.0,
+            # tokens produced per main-model pass (1.0 = no gain from the draft)
+            tokens_per_pass=(self.stats["accepted"] + passes) / passes if passes else 1.0,
+            draft_ms_per_pass=self.stats["draft_time"] * 1000 / passes if passes else 0.0
+        )
+
+
+def create_draft_model(conf):
+    # GGUFDraftModel from DRAFT_MODEL_PATH, None when speculative decoding is off
+    path = conf.get('draft_model_path')
+    if not path:
+        return None
+    logging.info(f"Speculative decoding: draft model {path}, k <= {conf.get('draft_max_k', 8)}")
+    return GGUFDraftModel(
+        path,
+        n_ctx=conf.get('n_ctx', 2048),
+        n_threads=conf.get('n_threads', 4),
+        n_batch=max(conf.get('n_batch', 16), 64),
+        max_k=conf.get('draft_max_k', 8)
+    )
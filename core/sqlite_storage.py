@@ -0,0 +1,441 @@
+# sqlite storage backend
+# one local file, no database server: WAL journal so readers never wait for
+# the writer, one connection per thread, writes batched into transactions
+import uuid
+import atexit
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from werkzeug.security import generate_password_hash, check_password_hash
+
+from core.storage import ChatStorage, TITLE_LENGTH, SNIPPET_OPEN, SNIPPET_CLOSE, SNIPPET_WORDS
+from core.write_behind import WriteBehindQueue
+
+SCHEMA_VERSION = 4
+BUSY_TIMEOUT = 5.0             # giây chờ khi file đang bị khóa ghi
+STATEMENT_CACHE = 128          # số câu lệnh đã biên dịch giữ lại mỗi kết nối
+
+# Ghi tin nhắn theo lô ở luồng nền, mỗi lô là một transaction
+WRITE_BATCH_SIZE = 50
+WRITE_FLUSH_INTERVAL = 0.2
+WRITE_MAX_PENDING = 10000
+WRITE_SPILL_FILE = "cache/pending_writes_sqlite.jsonl"
+
+SCHEMA = [
+    # bảng cũ (id, timestamp, user_message, assistant_response, conversation_id)
+    # được giữ nguyên, các cột mới thêm bằng _migrate
+    """CREATE TABLE IF NOT EXISTS chat_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        timestamp TEXT NOT NULL,
+        user_message TEXT NOT NULL,
+        assistant_response TEXT NOT NULL,
+        conversation_id TEXT,
+        owner TEXT NOT NULL DEFAULT 'local',
+        msg_key TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS conversations (
+        owner TEXT NOT NULL,
+        conversation_id TEXT NOT NULL,
+        title TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        last_activity TEXT NOT NULL,
+        message_count INTEGER NOT NULL DEFAULT 0,
+        version INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (owner, conversation_id)
+    ) WITHOUT ROWID""",
+    # phiên bản danh sách cuộc trò chuyện của mỗi user (đồng bộ delta)
+    """CREATE TABLE IF NOT EXISTS sync_state (
+        owner TEXT PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0,
+        reset_version INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID""",
+    """CREATE TABLE IF NOT EXISTS users (
+        username TEXT PRIMARY KEY,
+        password TEXT NOT NULL,
+        created_at TEXT NOT NULL
+    )""",
+]
+
+INDEXES = [
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_chat_key ON chat_history (msg_key)",
+    "CREATE INDEX IF NOT EXISTS idx_chat_conv ON chat_history (owner, conversation_id, timestamp, msg_key)",
+    "CREATE INDEX IF NOT EXISTS idx_conv_activity ON conversations (owner, last_activity DESC)",
+    "CREATE INDEX IF NOT EXISTS idx_conv_version ON conversations (owner, version)",
+]
+
+# Chỉ mục toàn văn (external content: không lưu lại nội dung tin nhắn),
+# đồng bộ với chat_history bằng trigger. Cột owner_tag là một token duy nhất
+# cho mỗi user ('u' + hex của username) để truy vấn chỉ chạm tới tin nhắn của user
+FTS_SCHEMA = [
+    """CREATE VIEW IF NOT EXISTS chat_fts_source AS
+        SELECT id, user_message, assistant_response, 'u' || hex(owner) AS owner_tag FROM chat_history""",
+    """CREATE VIRTUAL TABLE IF NOT EXISTS chat_fts USING fts5(
+        user_message, assistant_response, owner_tag,
+        content='chat_fts_source', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2',
+        prefix='2 3'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS chat_fts_insert AFTER INSERT ON chat_history BEGIN
+        INSERT INTO chat_fts (rowid, user_message, assistant_response, owner_tag)
+        VALUES (new.id, new.user_message, new.assistant_response, 'u' || hex(new.owner));
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS chat_fts_delete AFTER DELETE ON chat_history BEGIN
+        INSERT INTO chat_fts (chat_fts, rowid, user_message, assistant_response, owner_tag)
+        VALUES ('delete', old.id, old.user_message, old.assistant_response, 'u' || hex(old.owner));
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS chat_fts_update AFTER UPDATE ON chat_history BEGIN
+        INSERT INTO chat_fts (chat_fts, rowid, user_message, assistant_response, owner_tag)
+        VALUES ('delete', old.id, old.user_message, old.assistant_response, 'u' || hex(old.owner));
+        INSERT INTO chat_fts (rowid, user_message, assistant_response, owner_tag)
+        VALUES (new.id, new.user_message, new.assistant_response, 'u' || hex(new.owner));
+    END""",
+]
+
+# chỉ mục của các phiên bản cũ (v2, v3: không có owner_tag) bị xóa rồi tạo lại
+FTS_DROP = [
+    "DROP TRIGGER IF EXISTS chat_fts_insert",
+    "DROP TRIGGER IF EXISTS chat_fts_delete",
+    "DROP TRIGGER IF EXISTS chat_fts_update",
+    "DROP TABLE IF EXISTS chat_fts",
+]
+
+MESSAGE_COLUMNS = "msg_key, timestamp, user_message, assistant_response, conversation_id, owner"
+
+INSERT_MESSAGE = f"INSERT OR IGNORE INTO chat_history ({MESSAGE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)"
+
+UPSERT_CONVERSATION = """
+    INSERT INTO conversations (owner, conversation_id, title, created_at, last_activity, message_count, version)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (owner, conversation_id) DO UPDATE SET
+        last_activity = max(last_activity, excluded.last_activity),
+        message_count = message_count + excluded.message_count,
+        version = excluded.version
+"""
+
+# tăng phiên bản của user; reset_version đánh dấu lần xóa toàn bộ gần nhất
+BUMP_VERSION = """
+    INSERT INTO sync_state (owner, version) VALUES (?, 1)
+    ON CONFLICT (owner) DO UPDATE SET version = version + 1
+"""
+
+REBUILD_CONVERSATIONS = f"""
+    INSERT OR REPLACE INTO conversations (owner, conversation_id, title, created_at, last_activity, message_count)
+    SELECT c.owner, c.conversation_id,
+           (SELECT substr(f.user_message, 1, {TITLE_LENGTH}) FROM chat_history f
+             WHERE f.owner = c.owner AND f.conversation_id = c.conversation_id
+             ORDER BY f.timestamp, f.msg_key LIMIT 1),
+           min(c.timestamp), max(c.timestamp), count(*)
+    FROM chat_history c
+    GROUP BY c.owner, c.conversation_id
+"""
+
+SELECT_CONVERSATIONS = """
+    SELECT conversation_id, title, last_activity FROM conversations
+    WHERE owner = ? ORDER BY last_activity DESC
+"""
+
+SELECT_CHANGED_CONVERSATIONS = """
+    SELECT conversation_id, title, last_activity FROM conversations
+    WHERE owner = ? AND version > ? ORDER BY last_activity DESC
+"""
+
+SELECT_SYNC_STATE = "SELECT version, reset_version FROM sync_state WHERE owner = ?"
+
+SELECT_MESSAGE_COUNT = "SELECT message_count FROM conversations WHERE owner = ? AND conversation_id = ?"
+
+SELECT_MESSAGES = f"""
+    SELECT {MESSAGE_COLUMNS} FROM chat_history
+    WHERE owner = ? AND conversation_id = ?
+    ORDER BY timestamp, msg_key
+"""
+
+SELECT_PAGE = f"""
+    SELECT {MESSAGE_COLUMNS} FROM chat_history
+    WHERE owner = ? AND conversation_id = ?
+    ORDER BY timestamp DESC, msg_key DESC LIMIT ?
+"""
+
+SELECT_PAGE_BEFORE = f"""
+    SELECT {MESSAGE_COLUMNS} FROM chat_history
+    WHERE owner = ? AND conversation_id = ? AND (timestamp, msg_key) < (?, ?)
+    ORDER BY timestamp DESC, msg_key DESC LIMIT ?
+"""
+
+# Bước 1: xếp hạng bm25 (câu hỏi của user nặng gấp đôi câu trả lời) trên mọi
+# tin nhắn khớp của user; owner_tag trong MATCH nên không chấm điểm tin nhắn của
+# user khác, h.owner kiểm tra lại cho chắc
+SEARCH_RANK = """
+    SELECT f.rowid AS id
+    FROM chat_fts f JOIN chat_history h ON h.id = f.rowid
+    WHERE chat_fts MATCH ? AND h.owner = ?
+    ORDER BY bm25(chat_fts, 2.0, 1.0, 0.0) LIMIT ? OFFSET ?
+"""
+
+# Bước 2: snippet chỉ cho các tin nhắn của trang kết quả
+SEARCH_ROW = """
+    SELECT h.msg_key, h.conversation_id, h.timestamp, c.title,
+           snippet(chat_fts, -1, ?, ?, '…', ?) AS snippet
+    FROM chat_fts
+    JOIN chat_history h ON h.id = chat_fts.rowid
+    LEFT JOIN conversations c ON c.owner = h.owner AND c.conversation_id = h.conversation_id
+    WHERE chat_fts MATCH ? AND chat_fts.rowid = ?
+"""
+
+
+def _fts_query(terms):
+    # every term quoted (no FTS syntax from users), the last one as a prefix
+    # so results show up while typing; only the message columns are searched
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += "*"
+    return "{user_message assistant_response} : (" + " ".join(quoted) + ")"
+
+
+def _owner_tag(username):
+    # same value as 'u' || hex(owner) in FTS_SCHEMA
+    return "u" + username.encode("utf-8").hex().upper()
+
+
+def _to_text(value):
+    return value.isoformat(timespec="microseconds")
+
+
+def _to_datetime(text):
+    return datetime.fromisoformat(text)
+
+
+def _doc(row):
+    return {
+        "_id": row["msg_key"],
+        "timestamp": _to_datetime(row["timestamp"]),
+        "user_message": row["user_message"],
+        "assistant_response": row["assistant_response"],
+        "conversation_id": row["conversation_id"],
+        "owner": row["owner"]
+    }
+
+
+class SQLiteStorage(ChatStorage):
+    # same behaviour as MongoDBManager on a local sqlite file
+
+    def __init__(self, path="chat_history.db", spill_path=None):
+        # spill_path: file for messages the database could not take (default WRITE_SPILL_FILE)
+        self.path = path
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self.has_fts = False
+        self._migrate()
+
+        # save_message chỉ xếp hàng, luồng nền ghi mỗi lô trong một transaction
+        self.writer = WriteBehindQueue(
+            self._write_batch,
+            batch_size=WRITE_BATCH_SIZE,
+            flush_interval=WRITE_FLUSH_INTERVAL,
+            max_pending=WRITE_MAX_PENDING,
+            spill_path=spill_path or WRITE_SPILL_FILE
+        )
+        atexit.register(self.close)
+        print(f"[{datetime.now()}] Đã mở SQLite: {path}")
+
+    def _conn(self):
+        # sqlite3 connections cannot be shared between threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # isolation_level=None: tự quản lý transaction (BEGIN/COMMIT)
+            conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None,
+                                   cached_statements=STATEMENT_CACHE, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")  # WAL: chỉ fsync khi checkpoint
+            conn.execute("PRAGMA temp_store=MEMORY")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _migrate(self):
+        """Tạo bảng/index (idempotent) và nâng cấp file chat_history.db cũ"""
+        conn = self._conn()
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        with self._transaction():
+            for statement in SCHEMA:
+                conn.execute(statement)
+            if version < 1:
+                columns = {row["name"] for row in conn.execute("PRAGMA table_info(chat_history)")}
+                if "owner" not in columns:
+                    # tin nhắn cũ thuộc về user của GUI offline
+                    conn.execute("ALTER TABLE chat_history ADD COLUMN owner TEXT NOT NULL DEFAULT 'local'")
+                if "msg_key" not in columns:
+                    conn.execute("ALTER TABLE chat_history ADD COLUMN msg_key TEXT")
+                conn.execute("UPDATE chat_history SET msg_key = 'legacy' || id WHERE msg_key IS NULL")
+                conn.execute("UPDATE chat_history SET conversation_id = 'legacy' WHERE conversation_id IS NULL")
+            if version < 3:
+                columns = {row["name"] for row in conn.execute("PRAGMA table_info(conversations)")}
+                if "version" not in columns:
+                    conn.execute("ALTER TABLE conversations ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+            for statement in INDEXES:
+                conn.execute(statement)
+            if version < 1:
+                conn.execute(REBUILD_CONVERSATIONS)
+
+        try:
+            indexed = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'chat_fts'").fetchone()
+            with self._transaction():
+                if indexed and version < 4:
+                    # v2 thêm chỉ mục tiền tố (prefix) cho tìm kiếm khi đang gõ,
+                    # v4 thêm owner_tag
+                    for statement in FTS_DROP:
+                        conn.execute(statement)
+                    indexed = None
+                for statement in FTS_SCHEMA:
+                    conn.execute(statement)
+                if not indexed:
+                    # đánh chỉ mục các tin nhắn có sẵn
+                    conn.execute("INSERT INTO chat_fts (chat_fts) VALUES ('rebuild')")
+            self.has_fts = True
+        except sqlite3.OperationalError as e:
+            # sqlite build không có FTS5: vẫn chạy, chỉ không tìm kiếm được
+            print(f"Không tạo được chỉ mục FTS5: {e}")
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    # --- QUẢN LÝ USER ---
+    def register_user(self, username, password):
+        """Đăng ký user mới"""
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO users (username, password, created_at) VALUES (?, ?, ?)",
+                (username, generate_password_hash(password), _to_text(datetime.now())))
+            if cursor.rowcount == 0:
+                return False, "Tài khoản đã tồn tại!"
+        return True, "Đăng ký thành công!"
+
+    def login_user(self, username, password):
+        """Kiểm tra đăng nhập"""
+        row = self._conn().execute("SELECT password FROM users WHERE username = ?", (username,)).fetchone()
+        return bool(row) and check_password_hash(row["password"], password)
+
+    # --- QUẢN LÝ CHAT ---
+    def save_message(self, user_msg, assistant_resp, conv_id, username):
+        """Lưu tin nhắn kèm theo username người sở hữu (ghi nền, không chờ DB)"""
+        doc = {
+            "_id": uuid.uuid4().hex,  # tạo sẵn để ghi lại từ file tạm không bị trùng
+            "timestamp": datetime.now(),
+            "user_message": user_msg,
+            "assistant_response": assistant_resp,
+            "conversation_id": conv_id,
+            "owner": username
+        }
+        try:
+            self.writer.put(doc)
+        except Exception as e:
+            print(f"Lỗi lưu: {e}")
+        self._invalidate(username, conv_id)
+
+    def _bump_version(self, conn, username):
+        conn.execute(BUMP_VERSION, (username,))
+        return conn.execute(SELECT_SYNC_STATE, (username,)).fetchone()["version"]
+
+    def _write_batch(self, docs):
+        """Ghi một lô tin nhắn và bảng tóm tắt trong cùng một transaction"""
+        summaries = {}
+        with self._transaction() as conn:
+            for doc in docs:
+                cursor = conn.execute(INSERT_MESSAGE, (
+                    doc["_id"], _to_text(doc["timestamp"]), doc["user_message"] or "",
+                    doc["assistant_response"] or "", doc["conversation_id"], doc["owner"]))
+                if cursor.rowcount == 0:
+                    continue  # đã ghi từ trước (phát lại file tạm)
+                key = (doc["owner"], doc["conversation_id"])
+                if key not in summaries:
+                    summaries[key] = [doc, doc["timestamp"], 0]
+                summary = summaries[key]
+                summary[1] = max(summary[1], doc["timestamp"])
+                summary[2] += 1
+            # một phiên bản mới cho mỗi user có thay đổi trong lô
+            versions = {owner: self._bump_version(conn, owner) for owner, _ in summaries}
+            conn.executemany(UPSERT_CONVERSATION, [
+                (owner, conv_id, (first["user_message"] or "")[:TITLE_LENGTH],
+                 _to_text(first["timestamp"]), _to_text(last_activity), count, versions[owner])
+                for (owner, conv_id), (first, last_activity, count) in summaries.items()
+            ])
+        # bảng tóm tắt đã đổi (last_activity, thứ tự sidebar)
+        for owner, conv_id in summaries:
+            self._invalidate(owner, conv_id)
+
+    def _read_conversations(self, username, since=None):
+        if since is None:
+            rows = self._conn().execute(SELECT_CONVERSATIONS, (username,))
+        else:
+            rows = self._conn().execute(SELECT_CHANGED_CONVERSATIONS, (username, since))
+        return [
+            {"id": row["conversation_id"], "title": row["title"], "last_activity": _to_datetime(row["last_activity"])}
+            for row in rows
+        ]
+
+    def _read_sync_state(self, username):
+        row = self._conn().execute(SELECT_SYNC_STATE, (username,)).fetchone()
+        return (row["version"], row["reset_version"]) if row else (0, 0)
+
+    def _read_message_count(self, conv_id, username):
+        row = self._conn().execute(SELECT_MESSAGE_COUNT, (username, conv_id)).fetchone()
+        return row["message_count"] if row else 0
+
+    def _read_messages(self, conv_id, username):
+        return [_doc(row) for row in self._conn().execute(SELECT_MESSAGES, (username, conv_id))]
+
+    def _read_page(self, conv_id, username, before, limit):
+        if before is None:
+            rows = self._conn().execute(SELECT_PAGE, (username, conv_id, limit))
+        else:
+            ts, key = before
+            rows = self._conn().execute(SELECT_PAGE_BEFORE, (username, conv_id, _to_text(ts), key, limit))
+        return [_doc(row) for row in rows]
+
+    def _search(self, username, terms, offset, limit):
+        if not self.has_fts:
+            return []
+        conn = self._conn()
+        query = _fts_query(terms)
+        scoped = f'owner_tag : "{_owner_tag(username)}" AND {query}'
+        ids = [row["id"] for row in conn.execute(SEARCH_RANK, (scoped, username, limit, offset))]
+        results = []
+        for rowid in ids:
+            row = conn.execute(SEARCH_ROW, (SNIPPET_OPEN, SNIPPET_CLOSE, SNIPPET_WORDS, query, rowid)).fetchone()
+            results.append({"id": row["msg_key"], "conversation_id": row["conversation_id"],
+                            "title": row["title"] or "", "timestamp": _to_datetime(row["timestamp"]),
+                            "snippet": row["snippet"]})
+        return results
+
+    def delete_all_conversations(self, username):
+        """Xóa lịch sử của riêng user"""
+        # không lô nào đang ghi trong lúc xóa; bỏ tin nhắn đang chờ và trong file tạm
+        # của user để chúng không bị ghi lại sau khi xóa
+        with self.writer.exclusive():
+            self.writer.discard(lambda d: d["owner"] == username)
+            with self._transaction() as conn:
+                conn.execute("DELETE FROM chat_history WHERE owner = ?", (username,))
+                conn.execute("DELETE FROM conversations WHERE owner = ?", (username,))
+                version = self._bump_version(conn, username)
+                conn.execute("UPDATE sync_state SET reset_version = ? WHERE owner = ?", (version, username))
+        self._invalidate(username)
+
+    def close(self):
+        """Ghi hết hàng đợi rồi đóng các kết nối"""
+        super().close()
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
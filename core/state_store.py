@@ -0,0 +1,201 @@
+# state store for llama context snapshots
+# keeps hot conversation states in RAM (LRU), spills colder ones to disk
+import os
+import pickle
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+
+class ModelStateStore:
+    # per-conversation model state snapshots with RAM/disk tiering
+
+    def __init__(self, ram_budget_mb=1024, disk_dir="cache/states", disk_budget_mb=4096):
+        self.ram_budget = int(ram_budget_mb * 1024 * 1024)
+        self.disk_budget = int(disk_budget_mb * 1024 * 1024)
+        self.disk_dir = disk_dir
+
+        self._ram = OrderedDict()   # conv_id -> (state, size), oldest first
+        self._ram_bytes = 0
+        self._disk = OrderedDict()  # conv_id -> (file path, size), oldest first
+        self._disk_bytes = 0        # includes states in self._writing
+        self._writing = {}          # conv_id -> (state, size, file path) being written
+        self._seq = 0
+        self._lock = threading.Lock()
+        self.stats = {"ram_hits": 0, "disk_hits": 0, "misses": 0, "spills": 0, "dropped": 0}
+
+        if self.disk_dir and self.disk_budget > 0:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._scan_disk()
+
+    def _scan_disk(self):
+        # old files from a previous run can't be mapped back to ids, remove them
+        for name in os.listdir(self.disk_dir):
+            if name.endswith(".state") or name.endswith(".tmp"):
+                try:
+                    os.remove(os.path.join(self.disk_dir, name))
+                except OSError:
+                    pass
+
+    @staticmethod
+    def state_size(state):
+        # approximate memory used by a llama state
+        size = getattr(state, 'llama_state_size', 0) or 0
+        for attr in ('input_ids', 'scores'):
+            arr = getattr(state, attr, None)
+            size += getattr(arr, 'nbytes', 0)
+        return size or len(pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def _file_for(self, conv_id):
+        # a new file per write: a write still running never races a newer one
+        self._seq += 1
+        digest = hashlib.sha1(str(conv_id).encode("utf-8")).hexdigest()
+        return os.path.join(self.disk_dir, f"{digest}-{self._seq}.state")
+
+    # pickling and file I/O run outside self._lock; while a state is being
+    # written it stays in self._writing, so take() still finds it
+
+    def put(self, conv_id, state):
+        # store snapshot for a conversation, replacing the old one
+        size = self.state_size(state)
+        with self._lock:
+            stale = self._remove(conv_id)
+            spills = []
+            if size > self.ram_budget:
+                spills.append((conv_id, state, size))
+            else:
+                self._ram[conv_id] = (state, size)
+                self._ram_bytes += size
+                # move least recently used states to disk until we fit
+                while self._ram_bytes > self.ram_budget and self._ram:
+                    old_id, (old_state, old_size) = self._ram.popitem(last=False)
+                    self._ram_bytes -= old_size
+                    spills.append((old_id, old_state, old_size))
+            writes = [w for w in (self._reserve(*spill, stale) for spill in spills) if w]
+        self._delete_files(stale)
+        for write in writes:
+            self._write(*write)
+
+    def take(self, conv_id):
+        # get snapshot and remove it from the store (the live context owns it now)
+        with self._lock:
+            if conv_id in self._ram:
+                state, size = self._ram.pop(conv_id)
+                self._ram_bytes -= size
+                self.stats["ram_hits"] += 1
+                return state
+
+            if conv_id in self._writing:
+                # still being written: the writer deletes its file
+                state, size, _ = self._writing.pop(conv_id)
+                self._disk_bytes -= size
+                self.stats["ram_hits"] += 1
+                return state
+
+            if conv_id not in self._disk:
+                self.stats["misses"] += 1
+                return None
+            path, size = self._disk.pop(conv_id)
+            self._disk_bytes -= size
+
+        try:
+            with open(path, 'rb') as f:
+                state = pickle.load(f)
+        except Exception as e:
+            logging.error(f"Lỗi đọc state {conv_id}: {e}")
+            state = None
+        finally:
+            self._delete_files([path])
+        with self._lock:
+            self.stats["disk_hits" if state is not None else "misses"] += 1
+        return state
+
+    def discard(self, conv_id):
+        # forget a conversation (deleted / cleared)
+        with self._lock:
+            stale = self._remove(conv_id)
+        self._delete_files(stale)
+
+    def clear(self):
+        with self._lock:
+            stale = []
+            for conv_id in list(self._ram) + list(self._writing) + list(self._disk):
+                stale.extend(self._remove(conv_id))
+        self._delete_files(stale)
+
+    def _remove(self, conv_id):
+        # drop a conversation under self._lock, returns files to delete afterwards
+        if conv_id in self._ram:
+            _, size = self._ram.pop(conv_id)
+            self._ram_bytes -= size
+        if conv_id in self._writing:
+            _, size, _ = self._writing.pop(conv_id)
+            self._disk_bytes -= size
+        if conv_id in self._disk:
+            path, size = self._disk.pop(conv_id)
+            self._disk_bytes -= size
+            return [path]
+        return []
+
+    @staticmethod
+    def _delete_files(paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _reserve(self, conv_id, state, size, stale):
+        # make room on disk for a state (under self._lock, dropping the oldest
+        # files over the cap into stale); returns the write to run or None
+        if not self.disk_dir or size > self.disk_budget:
+            self.stats["dropped"] += 1
+            return None
+
+        while self._disk_bytes + size > self.disk_budget and self._disk:
+            stale.extend(self._remove(next(iter(self._disk))))
+            self.stats["dropped"] += 1
+        if self._disk_bytes + size > self.disk_budget:
+            # the rest of the cap is held by writes still running
+            self.stats["dropped"] += 1
+            return None
+
+        entry = (state, size, self._file_for(conv_id))
+        self._writing[conv_id] = entry
+        self._disk_bytes += size
+        return conv_id, entry
+
+    def _write(self, conv_id, entry):
+        # pickle a reserved state to its file, then publish it in self._disk
+        state, size, path = entry
+        tmp_path = path + ".tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+            written = True
+        except Exception as e:
+            logging.error(f"Lỗi ghi state {conv_id}: {e}")
+            self._delete_files([tmp_path])
+            written = False
+
+        with self._lock:
+            # not ours anymore: taken, replaced or discarded while writing
+            ours = self._writing.get(conv_id) is entry
+            if ours:
+                del self._writing[conv_id]
+                if written:
+                    self._disk[conv_id] = (path, size)
+                    self.stats["spills"] += 1
+                else:
+                    self._disk_bytes -= size
+                    self.stats["dropped"] += 1
+        if written and not ours:
+            self._delete_files([path])
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats,
+                        ram_items=len(self._ram), ram_bytes=self._ram_bytes, writing=len(self._writing),
+                        disk_items=len(self._disk), disk_bytes=self._disk_bytes)
@@ -0,0 +1,259 @@
+# chat storage interface
+# web app and GUI only talk to this interface, the backend is chosen in config
+import re
+import unicodedata
+from datetime import datetime
+
+from core.read_cache import ReadCache
+
+TITLE_LENGTH = 40
+PAGE_SIZE = 20  # số tin nhắn mỗi trang khi tải lịch sử
+
+# Tìm kiếm toàn văn
+SEARCH_PAGE_SIZE = 20
+SNIPPET_OPEN = "\x02"   # đánh dấu từ khớp trong snippet, web app đổi thành <mark>
+SNIPPET_CLOSE = "\x03"
+SNIPPET_WORDS = 12       # số từ quanh chỗ khớp
+
+
+def search_terms(query):
+    # words of a user query, any search syntax is dropped
+    return re.findall(r"\w+", query.lower())[:16]
+
+
+def _fold(word):
+    # so sánh không dấu, không phân biệt hoa thường
+    decomposed = unicodedata.normalize("NFD", word.casefold())
+    return "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+
+
+def make_snippet(text, terms, words=SNIPPET_WORDS):
+    # window of words around the first match, matches wrapped in SNIPPET_OPEN/CLOSE
+    # (for backends whose index cannot build snippets itself)
+    folded_terms = {_fold(term) for term in terms}
+    tokens = re.findall(r"\w+|\W+", text)
+    word_positions = [i for i, token in enumerate(tokens) if token[0].isalnum() or token[0] == "_"]
+    hits = [n for n, i in enumerate(word_positions) if _fold(tokens[i]) in folded_terms]
+    if not word_positions:
+        return ""
+    first = max(0, (hits[0] if hits else 0) - words // 3)
+    last = min(len(word_positions), first + words)
+    hit_tokens = {word_positions[n] for n in hits}
+    parts = []
+    for i in range(word_positions[first], word_positions[last - 1] + 1):
+        parts.append(f"{SNIPPET_OPEN}{tokens[i]}{SNIPPET_CLOSE}" if i in hit_tokens else tokens[i])
+    snippet = "".join(parts)
+    if first > 0:
+        snippet = "…" + snippet
+    if last < len(word_positions):
+        snippet += "…"
+    return snippet
+
+
+class ChatStorage:
+    # users, messages and the per-conversation summary of one backend
+    # messages are dicts: _id, timestamp, user_message, assistant_response,
+    # conversation_id, owner
+    # backends queue writes in self.writer (WriteBehindQueue) and implement
+    # the _read_* methods; reads here merge in writes not flushed yet
+    # self.cache (ReadCache, optional) serves repeated reads, backends call
+    # _invalidate from their write paths
+
+    writer = None
+    cache = None
+
+    # --- QUẢN LÝ USER ---
+    def register_user(self, username, password):
+        """Đăng ký user mới, trả về (thành công, thông báo)"""
+        raise NotImplementedError
+
+    def login_user(self, username, password):
+        """Kiểm tra đăng nhập"""
+        raise NotImplementedError
+
+    # --- QUẢN LÝ CHAT ---
+    def save_message(self, user_msg, assistant_resp, conv_id, username):
+        """Lưu một cặp hỏi/đáp của user (có thể ghi nền)"""
+        raise NotImplementedError
+
+    def _pending(self, predicate):
+        return self.writer.pending(predicate) if self.writer else []
+
+    def _cached(self, key, loader):
+        return self.cache.get(key, loader) if self.cache else loader()
+
+    def _invalidate(self, username, conv_id=None):
+        if self.cache:
+            self.cache.invalidate(username, conv_id)
+
+    def get_cache_stats(self):
+        return self.cache.get_stats() if self.cache else None
+
+    def _merge_pending_conversations(self, username, conversations):
+        # Cuộc trò chuyện có tin nhắn chưa kịp ghi xuống DB lên đầu danh sách
+        known = {c["id"] for c in conversations}
+        pending = self._pending(lambda d: d["owner"] == username)
+        for doc in pending:
+            if doc["conversation_id"] not in known:
+                known.add(doc["conversation_id"])
+                conversations.insert(0, {"id": doc["conversation_id"],
+                                         "title": (doc["user_message"] or "")[:TITLE_LENGTH],
+                                         "last_activity": doc["timestamp"]})
+        return bool(pending)
+
+    def get_conversation_list(self, username):
+        """Danh sách cuộc trò chuyện của user, mới hoạt động nhất trước"""
+        def load():
+            conversations = self._read_conversations(username)
+            self._merge_pending_conversations(username, conversations)
+            return conversations
+        return self._cached(("list", username, None), load)
+
+    def has_pending_writes(self, username):
+        """User còn tin nhắn chưa ghi xuống DB (danh sách có thể đổi mà version chưa đổi)"""
+        return bool(self._pending(lambda d: d["owner"] == username))
+
+    def get_sync_version(self, username):
+        """Phiên bản danh sách cuộc trò chuyện của user (tăng sau mỗi lần ghi/xóa)"""
+        return self._read_sync_state(username)[0]
+
+    def get_conversation_changes(self, username, since=None):
+        """Các cuộc trò chuyện tạo mới/cập nhật sau phiên bản since (đồng bộ delta)
+        reset=True: client bỏ danh sách đang có (lần đầu, hoặc lịch sử đã bị xóa sau since)
+        pending=True: có tin nhắn chưa ghi xuống DB, kết quả có thể đổi dù version chưa đổi
+        Cuộc trò chuyện client đã biết chỉ cần cập nhật last_activity, tiêu đề không đổi"""
+        version, reset_version = self._read_sync_state(username)
+        reset = since is None or since < reset_version or since > version
+        changed = self._read_conversations(username, since=None if reset else since)
+        pending = self._merge_pending_conversations(username, changed)
+        return {"version": version, "changed": changed, "reset": reset, "pending": pending}
+
+    def get_messages_by_conversation_id(self, conv_id, username):
+        """Toàn bộ tin nhắn của một cuộc trò chuyện, cũ -> mới (bảo mật: phải đúng chủ sở hữu)"""
+        return self._cached(("all", username, conv_id),
+                            lambda: self._load_messages(conv_id, username))
+
+    def _load_messages(self, conv_id, username):
+        pending = self._pending(lambda d: d["conversation_id"] == conv_id and d["owner"] == username)
+        saved = self._read_messages(conv_id, username)
+        # Kèm các tin nhắn chưa kịp ghi xuống DB
+        saved_ids = {d["_id"] for d in saved}
+        return saved + [d for d in pending if d["_id"] not in saved_ids]
+
+    def get_messages_page(self, conv_id, username, before=None, limit=PAGE_SIZE):
+        """Một trang tin nhắn, mới nhất trước; before là cursor của trang trước
+        Trả về (tin nhắn cũ -> mới, cursor để lấy trang cũ hơn hoặc None)"""
+        return self._cached(("page", username, conv_id, before, limit),
+                            lambda: self._load_page(conv_id, username, before, limit))
+
+    def _load_page(self, conv_id, username, before, limit):
+        newest = []
+        if before is None:
+            # Trang đầu: kèm các tin nhắn chưa kịp ghi xuống DB
+            newest = self._pending(lambda d: d["conversation_id"] == conv_id and d["owner"] == username)[::-1]
+        else:
+            before = self._parse_cursor(before)
+        
+        saved = self._read_page(conv_id, username, before, limit + 1)
+        pending_ids = {d["_id"] for d in newest}
+        page = newest + [d for d in saved if d["_id"] not in pending_ids]
+        
+        has_more = len(page) > limit
+        page = page[:limit]
+        next_cursor = self._make_cursor(page[-1]) if has_more and page else None
+        return page[::-1], next_cursor
+
+    def get_recent_messages(self, conv_id, username, limit):
+        """Chỉ lấy phần cuối cuộc trò chuyện (dùng để nạp lại context cho model)
+        Không qua read cache: tiến trình khác có thể vừa ghi thêm tin nhắn"""
+        return self._load_page(conv_id, username, None, limit)[0]
+
+    def get_message_count(self, conv_id, username):
+        """Số tin nhắn đã lưu của cuộc trò chuyện (mọi tiến trình) kèm tin nhắn chưa ghi của tiến trình này"""
+        pending = self._pending(lambda d: d["conversation_id"] == conv_id and d["owner"] == username)
+        return self._read_message_count(conv_id, username) + len(pending)
+
+    def search_messages(self, username, query, offset=0, limit=SEARCH_PAGE_SIZE):
+        """Tìm tin nhắn của user theo chỉ mục toàn văn, liên quan nhất trước
+        Trả về (kết quả, offset trang sau hoặc None); mỗi kết quả gồm
+        id, conversation_id, title, timestamp, snippet (từ khớp nằm giữa SNIPPET_OPEN/CLOSE)"""
+        terms = search_terms(query)
+        if not terms:
+            return [], None
+        results = self._search(username, terms, offset, limit + 1)
+        has_more = len(results) > limit
+        return results[:limit], offset + limit if has_more else None
+
+    def delete_all_conversations(self, username):
+        """Xóa lịch sử của riêng user"""
+        raise NotImplementedError
+
+    def flush(self):
+        """Ghi ngay các tin nhắn đang chờ"""
+        if self.writer:
+            self.writer.flush()
+
+    def close(self):
+        """Hook khi tắt ứng dụng: ghi hết hàng đợi (phần lỗi nằm lại trong file tạm)"""
+        if self.writer:
+            self.writer.close()
+
+    # --- đọc trực tiếp từ backend (không gồm tin nhắn đang chờ) ---
+    def _read_conversations(self, username, since=None):
+        # [{"id", "title", "last_activity"}], newest activity first
+        # since: only conversations changed after that sync version
+        raise NotImplementedError
+
+    def _read_sync_state(self, username):
+        # (current sync version, version of the last delete-all), (0, 0) when unknown
+        raise NotImplementedError
+
+    def _read_message_count(self, conv_id, username):
+        # saved messages of the conversation (summary table), 0 when unknown
+        raise NotImplementedError
+
+    def _read_messages(self, conv_id, username):
+        # all saved messages, oldest first
+        raise NotImplementedError
+
+    def _read_page(self, conv_id, username, before, limit):
+        # up to limit saved messages older than before=(timestamp, id), newest first
+        raise NotImplementedError
+
+    def _search(self, username, terms, offset, limit):
+        # ranked search results, all terms must match (unflushed writes are not searched)
+        raise NotImplementedError
+
+    # cursor = "<timestamp iso>_<message id>", ids never contain "_"
+    @staticmethod
+    def _make_cursor(doc):
+        return f"{doc['timestamp'].isoformat()}_{doc['_id']}"
+
+    @staticmethod
+    def _parse_cursor(cursor):
+        # ValueError for a malformed cursor (it comes from the client)
+        timestamp, _, message_id = cursor.rpartition("_")
+        try:
+            return datetime.fromisoformat(timestamp), message_id
+        except ValueError:
+            raise ValueError(f"Cursor không hợp lệ: {cursor}") from None
+
+
+def open_storage(conf):
+    # create the backend selected by conf['storage_backend']
+    # imports are lazy so the sqlite backend works without pymongo installed
+    # conf['write_spill_path']: spill file of unwritten messages, set per
+    # worker by web_prefork.py (processes must not share it), else the backend's default
+    backend = conf.get('storage_backend', 'mongo')
+    spill_path = conf.get('write_spill_path')
+    if backend == 'sqlite':
+        from core.sqlite_storage import SQLiteStorage
+        storage = SQLiteStorage(conf['sqlite_path'], spill_path=spill_path)
+    elif backend == 'mongo':
+        from core.database_utils import MongoDBManager
+        storage = MongoDBManager(spill_path=spill_path)
+    else:
+        raise ValueError(f"STORAGE_BACKEND không hợp lệ: {backend}")
+    if conf.get('read_cache_mb'):
+        storage.cache = ReadCache(conf['read_cache_mb'], conf.get('read_cache_ttl', 30))
+    return storage
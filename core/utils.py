@@ -57,3 +57,23 @@ def get_model_info(model_path):
         }
     except Exception as e:
         return {"exists": True, "error": str(e)}
+
+
+def get_process_memory(pid=None):
+    # memory of a process in MB from /proc/<pid>/smaps_rollup (linux)
+    # rss counts shared pages fully in every process, pss splits them
+    # between the processes sharing them; None when not available
+    path = f"/proc/{pid or 'self'}/smaps_rollup"
+    fields = {"Rss": "rss", "Pss": "pss", "Shared_Clean": "shared", "Shared_Dirty": "shared",
+              "Private_Clean": "private", "Private_Dirty": "private"}
+    usage = {"rss": 0.0, "pss": 0.0, "shared": 0.0, "private": 0.0}
+    try:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                parts = line.split()
+                key = parts[0].rstrip(':')
+                if key in fields:
+                    usage[fields[key]] += int(parts[1]) / 1024  # kB -> MB
+    except (OSError, ValueError, IndexError):
+        return None
+    return usage
@@ -0,0 +1,225 @@
+# write-behind queue for database writes
+# requests only enqueue; a background thread flushes batches by size or time
+# and spills to a local file when the database is unreachable
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return {"$date": value.isoformat()}
+    return str(value)
+
+
+def _decode(obj):
+    if set(obj) == {"$date"}:
+        return datetime.fromisoformat(obj["$date"])
+    return obj
+
+
+class WriteBehindQueue:
+    # buffers documents and hands them to flush_fn(list_of_docs) in batches
+    # flush_fn raises on failure; failed batches are appended to spill_path
+    # and replayed once flushing works again
+
+    def __init__(self, flush_fn, batch_size=50, flush_interval=1.0, max_pending=10000,
+                 spill_path="cache/pending_writes.jsonl", encode_doc=None, decode_doc=None):
+        self.flush_fn = flush_fn
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.spill_path = spill_path
+        self.encode_doc = encode_doc or (lambda doc: doc)
+        self.decode_doc = decode_doc or (lambda doc: doc)
+
+        self._pending = []
+        self._writing = []  # batches being written, still visible to pending()
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()  # one flush_fn call at a time, see exclusive()
+        self._file_lock = threading.Lock()
+        self._closed = False
+        self._healthy = True
+        self.stats = {"queued": 0, "written": 0, "batches": 0, "spilled": 0, "replayed": 0, "errors": 0}
+
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def put(self, doc):
+        # enqueue one document, never blocks on the database
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Write-behind queue đã đóng")
+            self.stats["queued"] += 1
+            if len(self._pending) >= self.max_pending:
+                # buffer full: go straight to the durable spill file
+                self._spill([doc])
+                return
+            self._pending.append(doc)
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify()
+
+    def pending(self, predicate=None):
+        # documents not written yet (for read-your-writes); a document may
+        # also be in the database already while its batch is committing
+        with self._cond:
+            return [doc for doc in self._writing + self._pending if predicate is None or predicate(doc)]
+
+    @contextmanager
+    def exclusive(self):
+        # no batch is being written while inside (waits for the one in flight)
+        with self._write_lock:
+            yield
+
+    def discard(self, predicate):
+        # drop queued and spilled documents matching predicate (delete-all);
+        # call inside exclusive() so no matching batch is in flight
+        with self._cond:
+            self._pending = [doc for doc in self._pending if not predicate(doc)]
+        with self._file_lock:
+            for path in (self.spill_path, self._replay_path()):
+                if not path or not os.path.exists(path):
+                    continue
+                docs = self._read_spill(path)
+                kept = [doc for doc in docs if not predicate(doc)]
+                if len(kept) < len(docs):
+                    self._write_spill(path + ".tmp", kept, 'w')
+                    os.replace(path + ".tmp", path)
+
+    def _take_batch(self):
+        batch = self._pending[:self.batch_size]
+        del self._pending[:self.batch_size]
+        self._writing.extend(batch)
+        return batch
+
+    def _done_batch(self, batch):
+        with self._cond:
+            done = {id(doc) for doc in batch}
+            self._writing = [doc for doc in self._writing if id(doc) not in done]
+
+    def _run(self):
+        last_replay = 0.0
+        while True:
+            with self._cond:
+                if not self._closed and len(self._pending) < self.batch_size:
+                    self._cond.wait(self.flush_interval)
+                if self._closed:
+                    return
+
+            with self._write_lock:
+                with self._cond:
+                    batch = self._take_batch()
+                if batch:
+                    self._write(batch)
+                    self._done_batch(batch)
+
+            # replay spilled writes when the database looks reachable again
+            now = time.time()
+            if now - last_replay >= max(self.flush_interval * 10, 5) and self._has_spill():
+                last_replay = now
+                self.replay()
+
+    def _write(self, batch):
+        try:
+            self.flush_fn(batch)
+            self.stats["written"] += len(batch)
+            self.stats["batches"] += 1
+            self._healthy = True
+            return True
+        except Exception as e:
+            if self._healthy:
+                logging.error(f"Lỗi ghi DB, chuyển sang file tạm: {e}")
+            self._healthy = False
+            self.stats["errors"] += 1
+            self._spill(batch)
+            return False
+
+    def _replay_path(self):
+        return self.spill_path + ".replay" if self.spill_path else None
+
+    def _has_spill(self):
+        # a .replay file is left over when a replay was interrupted
+        return any(path and os.path.exists(path) and os.path.getsize(path) > 0
+                   for path in (self.spill_path, self._replay_path()))
+
+    def _read_spill(self, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            return [self.decode_doc(json.loads(line, object_hook=_decode)) for line in f if line.strip()]
+
+    def _write_spill(self, path, docs, mode='a'):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, mode, encoding='utf-8') as f:
+            for doc in docs:
+                f.write(json.dumps(self.encode_doc(doc), default=_encode, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _spill(self, docs):
+        if not self.spill_path:
+            logging.error(f"Mất {len(docs)} bản ghi (không có file tạm)")
+            return
+        if not docs:
+            return
+        with self._file_lock:
+            self._write_spill(self.spill_path, docs)
+        self.stats["spilled"] += len(docs)
+
+    def replay(self):
+        # write spilled documents back to the database, keep what still fails
+        # the .replay file is removed only after its documents were written
+        # or spilled again; writes are idempotent, so a crash in between
+        # only replays some documents twice
+        with self._write_lock:
+            replay_path = self._replay_path()
+            with self._file_lock:
+                if not self._has_spill():
+                    return 0
+                if os.path.exists(replay_path):
+                    # interrupted replay: its documents are older, keep them first
+                    if os.path.exists(self.spill_path):
+                        self._write_spill(replay_path, self._read_spill(self.spill_path))
+                        os.remove(self.spill_path)
+                else:
+                    os.replace(self.spill_path, replay_path)
+                docs = self._read_spill(replay_path)
+
+            replayed = 0
+            for start in range(0, len(docs), self.batch_size):
+                if not self._write(docs[start:start + self.batch_size]):
+                    # _write spilled this batch, put the rest back too
+                    self._spill(docs[start + self.batch_size:])
+                    break
+                replayed += len(docs[start:start + self.batch_size])
+            with self._file_lock:
+                os.remove(replay_path)
+            self.stats["replayed"] += replayed
+            return replayed
+
+    def flush(self):
+        # write everything pending now, including the batch the background
+        # thread is writing (delete-all, shutdown hook)
+        with self._write_lock:
+            while True:
+                with self._cond:
+                    batch = self._take_batch()
+                if not batch:
+                    return
+                self._write(batch)
+                self._done_batch(batch)
+
+    def close(self):
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        self.flush()
+
+    def get_stats(self):
+        with self._cond:
+            return dict(self.stats, pending=len(self._pending), healthy=self._healthy)
@@ -0,0 +1,44 @@
+# CancelToken with the simulated backend: stopped generations are partial and never cached
+from core.cancellation import CancelToken, PartialResponse, TOKEN_LIMIT, CANCELLED, DEADLINE, display_text
+from core.model_llama_cpp import ModelWrapper
+from core.response_cache import ResponseCache
+
+
+def make_model():
+    overrides = {"backend": "simulated", "sim_prompt_ms": 0, "sim_token_ms": 0, "temperature": 0,
+                 "stream": False, "state_cache": False, "semantic_cache": False}
+    return ModelWrapper(overrides, response_cache=ResponseCache(ram_mb=1))
+
+
+def test_token_reasons():
+    token = CancelToken(max_tokens=2)
+    assert not token.step()
+    assert token.step() and token.reason == TOKEN_LIMIT
+    token.cancel()  # first reason wins
+    assert token.reason == TOKEN_LIMIT
+    assert CancelToken().remaining() is None  # no deadline
+    expired = CancelToken(timeout=1e-9)
+    assert expired.cancelled and expired.reason == DEADLINE
+
+
+def test_stopped_generation_is_partial_and_not_cached():
+    model = make_model()
+    prompt = "Python list là gì?"
+    partial = model.generate(prompt, max_tokens=32, cancel=CancelToken(max_tokens=3))
+    assert isinstance(partial, PartialResponse) and partial.reason == TOKEN_LIMIT
+    assert display_text(partial).endswith("(đạt giới hạn token)")
+    assert model.response_cache.get_stats()["stores"] == 0
+
+    full = model.generate(prompt, max_tokens=32)
+    assert not getattr(full, "partial", False) and full.startswith(partial)
+    assert model.generate(prompt, max_tokens=32) == full
+    assert model.response_cache.get_stats()["ram_hits"] == 1
+
+
+def test_cancelled_before_start_returns_empty():
+    model = make_model()
+    token = CancelToken()
+    token.cancel()
+    result = model.generate("xin chào", cancel=token)
+    assert result == "" and result.reason == CANCELLED
+    assert "".join(model.generate("xin chào", stream=True, cancel=token)) == ""
@@ -0,0 +1,111 @@
+# delta sync of MongoDBManager: a reader running while the summaries are
+# being written must not skip them (fake collections, no server needed)
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip("pymongo")
+pytest.importorskip("werkzeug")
+
+from core.database_utils import MongoDBManager
+
+
+def _eval(expr, doc):
+    # the aggregation expressions used by _bump_version
+    if isinstance(expr, str) and expr.startswith("$"):
+        return doc.get(expr[1:])
+    if isinstance(expr, list):
+        return [_eval(e, doc) for e in expr]
+    if isinstance(expr, dict):
+        if "$add" in expr:
+            return sum(_eval(e, doc) for e in expr["$add"])
+        if "$ifNull" in expr:
+            value, default = expr["$ifNull"]
+            value = _eval(value, doc)
+            return _eval(default, doc) if value is None else value
+        if "$concatArrays" in expr:
+            return [x for part in expr["$concatArrays"] for x in _eval(part, doc)]
+        return {k: _eval(v, doc) for k, v in expr.items()}
+    return expr
+
+
+class FakeSync:
+    def __init__(self):
+        self.states = {}
+
+    def find_one(self, query):
+        state = self.states.get(query["owner"])
+        return dict(state) if state else None
+
+    def find_one_and_update(self, query, pipeline, upsert, return_document):
+        state = self.states.setdefault(query["owner"], {"owner": query["owner"]})
+        for stage in pipeline:
+            for field, expr in stage["$set"].items():
+                state[field] = _eval(expr, state)
+        return dict(state)
+
+    def update_one(self, query, update):
+        state = self.states[query["owner"]]
+        version = update["$pull"]["in_flight"]["version"]
+        state["in_flight"] = [e for e in state["in_flight"] if e["version"] != version]
+
+
+class FakeCursor(list):
+    def sort(self, field, direction):
+        return FakeCursor(sorted(self, key=lambda c: c[field], reverse=True))
+
+
+class FakeConversations:
+    def __init__(self):
+        self.rows = {}
+
+    def find(self, query, projection):
+        since = query.get("version", {}).get("$gt", -1)
+        return FakeCursor(dict(c) for (owner, _), c in self.rows.items()
+                          if owner == query["owner"] and c["version"] > since)
+
+
+@pytest.fixture
+def manager():
+    m = MongoDBManager.__new__(MongoDBManager)
+    m.client = object()
+    m.sync_col = FakeSync()
+    m.conv_col = FakeConversations()
+    return m
+
+
+def message(conv_id):
+    return {"owner": "alice", "conversation_id": conv_id, "user_message": conv_id,
+            "timestamp": datetime.now()}
+
+
+def test_reader_during_summary_write_does_not_skip(manager):
+    seen = {}
+
+    def write_summaries(summaries, versions):
+        # a delta reader runs between the version bump and the summary write
+        changes = manager.get_conversation_changes("alice", since=seen.get("version"))
+        seen["version"] = changes["version"]
+        for (owner, conv_id), s in summaries.items():
+            manager.conv_col.rows[(owner, conv_id)] = {
+                "conversation_id": conv_id, "title": conv_id,
+                "last_activity": s["last_activity"], "version": versions[owner]}
+
+    manager._write_summaries = write_summaries
+    manager._update_conversation_index([message("c1")])
+    manager._update_conversation_index([message("c2")])
+
+    changes = manager.get_conversation_changes("alice", since=seen["version"])
+    assert [c["id"] for c in changes["changed"]] == ["c2"]
+    assert changes["version"] == 2
+    assert manager.sync_col.states["alice"]["in_flight"] == []
+
+
+def test_failed_summary_write_releases_version(manager):
+    def fail(summaries, versions):
+        raise ConnectionError("db down")
+
+    manager._write_summaries = fail
+    with pytest.raises(ConnectionError):
+        manager._update_conversation_index([message("c1")])
+    assert manager.get_sync_version("alice") == 1
@@ -0,0 +1,68 @@
+# ReadCache: TTL, byte cap, invalidation racing a load
+import pytest
+
+from core.read_cache import ReadCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("core.read_cache.time.time", lambda: now[0])
+    return now
+
+
+def test_hit_until_ttl_expires(clock):
+    cache = ReadCache(ttl=30)
+    loads = []
+
+    def load():
+        loads.append(1)
+        return ["tin 1"]
+
+    key = ("messages", "alice", "c1")
+    assert cache.get(key, load) == ["tin 1"]
+    assert cache.get(key, load) == ["tin 1"]
+    assert len(loads) == 1
+    clock[0] += 31
+    cache.get(key, load)
+    assert len(loads) == 2
+    assert cache.get_stats()["expired"] == 1
+
+
+def test_invalidate_scopes_to_conversation_and_lists():
+    cache = ReadCache()
+    for key in (("messages", "alice", "c1"), ("messages", "alice", "c2"),
+                ("list", "alice", None), ("messages", "bob", "c1")):
+        cache.get(key, lambda: "v")
+    cache.invalidate("alice", "c1")
+    # the user's conversation list changes with any of its conversations
+    assert set(cache._entries) == {("messages", "alice", "c2"), ("messages", "bob", "c1")}
+    cache.invalidate("alice")
+    assert set(cache._entries) == {("messages", "bob", "c1")}
+
+
+def test_write_during_load_is_not_cached():
+    cache = ReadCache()
+    key = ("messages", "alice", "c1")
+
+    def stale_load():
+        # another request saves a message while this read runs
+        cache.invalidate("alice", "c1")
+        return ["cũ"]
+
+    assert cache.get(key, stale_load) == ["cũ"]
+    assert cache.get(key, lambda: ["mới"]) == ["mới"]
+
+
+def test_byte_cap_evicts_least_recently_used():
+    cache = ReadCache(max_mb=0.001)  # ~1 KB
+    big = "x" * 400
+    cache.get(("messages", "alice", "c1"), lambda: big)
+    cache.get(("messages", "alice", "c2"), lambda: big)
+    cache.get(("messages", "alice", "c1"), lambda: big)  # c1 is now the most recent
+    cache.get(("messages", "alice", "c3"), lambda: big)
+    assert ("messages", "alice", "c2") not in cache._entries
+    assert cache.get_stats()["bytes"] <= cache.max_bytes
+    # a value larger than the whole cache is returned but not kept
+    assert cache.get(("messages", "bob", "c1"), lambda: "y" * 2000) == "y" * 2000
+    assert ("messages", "bob", "c1") not in cache._entries
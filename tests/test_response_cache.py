@@ -0,0 +1,46 @@
+# ResponseCache: RAM/disk tiers, expiry, restart
+import os
+
+from core.response_cache import ResponseCache, cache_key
+
+
+def test_key_depends_on_model_prompt_and_params():
+    params = {"temperature": 0, "max_tokens": 256}
+    key = cache_key("m1", "xin chào", params)
+    assert key == cache_key("m1", "xin chào", dict(params))
+    assert key != cache_key("m2", "xin chào", params)
+    assert key != cache_key("m1", "xin chào", dict(params, max_tokens=128))
+    # token ids and a tuple of the same ids give the same key
+    assert cache_key("m1", (1, 2, 3), params) == cache_key("m1", [1, 2, 3], params)
+
+
+def test_disk_tier_survives_restart(tmp_path):
+    disk = str(tmp_path / "responses")
+    cache = ResponseCache(ram_mb=1, disk_dir=disk)
+    cache.put("k", "câu trả lời")
+    assert cache.get("k") == "câu trả lời"
+
+    again = ResponseCache(ram_mb=1, disk_dir=disk)
+    assert again.get("k") == "câu trả lời"
+    assert again.get_stats()["disk_hits"] == 1
+    assert again.get("k") == "câu trả lời"
+    assert again.get_stats()["ram_hits"] == 1
+
+
+def test_expired_entries_are_removed(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("core.response_cache.time.time", lambda: now[0])
+    cache = ResponseCache(ram_mb=1, ttl=60, disk_dir=str(tmp_path))
+    cache.put("k", "cũ")
+    now[0] += 61
+    assert cache.get("k") is None
+    assert cache.get_stats()["expired"] == 1
+    assert os.listdir(tmp_path) == []
+
+
+def test_disk_budget_drops_oldest(tmp_path):
+    cache = ResponseCache(ram_mb=1, disk_dir=str(tmp_path), disk_mb=0.0002)  # ~200 bytes
+    cache.put("a", "x" * 100)
+    cache.put("b", "y" * 100)
+    assert sorted(os.listdir(tmp_path)) == ["b.json"]
+    assert cache.get_stats()["disk_bytes"] <= cache.disk_budget
@@ -0,0 +1,66 @@
+# InferenceScheduler: fairness between users, priorities, queue limits
+import threading
+
+import pytest
+
+from core.scheduler import InferenceScheduler, QueueFullError, PRIORITY_BACKGROUND
+
+
+@pytest.fixture
+def scheduler():
+    s = InferenceScheduler(lambda slot: f"model{slot}", n_workers=1, max_queue=16, max_per_user=4)
+    yield s
+    s.shutdown()
+
+
+def block(scheduler):
+    # occupy the only slot until the returned event is set
+    started, release = threading.Event(), threading.Event()
+
+    def job(model):
+        started.set()
+        release.wait(5)
+
+    future = scheduler.submit(job, user="blocker")
+    assert started.wait(5)
+    return release, future
+
+
+def test_users_are_served_round_robin(scheduler):
+    release, _ = block(scheduler)
+    order = []
+    futures = [scheduler.submit(lambda model, name=name: order.append(name), user=name[0])
+               for name in ("a1", "a2", "a3", "b1", "c1")]
+    release.set()
+    for f in futures:
+        f.result(5)
+    assert order == ["a1", "b1", "c1", "a2", "a3"]
+
+
+def test_background_waits_for_interactive(scheduler):
+    release, _ = block(scheduler)
+    order = []
+    futures = [scheduler.submit(lambda model: order.append("batch"), user="x", priority=PRIORITY_BACKGROUND),
+               scheduler.submit(lambda model: order.append("chat1"), user="y"),
+               scheduler.submit(lambda model: order.append("chat2"), user="z")]
+    release.set()
+    for f in futures:
+        f.result(5)
+    assert order == ["chat1", "chat2", "batch"]
+
+
+def test_limits_and_cancel_of_queued_job(scheduler):
+    release, _ = block(scheduler)
+    futures = [scheduler.submit(lambda model: None, user="a") for _ in range(4)]
+    with pytest.raises(QueueFullError) as e:
+        scheduler.submit(lambda model: None, user="a")
+    assert e.value.per_user
+    # a cancelled queued job frees its place at once and never runs
+    ran = []
+    assert futures[0].cancel()
+    futures[0] = scheduler.submit(lambda model: ran.append(model), user="a")
+    release.set()
+    for f in futures:
+        f.result(5)
+    assert ran == ["model0"]
+    assert scheduler.get_stats()["cancelled"] == 1
@@ -0,0 +1,66 @@
+# SessionRegistry: cached sessions, reload after another process saved messages
+import config
+
+from core.session_registry import SessionRegistry
+
+
+class Store:
+    # messages of one conversation, counted like storage.get_message_count
+    def __init__(self):
+        self.pairs = [("chào", "xin chào")]
+        self.counts = 0
+
+    def load(self, conv_id, user):
+        return list(self.pairs)
+
+    def count(self, conv_id, user):
+        self.counts += 1
+        return len(self.pairs)
+
+
+def make_registry(store, **kwargs):
+    return SessionRegistry(config.get_config(), loader=store.load, **kwargs)
+
+
+def test_single_process_does_not_count():
+    store = Store()
+    registry = make_registry(store)
+    first = registry.get("alice", "c1")
+    assert registry.get("alice", "c1") is first
+    assert registry.stats == {"hits": 1, "misses": 1, "evicted": 0, "reloaded": 0}
+
+
+def test_counter_reloads_after_other_process_saved():
+    store = Store()
+    registry = make_registry(store, counter=store.count)
+    first = registry.get("alice", "c1")
+    assert registry.get("alice", "c1") is first
+    store.pairs.append(("nữa", "được"))  # saved by another worker
+    assert registry.get("alice", "c1") is not first
+    assert registry.stats["reloaded"] == 1
+    assert store.counts == 3
+
+
+def test_counter_ttl_skips_recent_checks(monkeypatch):
+    store = Store()
+    registry = make_registry(store, counter=store.count, counter_ttl=5)
+    now = [1000.0]
+    monkeypatch.setattr("core.session_registry.time.time", lambda: now[0])
+    first = registry.get("alice", "c1")
+    store.pairs.append(("nữa", "được"))
+    # within the ttl the cached copy is trusted without a database count
+    assert registry.get("alice", "c1") is first
+    assert store.counts == 1
+    now[0] += 6
+    assert registry.get("alice", "c1") is not first
+    assert store.counts == 2
+
+
+def test_caller_messages_are_verified_next_time():
+    store = Store()
+    registry = make_registry(store, counter=store.count, counter_ttl=5)
+    first = registry.get("alice", "c1", messages=[("cũ", "từ cache")])
+    # not counted against the loader yet: the next request checks despite the ttl
+    second = registry.get("alice", "c1")
+    assert second is not first and store.counts == 2
+    assert registry.get("alice", "c1") is second and store.counts == 2
@@ -0,0 +1,92 @@
+# SingleFlight: shared generations, refcounted cancel, which requests coalesce
+import threading
+
+from core.single_flight import SingleFlight, generation_key
+
+
+class FakeFuture:
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+def start_idle(flight):
+    # the producer has not run yet (job still queued)
+    flight.future = FakeFuture()
+
+
+def test_identical_requests_share_one_flight():
+    inflight = SingleFlight()
+    first, started = inflight.join("k", start_idle)
+    second, joined_started = inflight.join("k", start_idle)
+    assert started and not joined_started
+    assert second is first and first.waiters == 2
+
+    def produce():
+        first.publish("xin ")
+        first.publish("chào")
+        first.finish()
+
+    threading.Thread(target=produce).start()
+    assert first.wait() == "xin chào"
+    assert "".join(second.stream()) == "xin chào"
+    assert inflight.get_stats()["in_flight"] == 0
+
+
+def test_cancel_only_when_last_waiter_leaves():
+    inflight = SingleFlight()
+    flight, _ = inflight.join("k", start_idle)
+    inflight.join("k", start_idle)
+
+    inflight.leave(flight)
+    assert not flight.cancelled and not flight.future.cancelled
+    inflight.leave(flight)
+    assert flight.cancelled and flight.future.cancelled
+    assert inflight.get_stats()["cancelled"] == 1
+    # a new request after the cancel starts a fresh generation
+    again, started = inflight.join("k", start_idle)
+    assert started and again is not flight
+
+
+def test_leaving_finished_flight_does_not_cancel():
+    inflight = SingleFlight()
+    flight, _ = inflight.join("k", start_idle)
+    flight.finish()
+    inflight.leave(flight)
+    assert not flight.cancelled and not flight.future.cancelled
+
+
+def test_failed_start_is_not_kept():
+    inflight = SingleFlight()
+
+    def fail(flight):
+        raise RuntimeError("queue full")
+
+    try:
+        inflight.join("k", fail)
+    except RuntimeError:
+        pass
+    _, started = inflight.join("k", start_idle)
+    assert started
+
+
+def test_random_sampling_does_not_coalesce_other_requesters():
+    alice = generation_key("p", 256, 0.8, 0.95, None, requester=("alice", "c1"))
+    bob = generation_key("p", 256, 0.8, 0.95, None, requester=("bob", "c2"))
+    assert alice != bob
+    inflight = SingleFlight()
+    a, _ = inflight.join(alice, start_idle)
+    b, started = inflight.join(bob, start_idle)
+    assert started and a is not b
+    # the same conversation sending twice still shares its generation
+    assert generation_key("p", 256, 0.8, 0.95, None, requester=("alice", "c1")) == alice
+
+
+def test_deterministic_sampling_coalesces():
+    greedy = [generation_key("p", 256, 0, 0.95, None, requester=user) for user in ("alice", "bob")]
+    seeded = [generation_key("p", 256, 0.8, 0.95, 42, requester=user) for user in ("alice", "bob")]
+    assert greedy[0] == greedy[1]
+    assert seeded[0] == seeded[1]
+    assert generation_key("p", 256, 0, 0.95, None, model="large") != greedy[0]
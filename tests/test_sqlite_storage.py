@@ -0,0 +1,209 @@
+# SQLiteStorage against a temporary database file
+import sqlite3
+import threading
+
+import pytest
+
+pytest.importorskip("werkzeug")
+
+from core.sqlite_storage import SQLiteStorage, SCHEMA_VERSION
+from core.storage import SNIPPET_OPEN, SNIPPET_CLOSE
+
+
+@pytest.fixture
+def storage(tmp_path):
+    store = SQLiteStorage(str(tmp_path / "chat.db"), spill_path=str(tmp_path / "spill.jsonl"))
+    yield store
+    store.close()
+
+
+def save(storage, conv_id, count, username="alice", prefix="câu hỏi"):
+    for i in range(count):
+        storage.save_message(f"{prefix} {i}", f"trả lời {i}", conv_id, username)
+
+
+def test_save_flush_list(storage):
+    save(storage, "c1", 2)
+    save(storage, "c2", 1, prefix="chào")
+    # unflushed writes are already visible
+    assert [c["id"] for c in storage.get_conversation_list("alice")][:1] == ["c2"]
+    storage.flush()
+
+    conversations = storage.get_conversation_list("alice")
+    assert [c["id"] for c in conversations] == ["c2", "c1"]
+    assert conversations[1]["title"] == "câu hỏi 0"
+    messages = storage.get_messages_by_conversation_id("c1", "alice")
+    assert [m["user_message"] for m in messages] == ["câu hỏi 0", "câu hỏi 1"]
+    assert storage.get_message_count("c1", "alice") == 2
+    # other users see nothing
+    assert storage.get_conversation_list("bob") == []
+    assert storage.get_messages_by_conversation_id("c1", "bob") == []
+
+
+def test_page_cursors(storage):
+    save(storage, "c1", 5)
+    storage.flush()
+
+    page, cursor = storage.get_messages_page("c1", "alice", limit=2)
+    assert [m["user_message"] for m in page] == ["câu hỏi 3", "câu hỏi 4"]
+    seen = [m["_id"] for m in page]
+    while cursor is not None:
+        page, cursor = storage.get_messages_page("c1", "alice", before=cursor, limit=2)
+        seen = [m["_id"] for m in page] + seen
+    ordered = [m["_id"] for m in storage.get_messages_by_conversation_id("c1", "alice")]
+    assert seen == ordered
+    assert storage.get_recent_messages("c1", "alice", 3)[-1]["user_message"] == "câu hỏi 4"
+
+
+def test_search_snippets(storage):
+    if not storage.has_fts:
+        pytest.skip("sqlite không có FTS5")
+    storage.save_message("Làm sao đảo ngược một list?", "Dùng list[::-1] hoặc reversed()", "c1", "alice")
+    storage.save_message("Đọc file thế nào?", "Dùng open()", "c2", "alice")
+    storage.save_message("đảo ngược chuỗi", "s[::-1]", "c3", "bob")
+    storage.flush()
+
+    # tone marks are ignored (đ is a letter of its own), the last word is a prefix
+    results, next_offset = storage.search_messages("alice", "ĐAO nguo")
+    assert next_offset is None
+    assert [r["conversation_id"] for r in results] == ["c1"]
+    snippet = results[0]["snippet"]
+    assert f"{SNIPPET_OPEN}đảo{SNIPPET_CLOSE}" in snippet
+    assert results[0]["title"] == "Làm sao đảo ngược một list?"
+    # query syntax is not passed to FTS
+    assert storage.search_messages("alice", '" OR *')[0] == []
+
+
+def test_search_ranks_all_matches_of_owner(storage):
+    if not storage.has_fts:
+        pytest.skip("sqlite không có FTS5")
+    # the strongest match is the oldest one, behind many weaker matches
+    storage.save_message("python python python", "python", "old", "alice")
+    for i in range(200):
+        storage.save_message(f"câu hỏi {i}", f"trả lời có nhắc python {i}", f"c{i}", "alice")
+    for i in range(50):
+        storage.save_message("python python python", "python", f"b{i}", "bob.x")
+    storage.flush()
+
+    results, next_offset = storage.search_messages("alice", "python", limit=5)
+    assert results[0]["conversation_id"] == "old"
+    assert next_offset == 5
+    assert all(not r["conversation_id"].startswith("b") for r in results)
+    assert storage.search_messages("bob", "python")[0] == []
+    assert len(storage.search_messages("bob.x", "python", limit=100)[0]) == 50
+
+
+def test_delete_all_resets_sync(storage):
+    save(storage, "c1", 2)
+    save(storage, "c9", 1, username="bob")
+    storage.flush()
+    before = storage.get_sync_version("alice")
+    changes = storage.get_conversation_changes("alice", since=before)
+    assert not changes["reset"] and changes["changed"] == []
+
+    save(storage, "c2", 1)  # still queued: delete-all must not let it come back
+    storage.delete_all_conversations("alice")
+    storage.flush()
+    assert storage.get_conversation_list("alice") == []
+    assert storage.get_message_count("c1", "alice") == 0
+    changes = storage.get_conversation_changes("alice", since=before)
+    assert changes["reset"] and changes["changed"] == []
+    # bob's history is kept
+    assert [c["id"] for c in storage.get_conversation_list("bob")] == ["c9"]
+
+
+def test_delta_reader_during_writes(storage):
+    # every conversation written while a client polls shows up in a delta
+    done = threading.Event()
+
+    def writer():
+        for i in range(30):
+            storage.save_message("hỏi", "đáp", f"c{i}", "alice")
+            storage.flush()
+        done.set()
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    seen, since = set(), None
+    while True:
+        finished = done.is_set()
+        changes = storage.get_conversation_changes("alice", since=since)
+        if not changes["pending"]:
+            # listed from the summary table, not from the queue
+            seen.update(c["id"] for c in changes["changed"])
+            since = changes["version"]
+        if finished:
+            break
+    thread.join()
+    changes = storage.get_conversation_changes("alice", since=since)
+    seen.update(c["id"] for c in changes["changed"])
+    assert seen == {f"c{i}" for i in range(30)}
+
+
+def test_delete_all_waits_for_batch_in_flight(storage):
+    gate, started = threading.Event(), threading.Event()
+    write = storage.writer.flush_fn
+
+    def slow_write(docs):
+        started.set()
+        gate.wait(5)
+        write(docs)
+
+    storage.writer.flush_fn = slow_write
+    storage.writer.batch_size = 1
+    save(storage, "c1", 1)
+    assert started.wait(5)  # the background thread is writing the batch
+
+    deleter = threading.Thread(target=storage.delete_all_conversations, args=("alice",))
+    deleter.start()
+    deleter.join(0.1)
+    assert deleter.is_alive()
+    gate.set()
+    deleter.join(5)
+    storage.flush()
+    assert storage.get_conversation_list("alice") == []
+    assert storage.get_message_count("c1", "alice") == 0
+
+
+def test_migrate_old_schema(tmp_path):
+    path = tmp_path / "old.db"
+    conn = sqlite3.connect(path)
+    conn.execute("""CREATE TABLE chat_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp TEXT NOT NULL,
+        user_message TEXT NOT NULL, assistant_response TEXT NOT NULL, conversation_id TEXT)""")
+    conn.executemany(
+        "INSERT INTO chat_history (timestamp, user_message, assistant_response, conversation_id) VALUES (?, ?, ?, ?)",
+        [("2024-01-01T10:00:00.000000", "xin chào", "chào bạn", "old1"),
+         ("2024-01-01T10:01:00.000000", "list là gì", "kiểu dữ liệu", "old1"),
+         ("2024-01-02T09:00:00.000000", "không có id", "vẫn giữ", None)])
+    conn.commit()
+    conn.close()
+
+    storage = SQLiteStorage(str(path), spill_path=str(tmp_path / "spill.jsonl"))
+    try:
+        conversations = storage.get_conversation_list("local")
+        assert [c["id"] for c in conversations] == ["legacy", "old1"]
+        assert conversations[1]["title"] == "xin chào"
+        messages = storage.get_messages_by_conversation_id("old1", "local")
+        assert [m["_id"] for m in messages] == ["legacy1", "legacy2"]
+        assert storage.get_message_count("old1", "local") == 2
+        if storage.has_fts:
+            assert storage.search_messages("local", "kieu")[0][0]["conversation_id"] == "old1"
+        # new writes go on top of the migrated history
+        storage.save_message("tiếp", "ok", "old1", "local")
+        storage.flush()
+        assert storage.get_message_count("old1", "local") == 3
+    finally:
+        storage.close()
+
+    conn = sqlite3.connect(path)
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
+    conn.close()
+
+
+def test_malformed_cursor(storage):
+    save(storage, "c1", 1)
+    storage.flush()
+    for cursor in ("rác", "2024-13-45T00:00:00_abc", "_"):
+        with pytest.raises(ValueError):
+            storage.get_messages_page("c1", "alice", before=cursor, limit=2)
@@ -0,0 +1,68 @@
+# ModelStateStore: RAM/disk tiering, file I/O outside the store lock
+import os
+import pickle
+import threading
+
+from core.state_store import ModelStateStore
+
+
+class State:
+    # stand-in for a llama state: llama_state_size is what state_size reads
+    def __init__(self, name, size):
+        self.name = name
+        self.llama_state_size = size
+
+
+def make_store(tmp_path, ram_mb=1, disk_mb=10):
+    return ModelStateStore(ram_budget_mb=ram_mb, disk_dir=str(tmp_path / "states"), disk_budget_mb=disk_mb)
+
+
+def test_lru_spills_to_disk_and_loads_back(tmp_path):
+    store = make_store(tmp_path)
+    mb = 1024 * 1024
+    store.put("a", State("a", mb // 2))
+    store.put("b", State("b", mb // 2))
+    store.put("c", State("c", mb // 2))  # "a" goes to disk
+    stats = store.get_stats()
+    assert stats["ram_items"] == 2 and stats["disk_items"] == 1
+
+    assert store.take("a").name == "a"
+    assert store.take("a") is None
+    assert os.listdir(tmp_path / "states") == []
+    assert store.get_stats()["disk_hits"] == 1
+
+
+def test_take_while_writing_returns_state_and_drops_file(tmp_path, monkeypatch):
+    store = make_store(tmp_path, ram_mb=0)
+    writing, release = threading.Event(), threading.Event()
+    dump = pickle.dump
+
+    def slow_dump(obj, f, protocol=None):
+        writing.set()
+        release.wait(5)
+        dump(obj, f, protocol=protocol)
+
+    monkeypatch.setattr("core.state_store.pickle.dump", slow_dump)
+    worker = threading.Thread(target=store.put, args=("a", State("a", 100)))
+    worker.start()
+    assert writing.wait(5)
+    # the store lock is free while pickling: reads don't wait for the disk
+    assert store.get_stats()["writing"] == 1
+    assert store.take("a").name == "a"
+    release.set()
+    worker.join(5)
+    assert store.take("a") is None
+    assert os.listdir(tmp_path / "states") == []
+    assert store.get_stats()["disk_bytes"] == 0
+
+
+def test_discard_and_replace(tmp_path):
+    store = make_store(tmp_path, ram_mb=0)
+    store.put("a", State("a1", 100))
+    store.put("a", State("a2", 100))
+    assert len(os.listdir(tmp_path / "states")) == 1
+    assert store.take("a").name == "a2"
+    store.put("b", State("b", 100))
+    store.discard("b")
+    assert os.listdir(tmp_path / "states") == []
+    assert store.get_stats()["disk_bytes"] == 0
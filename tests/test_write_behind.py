@@ -0,0 +1,129 @@
+# WriteBehindQueue: spill, replay and delete against an in-memory flush_fn
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from core.write_behind import WriteBehindQueue
+
+
+class FakeDB:
+    def __init__(self):
+        self.rows = {}
+        self.fail = False
+        self.gate = None      # threading.Event: block writes until set
+        self.started = threading.Event()
+
+    def write(self, docs):
+        self.started.set()
+        if self.gate is not None:
+            self.gate.wait(5)
+        if self.fail:
+            raise ConnectionError("db down")
+        for doc in docs:
+            self.rows[doc["_id"]] = doc  # idempotent like the real backends
+
+
+def doc(i, owner="alice"):
+    return {"_id": f"m{i}", "owner": owner, "text": f"tin {i}"}
+
+
+@pytest.fixture
+def db():
+    return FakeDB()
+
+
+def make_queue(db, tmp_path, batch_size):
+    return WriteBehindQueue(db.write, batch_size=batch_size, flush_interval=60,
+                            spill_path=str(tmp_path / "spill.jsonl"))
+
+
+@pytest.fixture
+def queue(db, tmp_path):
+    # batches never fill up: only the test flushes and replays
+    q = make_queue(db, tmp_path, 100)
+    yield q
+    q.close()
+
+
+def test_failed_batches_spill_and_replay(db, queue):
+    db.fail = True
+    for i in range(3):
+        queue.put(doc(i))
+    queue.flush()
+    assert db.rows == {}
+    assert queue.get_stats()["spilled"] == 3
+
+    db.fail = False
+    assert queue.replay() == 3
+    assert sorted(db.rows) == ["m0", "m1", "m2"]
+    assert not os.path.exists(queue.spill_path)
+    assert not os.path.exists(queue.spill_path + ".replay")
+
+
+def test_replay_merges_interrupted_replay_file(db, queue):
+    # a crash during an earlier replay left its file behind
+    with open(queue.spill_path + ".replay", "w", encoding="utf-8") as f:
+        f.write(json.dumps(doc(0)) + "\n")
+    with open(queue.spill_path, "w", encoding="utf-8") as f:
+        f.write(json.dumps(doc(1)) + "\n")
+
+    assert queue.replay() == 2
+    assert sorted(db.rows) == ["m0", "m1"]
+    assert not os.path.exists(queue.spill_path + ".replay")
+
+
+def test_replay_keeps_file_until_written(db, queue):
+    db.fail = True
+    queue.put(doc(0))
+    queue.flush()
+    db.fail = False
+    db.gate = threading.Event()
+    db.started.clear()
+    worker = threading.Thread(target=queue.replay)
+    worker.start()
+    assert db.started.wait(5)
+    # the write is in flight: the spilled document is still on disk
+    with open(queue.spill_path + ".replay", encoding="utf-8") as f:
+        assert [json.loads(line)["_id"] for line in f] == ["m0"]
+    db.gate.set()
+    worker.join(5)
+    assert "m0" in db.rows
+    assert not os.path.exists(queue.spill_path + ".replay")
+
+
+def test_flush_waits_for_batch_in_flight(db, tmp_path):
+    queue = make_queue(db, tmp_path, 2)
+    db.gate = threading.Event()
+    queue.put(doc(0))
+    queue.put(doc(1))  # full batch wakes the background thread
+    assert db.started.wait(5)
+
+    flushed = threading.Event()
+    threading.Thread(target=lambda: (queue.flush(), flushed.set())).start()
+    time.sleep(0.1)
+    assert not flushed.is_set()
+    db.gate.set()
+    assert flushed.wait(5)
+    assert sorted(db.rows) == ["m0", "m1"]
+    queue.close()
+
+
+def test_discard_drops_pending_and_spilled_docs_of_owner(db, queue):
+    db.fail = True
+    queue.put(doc(0))
+    queue.put(doc(1, owner="bob"))
+    queue.flush()  # both spilled
+    queue.put(doc(2))
+    queue.put(doc(3, owner="bob"))
+
+    with queue.exclusive():
+        queue.discard(lambda d: d["owner"] == "alice")
+    assert [d["_id"] for d in queue.pending()] == ["m3"]
+
+    db.fail = False
+    queue.flush()
+    queue.replay()
+    assert sorted(db.rows) == ["m1", "m3"]
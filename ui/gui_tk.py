@@ -8,8 +8,9 @@ import time # Cần thiết cho việc tạo ID phiên
 import config
 from core.model_llama_cpp import ModelWrapper
 from core.conversation import ConversationManager
+from core.cancellation import CancelToken, display_text
 from core.utils import save_chat_log, get_model_info
-from core.database_utils import MongoDBManager
+from core.storage import open_storage
 
 
 class SimpleChatGUI:
@@ -77,16 +78,24 @@ class SimpleChatGUI:
         self.model_wrapper = None
         self.conversation_manager = None
         self.is_processing = False
+        self.cancel_token = None # CancelToken của câu trả lời đang sinh (nút Dừng)
         
         # Biến trạng thái mới
         self.current_conv_id = str(uuid.uuid4()) # ID phiên hiện tại, tạo ID duy nhất
-        
-        # Khởi tạo MongoDB Manager
-        self.mongo_manager = None
+        self.username = "local" # GUI offline chỉ có một người dùng
+        self.older_cursor = None # Cursor trang lịch sử cũ hơn (None = hết)
+        # Sidebar đồng bộ delta: chỉ cập nhật các nút có thay đổi
+        self.conv_version = None
+        self.conv_buttons = {}   # conv_id -> nút trong sidebar
+        self.highlighted_conv_id = None
+        self.loading_older = False
+        
+        # Khởi tạo kho lưu trữ (MongoDB hoặc SQLite, theo config.STORAGE_BACKEND)
+        self.storage = None
         try:
-            self.mongo_manager = MongoDBManager()
-        except ConnectionError as e:
-            messagebox.showwarning("Cảnh báo Database", f"Không thể kết nối MongoDB. Lịch sử chat sẽ không được lưu vào DB. Lỗi: {e}")
+            self.storage = open_storage(self.config)
+        except Exception as e:
+            messagebox.showwarning("Cảnh báo Database", f"Không thể mở kho lưu trữ. Lịch sử chat sẽ không được lưu vào DB. Lỗi: {e}")
 
         # Tạo cửa sổ dark theme đơn giản
         self.root = tk.Tk()
@@ -176,6 +185,8 @@ class SimpleChatGUI:
             selectforeground='#ffffff'
         )
         self.chat_text.pack(fill=tk.BOTH, expand=True)
+        # Cuộn lên đầu để tải trang lịch sử cũ hơn
+        self.chat_text.config(yscrollcommand=self._on_chat_scroll)
         
         # Configure text tags đơn giản
         self.chat_text.tag_configure("user", foreground='#e0e0e0', font=("Segoe UI", 11))
@@ -208,6 +219,13 @@ class SimpleChatGUI:
                   activebackground='#505050', activeforeground='#ffffff')
         send_btn.pack(side=tk.RIGHT, padx=(0, 5))
         
+        # Stop button: dừng câu trả lời đang sinh, giữ phần đã có
+        self.stop_btn = tk.Button(input_frame, text="⏹ Dừng", command=self._on_stop, state=tk.DISABLED,
+                  bg='#404040', fg='#e0e0e0', relief='flat', padx=15, pady=12,
+                  font=("Segoe UI", 11), cursor='hand2', bd=0,
+                  activebackground='#505050', activeforeground='#ffffff')
+        self.stop_btn.pack(side=tk.RIGHT, padx=(0, 5))
+        
         # Status bar tối
         status_frame = tk.Frame(self.root, bg='#1a1a1a', height=30)
         status_frame.pack(fill=tk.X, padx=10, pady=(0, 10))
@@ -226,8 +244,14 @@ class SimpleChatGUI:
 
     def _start_new_conversation(self):
         """Bắt đầu một cuộc trò chuyện mới."""
+        if self.is_processing:
+            # dừng câu trả lời đang sinh, chuyển khi model rảnh
+            self._on_stop()
+            self.root.after(50, self._start_new_conversation)
+            return
         self.current_conv_id = str(uuid.uuid4()) # Tạo ID mới
         self.conversation_manager.clear_history() # Xóa bộ nhớ đệm
+        self.model_wrapper.switch_conversation(self.current_conv_id)
         self._clear_chat_display() # Xóa giao diện
         self.status_var.set("🟢 Bắt đầu cuộc trò chuyện mới")
         self._add_message("ai", "Xin chào! 👋 Bắt đầu cuộc trò chuyện mới.")
@@ -235,94 +259,150 @@ class SimpleChatGUI:
 
     def _load_conversation(self, conv_id):
         """Tải lịch sử của một cuộc trò chuyện cũ."""
-        if self.is_processing or conv_id == self.current_conv_id:
+        if conv_id == self.current_conv_id:
+            return
+        if self.is_processing:
+            # dừng câu trả lời đang sinh, chuyển khi model rảnh
+            self._on_stop()
+            self.root.after(50, lambda: self._load_conversation(conv_id))
             return
             
         self.current_conv_id = conv_id
         self.conversation_manager.clear_history()
+        # Khôi phục KV state đã lưu, tránh đánh giá lại toàn bộ prompt
+        self.model_wrapper.switch_conversation(conv_id)
         self._clear_chat_display()
         
-        if not self.mongo_manager:
+        if not self.storage:
             return
-            
-        messages = self.mongo_manager.get_messages_by_conversation_id(conv_id)
         
-        # Tải lại lịch sử vào bộ nhớ đệm (dùng cho ConversationManager)
-        # và hiển thị ra giao diện
+        # Tải lại phần cuối lịch sử vào bộ nhớ đệm (dùng cho ConversationManager)
+        for msg in self.storage.get_recent_messages(conv_id, self.username, self.config['history_max_turns']):
+            self.conversation_manager.add_user_message(msg.get("user_message", ""))
+            self.conversation_manager.add_assistant_message(msg.get("assistant_response", ""))
+        
+        # Chỉ hiển thị trang mới nhất, các trang cũ hơn tải khi cuộn lên
+        messages, self.older_cursor = self.storage.get_messages_page(
+            conv_id, self.username, limit=self.config['history_page_size'])
         self.chat_text.config(state=tk.NORMAL)
         for msg in messages:
-            user_msg = msg.get("user_message", "")
-            ai_resp = msg.get("assistant_response", "")
-            timestamp = msg.get("timestamp", datetime.now()).strftime("%H:%M")
-            
-            # Tải lại lịch sử cho model context
-            self.conversation_manager.add_user_message(user_msg)
-            self.conversation_manager.add_assistant_message(ai_resp)
-            
-            # Hiển thị đơn giản
-            self.chat_text.insert(tk.END, f"[{timestamp}] ", "timestamp")
-            self.chat_text.insert(tk.END, "Bạn: ", "user_label")
-            self.chat_text.insert(tk.END, f"{user_msg}\n\n", "user")
-            
-            self.chat_text.insert(tk.END, f"[{timestamp}] ", "timestamp")
-            self.chat_text.insert(tk.END, "AI: ", "ai_label")
-            self.chat_text.insert(tk.END, f"{ai_resp}\n\n", "ai")
-            
+            self._insert_message_pair(tk.END, msg)
         self.chat_text.config(state=tk.DISABLED)
         self.chat_text.see(tk.END)
         self.status_var.set(f"📂 Đã tải cuộc trò chuyện: {conv_id[:8]}...")
         self._load_conversation_list() # Cập nhật trạng thái active button
 
+    def _insert_message_pair(self, index, msg):
+        # Hiển thị một cặp hỏi/đáp đã lưu tại vị trí index
+        timestamp = msg.get("timestamp", datetime.now()).strftime("%H:%M")
+        self.chat_text.insert(index, f"[{timestamp}] ", "timestamp")
+        self.chat_text.insert(index, "Bạn: ", "user_label")
+        self.chat_text.insert(index, f"{msg.get('user_message', '')}\n\n", "user")
+        
+        self.chat_text.insert(index, f"[{timestamp}] ", "timestamp")
+        self.chat_text.insert(index, "AI: ", "ai_label")
+        self.chat_text.insert(index, f"{msg.get('assistant_response', '')}\n\n", "ai")
+
+    def _on_chat_scroll(self, first, last):
+        self.chat_text.vbar.set(first, last)
+        if float(first) <= 0.0 and self.older_cursor and not self.loading_older:
+            self.loading_older = True
+            self.root.after_idle(self._load_older_messages)
+
+    def _load_older_messages(self):
+        """Tải trang lịch sử cũ hơn và chèn lên đầu khung chat."""
+        try:
+            if not self.storage or not self.older_cursor:
+                return
+            messages, self.older_cursor = self.storage.get_messages_page(
+                self.current_conv_id, self.username, before=self.older_cursor,
+                limit=self.config['history_page_size'])
+            
+            # Mark có gravity phải: mỗi lần chèn mark dịch ra sau, giữ thứ tự cũ -> mới
+            self.chat_text.config(state=tk.NORMAL)
+            self.chat_text.mark_set("history_top", "1.0")
+            self.chat_text.mark_gravity("history_top", tk.RIGHT)
+            for msg in messages:
+                self._insert_message_pair("history_top", msg)
+            self.chat_text.config(state=tk.DISABLED)
+            # Giữ nguyên vị trí đang xem
+            self.chat_text.yview("history_top")
+        finally:
+            self.loading_older = False
+
     def _load_conversation_list(self):
-        """Hiển thị danh sách cuộc trò chuyện ở Sidebar."""
-        if not self.mongo_manager:
+        """Cập nhật danh sách cuộc trò chuyện ở Sidebar (chỉ phần thay đổi)."""
+        if not self.storage:
             return
 
-        # Xóa các nút cũ
-        for widget in self.conv_list_frame.winfo_children():
-            widget.destroy()
+        changes = self.storage.get_conversation_changes(self.username, since=self.conv_version)
+        if changes["reset"]:
+            # Xóa các nút cũ
+            for widget in self.conv_list_frame.winfo_children():
+                widget.destroy()
+            self.conv_buttons = {}
+            self.highlighted_conv_id = None
 
-        conv_list = self.mongo_manager.get_conversation_list()
-        
-        for conv in conv_list:
-            title = conv['title'].strip() or "Untitled Chat"
-            conv_id = conv['id']
-            
-            # Kiểm tra xem đây có phải là cuộc trò chuyện hiện tại không
-            is_active = (conv_id == self.current_conv_id)
-            
-            # Tạo nút cho mỗi cuộc trò chuyện với icon
-            btn_bg = '#404040' if is_active else '#252525'  # Tối hơn khi active
-            btn_fg = '#e0e0e0' if is_active else '#b0b0b0'  # Sáng hơn khi active
-            btn_active_bg = '#505050'
-            
-            btn = tk.Button(self.conv_list_frame, 
-                            text=f"💬 {title}", 
-                            anchor="w", 
-                            relief='flat', 
-                            bg=btn_bg,
-                            activebackground=btn_active_bg,
-                            fg=btn_fg,
-                            font=("Segoe UI", 10) if is_active else ("Segoe UI", 10),
-                            wraplength=240, 
-                            justify=tk.LEFT,
-                            cursor='hand2',
-                            padx=12,
-                            pady=8,
-                            command=lambda id=conv_id: self._load_conversation(id),
-                            bd=0)
-            
-            if is_active:
-                btn.config(font=("Segoe UI", 10, "bold"))
-            
-            btn.pack(fill=tk.X, pady=2, padx=5)
-            
-        # Cập nhật scrollbar sau khi thêm nút
-        self.conv_list_frame.update_idletasks()
-        self.sidebar_canvas.config(scrollregion=self.sidebar_canvas.bbox("all"))
+        # Cũ trước, mới sau: mỗi nút được đưa lên đầu danh sách
+        for conv in reversed(changes["changed"]):
+            btn = self.conv_buttons.get(conv["id"])
+            if btn is None:
+                btn = self._create_conversation_button(conv)
+                self.conv_buttons[conv["id"]] = btn
+            else:
+                btn.pack_forget()
+            packed = self.conv_list_frame.pack_slaves()
+            if packed:
+                btn.pack(fill=tk.X, pady=2, padx=5, before=packed[0])
+            else:
+                btn.pack(fill=tk.X, pady=2, padx=5)
+        self.conv_version = changes["version"]
+        
+        self._highlight_conversation(self.current_conv_id)
+        
+        if changes["changed"] or changes["reset"]:
+            # Cập nhật scrollbar sau khi thêm nút
+            self.conv_list_frame.update_idletasks()
+            self.sidebar_canvas.config(scrollregion=self.sidebar_canvas.bbox("all"))
+
+    def _create_conversation_button(self, conv):
+        title = conv['title'].strip() or "Untitled Chat"
+        conv_id = conv['id']
+        # Tạo nút cho mỗi cuộc trò chuyện với icon
+        return tk.Button(self.conv_list_frame, 
+                         text=f"💬 {title}", 
+                         anchor="w", 
+                         relief='flat', 
+                         bg='#252525',
+                         activebackground='#505050',
+                         fg='#b0b0b0',
+                         font=("Segoe UI", 10),
+                         wraplength=240, 
+                         justify=tk.LEFT,
+                         cursor='hand2',
+                         padx=12,
+                         pady=8,
+                         command=lambda id=conv_id: self._load_conversation(id),
+                         bd=0)
+
+    def _highlight_conversation(self, conv_id):
+        """Đổi nút active (chỉ đụng tới nút cũ và nút mới)."""
+        if conv_id == self.highlighted_conv_id and conv_id in self.conv_buttons:
+            return
+        old = self.conv_buttons.get(self.highlighted_conv_id)
+        if old is not None:
+            old.config(bg='#252525', fg='#b0b0b0', font=("Segoe UI", 10))
+        new = self.conv_buttons.get(conv_id)
+        if new is not None:
+            # Tối hơn và chữ sáng hơn khi active
+            new.config(bg='#404040', fg='#e0e0e0', font=("Segoe UI", 10, "bold"))
+            self.highlighted_conv_id = conv_id
+        else:
+            self.highlighted_conv_id = None
 
     def _clear_chat_display(self):
         """Chỉ xóa nội dung hiển thị trên khung chat."""
+        self.older_cursor = None
         self.chat_text.config(state=tk.NORMAL)
         self.chat_text.delete(1.0, tk.END)
         self.chat_text.config(state=tk.DISABLED)
@@ -335,11 +415,11 @@ class SimpleChatGUI:
 
     def _clear_current_chat(self):
         """
-        Xóa TOÀN BỘ lịch sử chat khỏi MongoDB và reset giao diện.
+        Xóa TOÀN BỘ lịch sử chat khỏi DB và reset giao diện.
         (Thực hiện hành vi XÓA TẤT CẢ)
         """
-        if not self.mongo_manager:
-            messagebox.showwarning("Cảnh báo", "Không có kết nối MongoDB. Không thể xóa lịch sử.")
+        if not self.storage:
+            messagebox.showwarning("Cảnh báo", "Không có kết nối DB. Không thể xóa lịch sử.")
             return
 
         # Xác nhận với người dùng trước khi xóa vĩnh viễn
@@ -349,8 +429,8 @@ class SimpleChatGUI:
         )
         
         if confirmation:
-            # 1. Thực hiện Xóa TẤT CẢ khỏi MongoDB
-            self.mongo_manager.delete_all_conversations()
+            # 1. Thực hiện Xóa TẤT CẢ khỏi DB
+            self.storage.delete_all_conversations(self.username)
             
             # 2. Xóa bộ nhớ đệm, giao diện và khởi tạo phiên mới
             # Hàm _start_new_conversation sẽ xử lý việc reset giao diện và cập nhật Sidebar
@@ -384,7 +464,7 @@ class SimpleChatGUI:
                     return
                 
                 self.model_wrapper = ModelWrapper()
-                self.conversation_manager = ConversationManager(self.config)
+                self.conversation_manager = ConversationManager(self.config, tokenizer=self.model_wrapper.tokenize)
                 
                 self.root.after(0, self._on_model_ready)
                 
@@ -437,30 +517,37 @@ class SimpleChatGUI:
             self.root.after(0, lambda: self.status_var.set("🔄 AI đang suy nghĩ..."))
             
             prompt = self.conversation_manager.build_prompt(user_input)
-            response = self.model_wrapper.generate(prompt)
+            question = self.conversation_manager.standalone_question(user_input)
+            self.cancel_token = CancelToken(timeout=self.config.get('request_timeout') or None)
+            self.root.after(0, lambda: self.stop_btn.config(state=tk.NORMAL))
+            response = self.model_wrapper.generate(prompt, question=question, cancel=self.cancel_token)
             
             self.conversation_manager.add_user_message(user_input)
             self.conversation_manager.add_assistant_message(response)
             
-            self.root.after(0, lambda: self._add_message("ai", response))
+            self.root.after(0, lambda: self._add_message("ai", display_text(response)))
             
             # Lưu lịch sử chat vào file log cũ (giữ lại)
             save_chat_log(user_input, response, self.config.get('log_dir', 'logs')) 
             
-            # LƯU VÀO MONGODB
-            if response and self.mongo_manager:
-                self.mongo_manager.save_message(user_input, response, self.current_conv_id) 
+            # LƯU VÀO MONGODB (chỉ xếp hàng, luồng nền ghi xuống DB)
+            if response and self.storage:
+                self.storage.save_message(user_input, response, self.current_conv_id, self.username)
                 # Cập nhật danh sách sidebar sau khi lưu
                 self.root.after(0, self._load_conversation_list)
             
-            if self.conversation_manager.is_history_full():
-                self.conversation_manager.trim_history(keep_turns=3)
-            
         except Exception as e:
             self.root.after(0, lambda: self._add_message("ai", f"❌ Lỗi: {e}"))
         finally:
+            self.cancel_token = None
             self.is_processing = False
+            self.root.after(0, lambda: self.stop_btn.config(state=tk.DISABLED))
             self.root.after(0, lambda: self.status_var.set("🟢 Sẵn sàng"))
+    
+    def _on_stop(self):
+        # stop button: the running generation ends at its next token
+        if self.cancel_token is not None:
+            self.cancel_token.cancel()
             
 # Trong file ui/gui_tk.py, thêm đoạn code này vào cuối class SimpleChatGUI
 
@@ -1,33 +1,157 @@
 #Flask: tạo ứng dụng web; render_template: trả về file HTML; session: lưu trạng thái đăng nhập; redirect, url_for: chuyển hướng trang web
 import re
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for
+import sys
+import html
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, Response, stream_with_context
 import config
-from core.model_llama_cpp import ModelWrapper
-from core.conversation import ConversationManager
-from core.database_utils import MongoDBManager
+from core.model_llama_cpp import create_response_cache, create_semantic_cache
+from core.session_registry import SessionRegistry
+from core.storage import open_storage, SNIPPET_OPEN, SNIPPET_CLOSE
+from core.scheduler import InferenceScheduler, QueueFullError, create_model_scheduler, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND
+from core.single_flight import SingleFlight, generation_key
 import uuid
+import json
 import webbrowser
 import threading
 import time
 import os
+import hashlib
 
 app = Flask(__name__)
 app.secret_key = "bat_ky_chuoi_bi_mat_nao_ban_thich_o_day"  # BẮT BUỘC để dùng Session
 
 # --- KHỞI TẠO ---
 conf = config.get_config()
-model_wrapper = ModelWrapper()
-conversation_manager = ConversationManager(conf)
+response_cache = None
+semantic_cache = None
+scheduler = None
+storage = None
+sessions = None
 
-try:
-    mongo_manager = MongoDBManager()
-    print("✅ Đã kết nối MongoDB")
-except Exception:
-    mongo_manager = None
+def init_app(backend=None):
+    # Tạo model/scheduler, kho lưu trữ và registry session
+    # backend: model đã nạp sẵn ở tiến trình cha (web_prefork.py gọi sau khi fork)
+    global response_cache, semantic_cache, scheduler, storage, sessions
+    if conf.get('inference_socket'):
+        # Model chạy trong inference server riêng (python -m core.inference_server),
+        # mỗi slot ở đây chỉ là một kết nối tới nó -> nhiều web worker dùng chung một model
+        from core.remote_model import RemoteModelWrapper
+        scheduler = InferenceScheduler(lambda slot: RemoteModelWrapper(conf['inference_socket']),
+                                       n_workers=conf['inference_client_slots'],
+                                       max_queue=conf['queue_max_depth'],
+                                       max_per_user=conf['queue_max_per_user'])
+    else:
+        # Mỗi slot giữ một ModelWrapper riêng (Llama không thread-safe),
+        # cache câu trả lời dùng chung cho mọi slot
+        response_cache = create_response_cache(conf) if conf.get('response_cache') else None
+        semantic_cache = create_semantic_cache(conf) if conf.get('semantic_cache') else None
+        scheduler = create_model_scheduler(conf, response_cache, semantic_cache, backend=backend)
 
-# Lưu session ID tạm thời cho mỗi user trong RAM server (dictionary)
-# Key: username, Value: session_id
-user_sessions = {}
+    # Lưu trữ lịch sử: MongoDB hoặc SQLite (config.STORAGE_BACKEND)
+    try:
+        storage = open_storage(conf)
+        print(f"✅ Đã mở kho lưu trữ: {conf['storage_backend']}")
+    except Exception as e:
+        print(f"Lỗi mở kho lưu trữ: {e}")
+        storage = None
+
+    # Mỗi (user, cuộc trò chuyện) có ConversationManager riêng; counter: nạp lại
+    # session khi tiến trình khác (worker prefork/gunicorn) đã lưu thêm lượt hỏi đáp.
+    # Chạy một tiến trình thì không cần đếm trong DB ở mỗi yêu cầu
+    shared = storage is not None and multi_process()
+    sessions = SessionRegistry(conf, loader=load_session_history,
+                               tokenizer=scheduler.slots[0].tokenize,
+                               max_sessions=conf['session_max'],
+                               max_mb=conf['session_max_mb'],
+                               idle_ttl=conf['session_idle_ttl'],
+                               counter=storage.get_message_count if shared else None,
+                               counter_ttl=conf['session_sync_ttl'])
+
+def multi_process():
+    # Nhiều tiến trình web cùng ghi một DB: web_prefork.py hoặc worker gunicorn
+    return bool(os.environ.get("CHAT_AI_PREFORK")) or "gunicorn" in sys.modules
+
+def load_session_history(conv_id, username):
+    # Nạp lại context của một cuộc trò chuyện từ DB khi không còn trong RAM
+    # (chỉ đọc phần cuối mà model cần)
+    if not storage:
+        return []
+    return [(m.get("user_message"), m.get("assistant_response"))
+            for m in storage.get_recent_messages(conv_id, username, conf['history_max_turns'])]
+
+# web_prefork.py import module này ở tiến trình cha rồi tự gọi init_app() trong từng worker
+if not os.environ.get("CHAT_AI_PREFORK"):
+    init_app()
+
+# Yêu cầu giống hệt nhau (bấm gửi 2 lần, nhiều tab) dùng chung một lần sinh;
+# khi lấy mẫu ngẫu nhiên chỉ các yêu cầu của cùng user + cuộc trò chuyện
+inflight = SingleFlight()
+
+def start_generation(username, conv_id, prompt, question, model_name=None, priority=PRIORITY_INTERACTIVE):
+    # join the running generation of the same prompt/parameters or start one
+    # returns (flight, duplicate); duplicate = same user and conversation
+    # already started it, so the answer must not be recorded twice
+    # model_name: model of the registry (MODELS), None = default model
+    # priority: PRIORITY_BACKGROUND jobs run only when no interactive job waits
+    key = generation_key(prompt, conf['max_tokens'], conf['temperature'], conf['top_p'], conf.get('seed'),
+                         model_name, requester=(username, conv_id))
+    options = {"model": model_name} if model_name else {}
+    if conf.get('inference_socket'):
+        # inference server xếp hàng công bằng và giới hạn theo user, không theo cuộc trò chuyện
+        options["user"] = username
+        options["priority"] = priority
+    
+    def start(flight):
+        flight.origin = (username, conv_id)
+        
+        def job(model):
+            stream = None
+            try:
+                # Khôi phục KV state của cuộc trò chuyện (nếu có snapshot)
+                model.switch_conversation(conv_id)
+                stream = model.generate(prompt, stream=True, question=question, cancel=flight.token, **options)
+                for delta in stream:
+                    if flight.cancelled:
+                        break  # mọi người chờ đã rời đi
+                    flight.publish(delta)
+            except Exception as e:
+                flight.finish(error=e)
+                raise
+            finally:
+                if stream is not None:
+                    stream.close()
+            flight.finish()
+        
+        flight.future = scheduler.submit(job, user=username, priority=priority)
+    
+    flight, started = inflight.join(key, start, timeout=conf.get('request_timeout') or None)
+    return flight, not started and flight.origin == (username, conv_id)
+
+def list_models():
+    # models the requests can pick ([] without MODELS)
+    slot = scheduler.slots[0]
+    return slot.list_models() if hasattr(slot, 'list_models') else []
+
+def requested_priority():
+    # json "background": true marks scripted / batch requests, they yield to chat users
+    return PRIORITY_BACKGROUND if (request.json or {}).get("background") else PRIORITY_INTERACTIVE
+
+def requested_model():
+    # model chosen by the request (json "model"), None = default model
+    name = (request.json or {}).get("model")
+    if name and name not in [m["id"] for m in list_models()]:
+        raise ValueError(f"Không có model: {name}")
+    return name or None
+
+# Thống kê streaming: time-to-first-token và thời gian tổng
+stream_stats = {"count": 0, "total_ttft": 0.0, "max_ttft": 0.0, "total_time": 0.0}
+stream_stats_lock = threading.Lock()
+
+def current_conv_id():
+    # ID cuộc trò chuyện hiện tại nằm trong cookie session của trình duyệt
+    if 'conv_id' not in session:
+        session['conv_id'] = str(uuid.uuid4())
+    return session['conv_id']
 
 # --- ROUTE XÁC THỰC (AUTH) ---
 @app.route("/login", methods=["GET", "POST"])
@@ -37,12 +161,11 @@ def login():
         username = data.get("username")
         password = data.get("password")
         
-        if mongo_manager and mongo_manager.login_user(username, password):
+        if storage and storage.login_user(username, password):
             session['user'] = username # Lưu trạng thái đăng nhập
             
             # Tạo session chat mới nếu chưa có
-            if username not in user_sessions:
-                user_sessions[username] = str(uuid.uuid4())
+            current_conv_id()
                 
             return jsonify({"status": "success"})
         return jsonify({"status": "fail", "msg": "Sai tài khoản hoặc mật khẩu!"})
@@ -74,8 +197,8 @@ def register():
         return jsonify({"status": "fail", "msg": "Mật khẩu yếu! Cần ít nhất 6 ký tự, bao gồm cả chữ và số."})
         
     # 5. Gọi Database tạo tài khoản
-    if mongo_manager:
-        success, msg = mongo_manager.register_user(username, password)
+    if storage:
+        success, msg = storage.register_user(username, password)
         return jsonify({"status": "success" if success else "fail", "msg": msg})
     
     return jsonify({"status": "fail", "msg": "Lỗi kết nối Database"})
@@ -99,62 +222,232 @@ def get_bot_response():
     
     username = session['user']
     user_input = request.json.get("msg")
+    try:
+        model_name = requested_model()
+    except ValueError as e:
+        return jsonify({"response": str(e)}), 400
     
     # Lấy ID phiên hiện tại của user này
-    current_conv_id = user_sessions.get(username, str(uuid.uuid4()))
+    conv_id = current_conv_id()
+    conversation_manager = sessions.get(username, conv_id)
 
     prompt = conversation_manager.build_prompt(user_input)
-    ai_response = model_wrapper.generate(prompt)
+    question = conversation_manager.standalone_question(user_input)
+    
+    try:
+        flight, duplicate = start_generation(username, conv_id, prompt, question, model_name,
+                                             priority=requested_priority())
+    except QueueFullError as e:
+        return jsonify({"response": str(e)}), 429 if e.per_user else 503
+    try:
+        ai_response = flight.wait()
+    except QueueFullError as e:
+        # inference server đầy (báo về khi job đã chạy)
+        return jsonify({"response": str(e)}), 429 if e.per_user else 503
+    finally:
+        inflight.leave(flight)
+    # partial: lý do dừng sớm ("deadline", ...) nếu câu trả lời bị cắt
+    result = {"response": ai_response, "partial": getattr(ai_response, 'reason', None)}
+    if duplicate:
+        return jsonify(result)
     
     conversation_manager.add_user_message(user_input)
     conversation_manager.add_assistant_message(ai_response)
     
-    if mongo_manager:
+    if storage:
         # Lưu kèm username
-        mongo_manager.save_message(user_input, ai_response, current_conv_id, username)
+        storage.save_message(user_input, ai_response, conv_id, username)
+        sessions.saved(username, conv_id)
+
+    return jsonify(result)
+
+@app.route("/stream_response", methods=["POST"])
+def stream_bot_response():
+    # Giống /get_response nhưng trả từng đoạn text qua Server-Sent Events
+    if 'user' not in session:
+        return jsonify({"response": "Vui lòng đăng nhập lại!"}), 401
+    
+    username = session['user']
+    user_input = request.json.get("msg")
+    try:
+        model_name = requested_model()
+    except ValueError as e:
+        return jsonify({"response": str(e)}), 400
+    conv_id = current_conv_id()
+    conversation_manager = sessions.get(username, conv_id)
+    prompt = conversation_manager.build_prompt(user_input)
+    question = conversation_manager.standalone_question(user_input)
+    
+    started = time.time()
+    
+    try:
+        flight, duplicate = start_generation(username, conv_id, prompt, question, model_name,
+                                             priority=requested_priority())
+    except QueueFullError as e:
+        return jsonify({"response": str(e)}), 429 if e.per_user else 503
+    
+    def events():
+        parts = []
+        ttft = None
+        try:
+            for delta in flight.stream():
+                if ttft is None:
+                    ttft = time.time() - started
+                parts.append(delta)
+                yield f"data: {json.dumps({'delta': delta}, ensure_ascii=False)}\n\n"
+        except Exception as error:
+            yield f"event: error\ndata: {json.dumps({'msg': str(error)}, ensure_ascii=False)}\n\n"
+            return
+        finally:
+            # client ngắt kết nối cũng tới đây; người chờ cuối cùng rời đi thì dừng sinh
+            inflight.leave(flight)
+        
+        # Stream xong: cập nhật context và lưu DB (yêu cầu trùng lặp thì không lưu lại)
+        ai_response = "".join(parts).strip()
+        if not duplicate:
+            conversation_manager.add_user_message(user_input)
+            conversation_manager.add_assistant_message(ai_response)
+            if storage:
+                storage.save_message(user_input, ai_response, conv_id, username)
+                sessions.saved(username, conv_id)
+        
+        total = time.time() - started
+        ttft = ttft if ttft is not None else total
+        with stream_stats_lock:
+            stream_stats["count"] += 1
+            stream_stats["total_ttft"] += ttft
+            stream_stats["max_ttft"] = max(stream_stats["max_ttft"], ttft)
+            stream_stats["total_time"] += total
+        yield f"event: done\ndata: {json.dumps({'ttft': round(ttft, 3), 'total': round(total, 3), 'partial': flight.token.reason})}\n\n"
+    
+    return Response(stream_with_context(events()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route("/api/stats", methods=["GET"])
+def get_stats():
+    if 'user' not in session:
+        return jsonify({"status": "error", "msg": "Chưa đăng nhập"}), 401
+    with stream_stats_lock:
+        count = stream_stats["count"]
+        streaming = {
+            "count": count,
+            "avg_ttft": stream_stats["total_ttft"] / count if count else 0.0,
+            "max_ttft": stream_stats["max_ttft"],
+            "avg_total": stream_stats["total_time"] / count if count else 0.0
+        }
+    return jsonify({"streaming": streaming, "scheduler": scheduler.get_stats(),
+                    "sessions": sessions.get_stats(),
+                    "read_cache": storage.get_cache_stats() if storage else None,
+                    "response_cache": response_cache.get_stats() if response_cache else None,
+                    "semantic_cache": semantic_cache.get_stats() if semantic_cache else None,
+                    "single_flight": inflight.get_stats(),
+                    "models": scheduler.slots[0].get_registry_stats()
+                              if hasattr(scheduler.slots[0], 'get_registry_stats') else None,
+                    "router": scheduler.slots[0].get_router_stats()
+                              if hasattr(scheduler.slots[0], 'get_router_stats') else None,
+                    "speculative": [slot.get_speculative_stats() for slot in scheduler.slots
+                                    if hasattr(slot, 'get_speculative_stats')],
+                    "inference_server": scheduler.slots[0].get_server_stats()
+                                        if hasattr(scheduler.slots[0], 'get_server_stats') else None})
 
-    return jsonify({"response": ai_response})
+def history_etag(username, version):
+    # hai user cùng phiên bản không được dùng chung bản cache của nhau
+    user_hash = hashlib.sha256(username.encode("utf-8")).hexdigest()[:16]
+    return f"{user_hash}-{version}"
+
+def private_response(resp):
+    # nội dung phụ thuộc cookie đăng nhập: chỉ trình duyệt được cache, luôn hỏi lại server
+    resp.headers["Cache-Control"] = "private, no-cache"
+    resp.headers["Vary"] = "Cookie"
+    return resp
 
 @app.route("/api/history", methods=["GET"])
 def get_history_list():
+    # ?since=<version>: chỉ trả các cuộc trò chuyện thay đổi sau phiên bản đó
+    # (since rỗng = toàn bộ danh sách); ETag = user + phiên bản, không đổi thì trả 304
     if 'user' not in session: return jsonify([])
-    if mongo_manager:
-        return jsonify(mongo_manager.get_conversation_list(session['user']))
-    return jsonify([])
+    if not storage:
+        return jsonify([])
+    username = session['user']
+    if "since" not in request.args:
+        return jsonify(storage.get_conversation_list(username))
+    
+    version = storage.get_sync_version(username)
+    if request.if_none_match.contains(history_etag(username, version)) and not storage.has_pending_writes(username):
+        resp = Response(status=304)
+        resp.set_etag(history_etag(username, version))
+        return private_response(resp)
+    
+    changes = storage.get_conversation_changes(username, since=request.args.get("since", type=int))
+    resp = jsonify(changes)
+    if not changes["pending"]:
+        resp.set_etag(history_etag(username, changes["version"]))
+    return private_response(resp)
+
+@app.route("/api/search", methods=["GET"])
+def search_messages():
+    # Tìm trong lịch sử của user: ?q=<từ khóa>&offset=<vị trí trang>
+    if 'user' not in session: return jsonify({"results": [], "next_offset": None})
+    query = request.args.get("q", "").strip()
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    if not storage or not query:
+        return jsonify({"results": [], "next_offset": None})
+    
+    results, next_offset = storage.search_messages(session['user'], query, offset=offset)
+    for r in results:
+        # Escape nội dung, chỉ giữ thẻ <mark> cho từ khớp
+        r["snippet"] = (html.escape(r["snippet"])
+                        .replace(SNIPPET_OPEN, "<mark>").replace(SNIPPET_CLOSE, "</mark>"))
+    return jsonify({"results": results, "next_offset": next_offset})
 
 @app.route("/api/load_chat/<conv_id>", methods=["GET"])
 def load_chat_content(conv_id):
-    if 'user' not in session: return jsonify([])
+    # Phân trang: trang mới nhất trước, ?before=<cursor> để lấy trang cũ hơn
+    if 'user' not in session: return jsonify({"messages": [], "next_cursor": None})
     username = session['user']
-    
-    # Cập nhật ID hiện tại
-    user_sessions[username] = conv_id
-    conversation_manager.clear_history()
+    before = request.args.get("before")
+    limit = max(1, min(request.args.get("limit", conf['history_page_size'], type=int), 100))
     
     messages = []
-    if mongo_manager:
-        raw_msgs = mongo_manager.get_messages_by_conversation_id(conv_id, username)
+    pairs = []
+    next_cursor = None
+    if storage:
+        try:
+            raw_msgs, next_cursor = storage.get_messages_page(conv_id, username, before=before, limit=limit)
+        except ValueError as e:
+            return jsonify({"messages": [], "next_cursor": None, "msg": str(e)}), 400
         for m in raw_msgs:
             messages.append({"role": "user", "content": m.get("user_message")})
             messages.append({"role": "bot", "content": m.get("assistant_response")})
-            # Nạp context
-            conversation_manager.add_user_message(m.get("user_message"))
-            conversation_manager.add_assistant_message(m.get("assistant_response"))
+            pairs.append((m.get("user_message"), m.get("assistant_response")))
+    
+    if before is None:
+        # Cập nhật ID hiện tại và nạp context (chỉ khi session chưa có trong RAM)
+        session['conv_id'] = conv_id
+        sessions.get(username, conv_id, messages=pairs)
             
-    return jsonify(messages)
+    return jsonify({"messages": messages, "next_cursor": next_cursor})
 
 @app.route("/new_chat", methods=["POST"])
 def new_chat():
     if 'user' in session:
-        username = session['user']
-        user_sessions[username] = str(uuid.uuid4())
-        conversation_manager.clear_history()
+        session['conv_id'] = str(uuid.uuid4())
+        sessions.create(session['user'], session['conv_id'])
     return jsonify({"status": "success"})
 
 @app.route("/clear_all", methods=["POST"])
 def clear_all_db():
-    if 'user' in session and mongo_manager:
-        mongo_manager.delete_all_conversations(session['user'])
+    if 'user' in session:
+        conv_ids = {session.get('conv_id')}
+        if storage:
+            conv_ids.update(c["id"] for c in storage.get_conversation_list(session['user']))
+            storage.delete_all_conversations(session['user'])
+        sessions.drop(session['user'])
+        # bỏ KV cache / state đã lưu của các cuộc trò chuyện vừa xoá
+        for model in set(scheduler.slots):
+            if hasattr(model, 'forget_conversation'):
+                for conv_id in conv_ids - {None}:
+                    model.forget_conversation(conv_id)
     return new_chat()
 
 def open_browser():
@@ -169,12 +462,15 @@ def handle_settings():
         
     if request.method == "GET":
         # Lấy cấu hình hiện tại từ model wrapper
-        current_config = model_wrapper.get_config()
+        current_config = scheduler.slots[0].get_config()
         # Chỉ trả về các tham số an toàn để chỉnh sửa
         return jsonify({
             "temperature": current_config.get("temperature", 0.7),
             "max_tokens": current_config.get("max_tokens", 256),
-            "top_p": current_config.get("top_p", 0.9)
+            "top_p": current_config.get("top_p", 0.9),
+            "model": current_config.get("model"),  # model mặc định (khi có MODELS)
+            "models": [{"id": m["id"], "description": m["description"], "loaded": m["loaded"]}
+                       for m in list_models()]
         })
         
     if request.method == "POST":
@@ -186,8 +482,17 @@ def handle_settings():
                 "max_tokens": int(new_settings.get("max_tokens", 256)),
                 "top_p": float(new_settings.get("top_p", 0.9))
             }
-            # Cập nhật vào model wrapper
-            model_wrapper.update_config(clean_settings)
+            if new_settings.get("model"):
+                # đổi model mặc định, các câu trả lời đang sinh vẫn chạy xong trên model cũ
+                if new_settings["model"] not in [m["id"] for m in list_models()]:
+                    raise ValueError(f"Không có model: {new_settings['model']}")
+                scheduler.slots[0].select_model(new_settings["model"])
+                # token id đã cache của các session thuộc tokenizer của model cũ
+                sessions.set_tokenizer(scheduler.slots[0].tokenize)
+            # Cập nhật vào model wrapper của mọi slot
+            for model in set(scheduler.slots):
+                model.update_config(clean_settings)
+            conf.update(clean_settings)  # ngân sách token của prompt (dùng chung mọi session)
             return jsonify({"status": "success"})
         except Exception as e:
             return jsonify({"status": "error", "msg": str(e)})
@@ -0,0 +1,170 @@
+# preload-and-fork launcher for the web app
+# the parent imports web_app and loads the model once (GGUF mmapped), then
+# forks PREFORK_WORKERS processes. with USE_MMAP each worker maps the same
+# GGUF again (the weights are the same page-cache pages), without it the
+# workers share the parent's copy copy-on-write.
+# each worker gets its own llama context with N_THREADS / workers threads,
+# opens its own database connection and accepts on the same listening socket
+# run with: python web_prefork.py [--workers N] [--host H] [--port P] [--report-interval S]
+import os
+import sys
+import time
+import signal
+import socket
+import argparse
+import threading
+
+os.environ["CHAT_AI_PREFORK"] = "1"  # web_app: init_app() runs in the workers
+
+import config
+import web_app
+from core.backend import create_backend
+from core.utils import get_process_memory
+
+
+def run_worker(index, backend, listener, n_threads, ready_fd):
+    # child process: rebuild per-process state, then serve forever
+    from werkzeug.serving import make_server
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the parent stops workers with SIGTERM
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    backend.after_fork(n_threads)
+    # files a process owns: the state store cleans its directory on start and
+    # names snapshots by conversation, the write spill is moved away on replay.
+    # per worker index, so a respawned worker picks up what its predecessor left
+    conf = web_app.conf
+    if conf.get('state_cache_dir'):
+        conf['state_cache_dir'] = os.path.join(conf['state_cache_dir'], f"worker{index}")
+    conf['write_spill_path'] = os.path.join("cache", f"pending_writes_worker{index}.jsonl")
+    web_app.init_app(backend=backend)
+    host, port = listener.getsockname()[:2]
+    server = make_server(host, port, web_app.app, threaded=True, fd=listener.fileno())
+    os.write(ready_fd, b"1")
+    print(f"Worker {index} (pid {os.getpid()}): {n_threads} thread")
+    threading.Thread(target=_exit_with_parent, args=(os.getppid(),), daemon=True).start()
+    try:
+        server.serve_forever()
+    finally:
+        # atexit handlers do not run in a forked child: flush queued writes here
+        if web_app.storage is not None:
+            web_app.storage.close()
+
+
+def _exit_with_parent(parent_pid):
+    # a worker must not outlive the launcher (e.g. when it was killed -9)
+    while os.getppid() == parent_pid:
+        time.sleep(1)
+    os._exit(0)
+
+
+def spawn(index, backend, listener, n_threads, ready_fd):
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            run_worker(index, backend, listener, n_threads, ready_fd)
+        except SystemExit:
+            pass
+        except BaseException as e:
+            print(f"Worker {index} lỗi: {e}", file=sys.stderr)
+            os.write(ready_fd, b"0")
+            code = 1
+        finally:
+            os._exit(code)
+    return pid
+
+
+def memory_report(workers):
+    # rss/pss of the parent and every worker; pss is the fair share, so the
+    # rss total minus the pss total is the memory that sharing saved
+    rows = [("parent", os.getpid())] + [(f"worker {i}", pid) for pid, i in sorted(workers.items(), key=lambda w: w[1])]
+    print(f"\n{'process':>10} | {'pid':>7} | {'rss MB':>9} | {'pss MB':>9} | {'shared MB':>9} | {'private MB':>10}")
+    print("-" * 68)
+    total_rss = total_pss = 0.0
+    for name, pid in rows:
+        usage = get_process_memory(pid)
+        if usage is None:
+            print(f"{name:>10} | {pid:>7} | (không đọc được /proc/{pid}/smaps_rollup)")
+            continue
+        total_rss += usage["rss"]
+        total_pss += usage["pss"]
+        print(f"{name:>10} | {pid:>7} | {usage['rss']:>9.1f} | {usage['pss']:>9.1f} | "
+              f"{usage['shared']:>9.1f} | {usage['private']:>10.1f}")
+    print(f"Tổng RSS {total_rss:.1f} MB, tổng PSS (RAM thực dùng) {total_pss:.1f} MB, "
+          f"chia sẻ tiết kiệm {total_rss - total_pss:.1f} MB\n")
+
+
+def main():
+    conf = web_app.conf
+    parser = argparse.ArgumentParser(description="Chạy web app với model nạp một lần rồi fork worker")
+    parser.add_argument("--workers", type=int, default=conf['prefork_workers'])
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--report-interval", type=float, default=0,
+                        help="giây giữa các lần in báo cáo RSS/PSS (0 = chỉ in khi khởi động)")
+    args = parser.parse_args()
+
+    if conf.get('inference_socket'):
+        print("INFERENCE_SOCKET đang bật: model nằm ở inference server, hãy chạy web_app.py bình thường")
+        sys.exit(1)
+    if conf.get('models'):
+        print("MODELS đang bật: model được nạp/giải phóng theo yêu cầu nên không nạp trước được, hãy chạy web_app.py")
+        sys.exit(1)
+    is_valid, message = config.validate_config(conf)
+    if not is_valid:
+        print(f"Config error: {message}")
+        sys.exit(1)
+
+    n_workers = max(1, args.workers)
+    n_threads = max(1, conf['n_threads'] // n_workers)
+    print(f"Đang nạp model một lần cho {n_workers} worker (mmap={conf.get('use_mmap', True)})...")
+    backend = create_backend(conf)
+    listener = socket.create_server((args.host, args.port), backlog=128)
+    listener.set_inheritable(True)
+    ready_r, ready_w = os.pipe()
+
+    workers = {}  # pid -> index
+    for index in range(n_workers):
+        # one at a time: the next worker forks once this one has its context
+        # and storage (concurrent first opens of the sqlite file can fail)
+        workers[spawn(index, backend, listener, n_threads, ready_w)] = index
+        if os.read(ready_r, 1) != b"1":
+            for pid in workers:
+                os.kill(pid, signal.SIGTERM)
+            print("Không khởi động được worker, dừng")
+            sys.exit(1)
+    print(f"Đang phục vụ tại http://{args.host}:{args.port}")
+    memory_report(workers)
+
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    next_report = time.monotonic() + args.report_interval if args.report_interval else None
+    while workers:
+        pid, status = os.waitpid(-1, os.WNOHANG)
+        if pid == 0:
+            time.sleep(0.5)
+            if next_report is not None and time.monotonic() >= next_report:
+                memory_report(workers)
+                next_report = time.monotonic() + args.report_interval
+            continue
+        index = workers.pop(pid, None)
+        if index is not None and not stopping:
+            # a worker died: fork a replacement from the still loaded model
+            print(f"Worker {index} (pid {pid}) đã thoát ({status}), khởi động lại")
+            time.sleep(1)
+            workers[spawn(index, backend, listener, n_threads, ready_w)] = index
+    listener.close()
+
+
+if __name__ == "__main__":
+    main()